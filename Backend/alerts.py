@@ -0,0 +1,297 @@
+import atexit
+import html
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from llm import CACHE_DIR
+from metrics import span
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+SENDER = "onboarding@resend.dev"
+
+
+def resend_sender(message):
+    """Send an email through Resend
+
+    Raises:
+        RuntimeError: If Resend did not accept the email"""
+    import resend
+
+    resend.api_key = os.getenv("RESEND_API_KEY")
+    with span("resend.send"):
+        response = resend.Emails.send(message)
+    if not response or not response.get("id"):
+        raise RuntimeError("Resend did not accept the email: {}".format(response))
+    return response["id"]
+
+
+def urgent_priority():
+    """Priority from which an alert skips the window"""
+    return int(os.getenv("ALERT_URGENT_PRIORITY", "8"))
+
+
+def lookup_nurse(nurse_id):
+    from system import System
+
+    return System().get_nurse(nurse_id, {"email": 1, "first_name": 1, "last_name": 1})
+
+
+def digest_message(nurse, alerts):
+    """The email of a digest: one line per distressed patient"""
+    nurse_name = nurse["first_name"] + " " + nurse["last_name"]
+    if len(alerts) == 1:
+        subject = "Urgent care alert for nurse {}".format(nurse_name)
+    else:
+        subject = "Urgent care alert for nurse {}: {} patients".format(nurse_name, len(alerts))
+    items = "".join(
+        "<li> Patient: {} (ID: {}){}</li>".format(
+            html.escape(alert["patient_name"] or "Unknown"),
+            html.escape(alert["patient_id"]),
+            " - {} conversations".format(alert["count"]) if alert["count"] > 1 else "",
+        )
+        for alert in alerts
+    )
+    return {
+        "from": SENDER,
+        "to": str(nurse["email"]),
+        "subject": subject,
+        "html": (
+            "<html><ul>{}"
+            "<li> Status: Emergent </li>"
+            "<li> Action Required: Immediate attention needed. Review patient details promptly "
+            "and proceed with urgent care protocols. </li>"
+            "</ul></html>"
+        ).format(items),
+    }
+
+
+class AlertDispatcher:
+    """Nurse alerts sent by a background thread from a SQLite outbox.
+
+    alert() only writes to the outbox, so the pipeline does not wait for
+    the nurse lookup or the email. The alerts of a nurse are collected for
+    window seconds after the first one and sent as one digest; another alert
+    for a patient already in the digest only bumps its count. A digest that
+    fails is retried with exponential backoff, up to max_attempts times.
+    Alerts stay in the outbox until sent, so they survive restarts.
+
+    Urgent alerts make the digest of their nurse due at once. A sender
+    claims the rows of a digest with a conditional update before sending,
+    so several processes can share the outbox without sending a digest
+    twice; the claim expires after claim_timeout seconds in case the
+    sender dies. drain() sends everything pending, e.g. before exiting."""
+
+    def __init__(self, path=None, window=None, max_attempts=None, retry_delay=None,
+                 sender=None, nurse_lookup=None, poll_interval=1.0, claim_timeout=300):
+        """
+        Args:
+            path (str): The SQLite outbox. Defaults to ALERTS_PATH.
+            window (float): Seconds to collect the alerts of a nurse. Defaults
+                to ALERT_WINDOW (60).
+            max_attempts (int): Sends of a digest before its alerts are marked
+                failed. Defaults to ALERT_MAX_ATTEMPTS (5).
+            retry_delay (float): Seconds before the first retry, doubled after
+                each failure. Defaults to ALERT_RETRY_DELAY (5).
+            sender (callable): Sends a Resend-style message dict. Defaults to Resend.
+            nurse_lookup (callable): Returns the nurse (email, first_name,
+                last_name) of an ID. Defaults to the nurses collection.
+            poll_interval (float): Longest sleep of the sender thread
+            claim_timeout (float): Seconds before the rows claimed by a
+                sender that did not finish can be claimed again
+        """
+        self.path = path or os.getenv("ALERTS_PATH", os.path.join(CACHE_DIR, "alerts.sqlite3"))
+        self.window = window if window is not None else float(os.getenv("ALERT_WINDOW", "60"))
+        self.max_attempts = max_attempts or int(os.getenv("ALERT_MAX_ATTEMPTS", "5"))
+        self.retry_delay = retry_delay if retry_delay is not None else float(os.getenv("ALERT_RETRY_DELAY", "5"))
+        self.sender = sender or resend_sender
+        self.nurse_lookup = nurse_lookup or lookup_nurse
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition()
+        self.stopping = threading.Event()
+        self.thread = None
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS alerts ("
+            "id TEXT PRIMARY KEY, nurse_id TEXT, patient_id TEXT, patient_name TEXT, "
+            "count INTEGER DEFAULT 1, state TEXT, attempts INTEGER DEFAULT 0, "
+            "next_attempt_at REAL DEFAULT 0, error TEXT, created_at REAL, sent_at REAL)"
+        )
+        columns = {row["name"] for row in self.connection.execute("PRAGMA table_info(alerts)")}
+        # Added after the first outboxes were created
+        for column, definition in (
+            ("urgent", "INTEGER DEFAULT 0"), ("claimed_by", "TEXT"), ("claimed_until", "REAL DEFAULT 0"),
+        ):
+            if column not in columns:
+                self.connection.execute("ALTER TABLE alerts ADD COLUMN {} {}".format(column, definition))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS alerts_state ON alerts (state, nurse_id)")
+        # One pending alert per nurse and patient
+        self.connection.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS alerts_pending_patient ON alerts (nurse_id, patient_id) "
+            "WHERE state = 'pending'"
+        )
+
+    def alert(self, nurse_id, patient_id, patient_name=None, urgent=False):
+        """Queue an alert for a nurse about a patient. An urgent alert is
+        sent without waiting for the window."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO alerts (id, nurse_id, patient_id, patient_name, state, created_at, urgent) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (nurse_id, patient_id) WHERE state = 'pending' "
+                "DO UPDATE SET count = count + 1, urgent = MAX(urgent, excluded.urgent)",
+                (uuid.uuid4().hex, str(nurse_id), str(patient_id), patient_name, PENDING, time.time(), int(urgent)),
+            )
+        with self.wakeup:
+            self.wakeup.notify()
+
+    def counts(self):
+        """The number of alerts in each state"""
+        with self.lock:
+            rows = self.connection.execute("SELECT state, COUNT(*) FROM alerts GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
+
+    def due(self, now=None, force=False):
+        """The nurses whose digest is due: window elapsed or urgent, and not
+        backing off. With force, every nurse with pending alerts."""
+        now = time.time() if now is None else now
+        with self.lock:
+            if force:
+                rows = self.connection.execute(
+                    "SELECT DISTINCT nurse_id FROM alerts WHERE state = ?", (PENDING,)
+                ).fetchall()
+            else:
+                rows = self.connection.execute(
+                    "SELECT nurse_id FROM alerts WHERE state = ? GROUP BY nurse_id "
+                    "HAVING (MIN(created_at) + ? <= ? OR MAX(urgent) = 1) AND MAX(next_attempt_at) <= ?",
+                    (PENDING, self.window, now, now),
+                ).fetchall()
+        return [row["nurse_id"] for row in rows]
+
+    def flush(self, now=None, force=False):
+        """Send every due digest, or with force every pending one
+
+        Returns:
+            int: The number of digests sent"""
+        sent = 0
+        for nurse_id in self.due(now, force):
+            sent += self.send_digest(nurse_id)
+        return sent
+
+    def claim(self, nurse_id):
+        """Claim the pending alerts of a nurse for one send
+
+        Returns:
+            list: The claimed alerts, none if another sender holds them"""
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            # Atomic across processes: SQLite serializes the writes
+            self.connection.execute(
+                "UPDATE alerts SET claimed_by = ?, claimed_until = ? "
+                "WHERE state = ? AND nurse_id = ? AND (claimed_by IS NULL OR claimed_until < ?)",
+                (token, now + self.claim_timeout, PENDING, nurse_id, now),
+            )
+            return [dict(row) for row in self.connection.execute(
+                "SELECT * FROM alerts WHERE claimed_by = ? AND state = ? ORDER BY created_at",
+                (token, PENDING),
+            ).fetchall()]
+
+    def send_digest(self, nurse_id):
+        alerts = self.claim(nurse_id)
+        if not alerts:
+            return False
+        ids = [alert["id"] for alert in alerts]
+        try:
+            nurse = self.nurse_lookup(nurse_id)
+            if nurse is None:
+                raise LookupError("Nurse {} not found".format(nurse_id))
+            self.sender(digest_message(nurse, alerts))
+        except Exception as e:
+            print("Failed to alert nurse {}: {}".format(nurse_id, e))
+            self._failed(ids, max(alert["attempts"] for alert in alerts) + 1, "{}: {}".format(type(e).__name__, e))
+            return False
+        self._update(ids, "state = ?, sent_at = ?, claimed_by = NULL", (SENT, time.time()))
+        return True
+
+    def _failed(self, ids, attempts, error):
+        if attempts >= self.max_attempts:
+            self._update(
+                ids, "state = ?, attempts = ?, error = ?, claimed_by = NULL", (FAILED, attempts, error)
+            )
+        else:
+            next_attempt_at = time.time() + self.retry_delay * 2 ** (attempts - 1)
+            self._update(
+                ids, "attempts = ?, next_attempt_at = ?, error = ?, claimed_by = NULL",
+                (attempts, next_attempt_at, error),
+            )
+
+    def _update(self, ids, assignments, values):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE alerts SET {} WHERE id IN ({})".format(assignments, ",".join("?" * len(ids))),
+                (*values, *ids),
+            )
+
+    def start(self):
+        """Start the sender thread"""
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._work, name="alert-sender", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the sender thread. Unsent alerts stay in the outbox."""
+        self.stopping.set()
+        with self.wakeup:
+            self.wakeup.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.thread = None
+
+    def drain(self, timeout=5):
+        """Stop the sender thread and try every pending digest once, e.g.
+        before a short-lived process exits
+
+        Returns:
+            int: The number of digests sent"""
+        self.stop(timeout)
+        return self.flush(force=True)
+
+    def _work(self):
+        while not self.stopping.is_set():
+            try:
+                self.flush()
+            except Exception as e:
+                print("Alert dispatcher error: {}".format(e))
+            with self.wakeup:
+                self.wakeup.wait(min(self.poll_interval, self.window) or self.poll_interval)
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_alert_dispatcher():
+    """Return the process-wide alert dispatcher, with its sender thread started"""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                dispatcher = AlertDispatcher()
+                dispatcher.start()
+                # Do not leave alerts waiting for their window at exit
+                atexit.register(dispatcher.drain)
+                _dispatcher = dispatcher
+    return _dispatcher
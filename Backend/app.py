@@ -1,16 +1,223 @@
-from typing import Annotated
-from fastapi import FastAPI
+import asyncio
+import os
+from typing import Annotated, Optional
+from fastapi import FastAPI, Header, HTTPException, Query, Response
+from fastapi.responses import FileResponse
 from chat import Chat 
-import uvicorn
+from system import System, as_object_id, decode_cursor
+from db import close_clients
+from render_service import get_render_service
+from qr_codes import get_qr_store
+from jobs import get_job_queue
+from alerts import get_alert_dispatcher
+from response_cache import NURSES_TAG, dumps, etag_matches, patient_tag, record_tag, response_cache
+from note_history import NoteHistory
+from emotions import note_vector, top_emotions_dict
+from pdf import pdf_path, read_render_state
+from bson import ObjectId
+import metrics
+import llm
 
 app = FastAPI()
 
+
+def process_conversation_job(payload):
+    conversation = Chat(payload["patient_id"]).process_conversation(payload.get("chat_id"))
+    return {"patient_id": payload["patient_id"], "chat_id": payload.get("chat_id"), "processed": conversation is not None}
+
+
+# The patient fields served by the read API
+PATIENT_FIELDS = {
+    "first_name": 1, "last_name": 1, "age": 1, "dob": 1, "gender": 1, "weight": 1,
+    "blood_type": 1, "room_number": 1, "assign_nurse_id": 1, "order": 1, "note": 1,
+    "process": 1, "version": 1,
+}
+NURSE_LIST_FIELDS = {"first_name": 1, "last_name": 1, "room_number": 1, "order": 1, "note": 1, "process": 1}
+
+
+def valid_id(object_id):
+    """Raise a 404 for an ID that cannot be an ObjectId, rather than a 500"""
+    if not ObjectId.is_valid(object_id):
+        raise HTTPException(status_code=404, detail="Not found")
+    return object_id
+
+
+def cached_json(key, tags, load, if_none_match=None):
+    """Serve a JSON response from the response cache, loading and caching it
+    on a miss, with an ETag and a 304 for a matching If-None-Match"""
+    entry = response_cache.get(key)
+    if entry is None:
+        data = load()
+        if data is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        entry = response_cache.set(key, dumps(data), tags)
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+
+def latest_note(patient_id):
+    note = NoteHistory(System().client["nursecheck"]).last(
+        as_object_id(patient_id), ["timestamp", "note", "priority", "emotion_vector", "emotions"]
+    )
+    if note is None:
+        return None
+    return {
+        "timestamp": note.get("timestamp"),
+        "note": note.get("note"),
+        "priority": note.get("priority"),
+        "top_emotions": top_emotions_dict(note_vector(note), 5),
+    }
+
+
+@app.on_event("startup")
+def startup():
+    system = System()
+    system.ensure_indexes()
+    system.resync_triage_queue()
+    jobs = get_job_queue()
+    jobs.register("process_conversation", process_conversation_job)
+    jobs.start()
+    get_alert_dispatcher()
+
+
+@app.on_event("shutdown")
+def close_database():
+    get_job_queue().stop(timeout=5)
+    get_alert_dispatcher().stop(timeout=5)
+    get_render_service().shutdown(wait=True)
+    close_clients()
+
+
+@app.on_event("shutdown")
+async def close_llm_client():
+    await llm.close_async_llm_client()
+
+
 @app.get("/patients/{patient_id}")
-def get_patient(patient_id: str):
+async def get_patient(patient_id: str):
     chat = Chat(patient_id)
-    chat.process_conversation()
+    try:
+        await chat.process_conversation_async()
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="LLM stage timed out")
     return {"status": "success"}
 
 
+@app.post("/patients/{patient_id}/process", status_code=202)
+def process_patient(
+    patient_id: str,
+    chat_id: Optional[str] = None,
+    idempotency_key: Annotated[Optional[str], Header()] = None,
+):
+    """Queue the processing of a patient's latest (or given) chat"""
+    key = idempotency_key or "process:{}:{}".format(patient_id, chat_id or "latest")
+    job, created = get_job_queue().enqueue(
+        "process_conversation", {"patient_id": patient_id, "chat_id": chat_id}, key
+    )
+    return {"job_id": job["id"], "state": job["state"], "created": created}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Stage latencies, Mongo command latencies and counters in the Prometheus text format"""
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/patients/{patient_id}/record/status")
+def get_record_status(patient_id: str):
+    return get_render_service().status(patient_id)
+
+
+@app.get("/patients/{patient_id}/qr")
+def get_patient_qr(patient_id: str):
+    valid_id(patient_id)
+    store = get_qr_store()
+    # Only codes of existing patients are encoded, cached and written
+    if patient_id not in store and System().get_patient(patient_id, {"_id": 1}) is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    return Response(content=store.get(patient_id), media_type="image/png")
+
+
+
+@app.get("/patients/{patient_id}/profile")
+def read_patient(patient_id: str, if_none_match: Annotated[Optional[str], Header()] = None):
+    valid_id(patient_id)
+    return cached_json(
+        ("patient", patient_id),
+        [patient_tag(patient_id)],
+        lambda: System().get_patient(patient_id, PATIENT_FIELDS),
+        if_none_match,
+    )
+
+
+@app.get("/patients/{patient_id}/record")
+def read_record(patient_id: str, if_none_match: Annotated[Optional[str], Header()] = None):
+    valid_id(patient_id)
+    # The notes are served one at a time by /notes/latest
+    return cached_json(
+        ("record", patient_id),
+        [record_tag(patient_id)],
+        lambda: System().get_patient_record(patient_id, {"notes": 0}),
+        if_none_match,
+    )
+
+
+@app.get("/patients/{patient_id}/notes/latest")
+def read_latest_note(patient_id: str, if_none_match: Annotated[Optional[str], Header()] = None):
+    valid_id(patient_id)
+    return cached_json(
+        ("latest_note", patient_id), [record_tag(patient_id)], lambda: latest_note(patient_id), if_none_match
+    )
+
+
+@app.get("/nurses/{nurse_id}/patients")
+def read_nurse_patients(
+    nurse_id: str,
+    processed: bool = False,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    cursor: Optional[str] = None,
+    if_none_match: Annotated[Optional[str], Header()] = None,
+):
+    """A page of a nurse's patients, highest priority first"""
+    if cursor is not None:
+        try:
+            decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return cached_json(
+        ("nurse", nurse_id, processed, limit, cursor),
+        [NURSES_TAG],
+        lambda: System().get_patients_page(nurse_id, processed, limit, cursor, NURSE_LIST_FIELDS),
+        if_none_match,
+    )
+
+
+@app.get("/patients/{patient_id}/record/pdf")
+def read_record_pdf(patient_id: str, if_none_match: Annotated[Optional[str], Header()] = None):
+    valid_id(patient_id)
+    path = pdf_path(patient_id)
+    state = read_render_state(patient_id)
+    if state is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Record PDF not found")
+    # The render hash identifies the content of the PDF
+    etag = '"{}"'.format(state["hash"][:32])
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="application/pdf", headers=headers)
+
+
 if __name__ == "__main__":
+    import uvicorn
+
     uvicorn.run(app, host="0.0.0.0", port=5173)
@@ -0,0 +1,236 @@
+"""Re-summarize the stored conversations that are still marked unprocessed.
+
+Usage:
+    python3 backfill.py --concurrency 8 --rate 2 --batch-size 50
+
+Documents are streamed from the database in _id order, summarized by a
+bounded pool of workers sharing a token-bucket rate limit, and written back
+in bulk. Each write sets the summary and flips processed in the same update,
+guarded on processed still being False. The checkpoint file records the
+highest _id below which everything has been written, so an interrupted run
+resumes where it stopped.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import time
+from collections import deque
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from db import get_client
+from llm import CACHE_DIR, LLM_MODEL
+from record import Record
+
+
+class TokenBucket:
+    """Allow rate operations per second on average, with bursts up to capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Checkpoint:
+    """Progress of a backfill, persisted as JSON"""
+
+    def __init__(self, path):
+        self.path = path
+        self.last_id = None
+        self.summarized = 0
+        self.failed_ids = []
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.last_id = ObjectId(data["last_id"]) if data.get("last_id") else None
+            self.summarized = data.get("summarized", 0)
+            self.failed_ids = data.get("failed_ids", [])
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "last_id": str(self.last_id) if self.last_id else None,
+                    "summarized": self.summarized,
+                    "failed_ids": self.failed_ids,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path)
+
+
+class Backfill:
+    def __init__(self, client=None, concurrency=4, rate=1.0, batch_size=50,
+                 checkpoint_path=None, limit=None, report_every=10.0):
+        """
+        Args:
+            client (MongoClient): The client to use. Defaults to the shared client.
+            concurrency (int): The number of conversations summarized at once
+            rate (float): The maximum number of summaries started per second
+            batch_size (int): The number of results per bulk_write
+            checkpoint_path (str): Where to keep progress. None disables resuming.
+            limit (int): Stop after this many documents
+            report_every (float): Seconds between progress reports
+        """
+        self.client = client or get_client()
+        self.documents = self.client["nursecheck"]["documents"]
+        self.record = Record(client=self.client)
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate)
+        self.batch_size = batch_size
+        self.checkpoint = Checkpoint(checkpoint_path)
+        self.limit = limit
+        self.report_every = report_every
+
+        self.pending = []
+        self.in_flight = deque()
+        self.done = set()
+        self.summarized = 0
+        self.failed = 0
+        self.started = None
+        self.reported = None
+
+    def cursor(self):
+        query = {"processed": False}
+        if self.checkpoint.last_id:
+            query["_id"] = {"$gt": self.checkpoint.last_id}
+        cursor = (
+            self.documents.find(query, {"content": 1, "patient_id": 1})
+            .sort("_id", 1)
+            .batch_size(self.batch_size)
+        )
+        if self.limit:
+            cursor = cursor.limit(self.limit)
+        return cursor
+
+    async def run(self):
+        """Summarize every unprocessed document
+
+        Returns:
+            dict: The number of summarized and failed documents"""
+        self.started = self.reported = time.monotonic()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self.worker(queue)) for _ in range(self.concurrency)]
+
+        cursor = self.cursor()
+        while True:
+            batch = await asyncio.to_thread(lambda: list(itertools.islice(cursor, self.batch_size)))
+            if not batch:
+                break
+            for document in batch:
+                self.in_flight.append(document["_id"])
+                await queue.put(document)
+
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        await self.flush()
+        self.report(final=True)
+        return {"summarized": self.summarized, "failed": self.failed}
+
+    async def worker(self, queue):
+        while True:
+            document = await queue.get()
+            if document is None:
+                return
+            await self.bucket.acquire()
+            try:
+                summary = await asyncio.to_thread(self.record.summarize_conversation, document)
+            except Exception as e:
+                print("Failed to summarize document {}: {}".format(document["_id"], e))
+                self.failed += 1
+                self.checkpoint.failed_ids.append(str(document["_id"]))
+                self.done.add(document["_id"])
+                continue
+            self.pending.append((
+                document["_id"],
+                UpdateOne(
+                    {"_id": document["_id"], "processed": False},
+                    {
+                        "$set": {
+                            "processed": True,
+                            "summary": summary,
+                            "summary_model": LLM_MODEL,
+                            "summarized_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                        }
+                    },
+                ),
+            ))
+            if len(self.pending) >= self.batch_size:
+                await self.flush()
+            self.report()
+
+    async def flush(self):
+        """Write the pending summaries and advance the checkpoint"""
+        pending, self.pending = self.pending, []
+        if pending:
+            requests = [request for _, request in pending]
+            result = await asyncio.to_thread(self.documents.bulk_write, requests, ordered=False)
+            self.summarized += result.modified_count
+            self.checkpoint.summarized += result.modified_count
+            self.done.update(document_id for document_id, _ in pending)
+        # Only move past a document once everything before it is written
+        while self.in_flight and self.in_flight[0] in self.done:
+            self.checkpoint.last_id = self.in_flight.popleft()
+            self.done.discard(self.checkpoint.last_id)
+        self.checkpoint.save()
+
+    def report(self, final=False):
+        now = time.monotonic()
+        if not final and now - self.reported < self.report_every:
+            return
+        self.reported = now
+        elapsed = max(now - self.started, 1e-9)
+        print(
+            "{}{} summarized, {} failed, {} pending, {:.2f} docs/s".format(
+                "Done: " if final else "",
+                self.summarized,
+                self.failed,
+                len(self.pending),
+                self.summarized / elapsed,
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize unprocessed conversations")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=1.0, help="summaries started per second")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--checkpoint", default=os.path.join(CACHE_DIR, "backfill_checkpoint.json"))
+    parser.add_argument("--from-start", action="store_true", help="ignore the checkpoint, e.g. to retry failures")
+    args = parser.parse_args()
+
+    if args.from_start and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    backfill = Backfill(
+        concurrency=args.concurrency,
+        rate=args.rate,
+        batch_size=args.batch_size,
+        checkpoint_path=args.checkpoint,
+        limit=args.limit,
+    )
+    asyncio.run(backfill.run())
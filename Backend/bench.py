@@ -0,0 +1,613 @@
+"""Microbenchmarks of the conversation pipeline and the portal reads.
+
+Usage:
+    python3 bench.py --sizes 100 1000 5000 --repeat 5 --llm-latency 0.05
+    python3 bench.py --compare cache/bench/<commit>.json
+
+Nothing external is needed: MongoDB is replaced by mongomock, and one local
+HTTP server plays the OpenAI-compatible yi-large API, the Hume
+/v0/evi/chats API and Resend. For every size the database is seeded with
+that many patients, and the benchmarked patient has a record of size / 10
+notes (at least 10). LLM and Hume answers are never served from their
+caches, so each run pays for the (simulated) API calls.
+
+With --models N, the construction, validation and serialization of N
+objects.Patient models is compared against the dataclass-style models
+they replaced (LegacyPatient below), including the batch decoding of
+documents.
+
+With --startup, the entry modules (app, chat, ui) are also imported in
+fresh interpreters under `python -X importtime`, reporting the import time
+of each and its heaviest direct imports.
+
+Results are written to JSON, by default cache/bench/<commit>.json, so that
+runs of two commits can be compared with --compare.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import mongomock
+from bson import ObjectId
+from pydantic import BaseModel
+
+from llm import CACHE_DIR
+
+BENCH_CHAT_ID = "bench-chat"
+STARTUP_MODULES = ("app", "chat", "ui")
+IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+WORDS = (
+    "headache nausea fever cough fatigue dizziness chest pain shortness breath swelling rash "
+    "insomnia anxiety confusion appetite vomiting bleeding fracture infection wound dressing "
+    "blood pressure glucose insulin medication dosage allergy mobility fall risk oxygen "
+    "saturation heart rate temperature hydration catheter sedation recovery surgery discharge"
+).split()
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the yi-large chat completions, Hume chat history
+    and Resend email APIs. Every request waits latency seconds first."""
+
+    latency = 0.0
+    chat_events = 40
+    emails = 0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        page_number = int(params.get("page_number", ["0"])[0])
+        page_size = int(params.get("page_size", ["100"])[0])
+        if url.path == "/v0/evi/chats":
+            items = [{"id": BENCH_CHAT_ID, "status": "USER_ENDED", "start_timestamp": 1, "end_timestamp": 2}]
+            body = {"chats_page": items[page_number * page_size:(page_number + 1) * page_size]}
+        elif url.path.startswith("/v0/evi/chats/"):
+            items = self.events()
+            body = {
+                "id": url.path.rsplit("/", 1)[-1],
+                "status": "USER_ENDED",
+                "start_timestamp": 1,
+                "end_timestamp": 2,
+                "events_page": items[page_number * page_size:(page_number + 1) * page_size],
+            }
+        else:
+            self.reply(404, {"message": "Not found"})
+            return
+        body.update(page_number=page_number, page_size=page_size, total_pages=-(-len(items) // page_size))
+        self.reply(200, body)
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.endswith("/chat/completions"):
+            prompt = request["messages"][-1]["content"]
+            self.reply(200, {
+                "id": "bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": self.answer(prompt)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+        elif self.path == "/emails":
+            FakeAPIHandler.emails += 1
+            self.reply(200, {"id": "email-{}".format(FakeAPIHandler.emails)})
+        else:
+            self.reply(404, {"message": "Not found"})
+
+    @staticmethod
+    def answer(prompt):
+        if prompt.startswith("From these emotion"):
+            # Negative emotions, so the nurse alert is part of the run
+            return "True"
+        if prompt.startswith("Process the priority"):
+            return "7"
+        return (
+            "Patient reports headache, insomnia and anxiety; blood pressure and heart rate "
+            "stable, medication dosage unchanged."
+        )
+
+    @classmethod
+    def events(cls):
+        events = []
+        for i in range(cls.chat_events):
+            if i % 2:
+                events.append({
+                    "role": "USER",
+                    "message_text": "I have a {} and some {}.".format(WORDS[i % len(WORDS)], WORDS[(i * 7) % len(WORDS)]),
+                    "emotion_features": json.dumps({"Pain": 0.1 * (i % 10), "Anxiety": 0.3, "Calmness": 0.2}),
+                })
+            else:
+                events.append({"role": "AGENT", "message_text": "How are you feeling today?"})
+        return events
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_api(latency=0.0):
+    """Serve FakeAPIHandler on a free local port
+
+    Returns:
+        ThreadingHTTPServer: The server. Its base URL is http://127.0.0.1:<server_port>."""
+    FakeAPIHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAPIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def use_fakes(mongo, base_url, workdir):
+    """Point the shared clients and stores of the app at the stand-ins.
+
+    The module attributes are set after import, so a .env pointing at the
+    real services cannot send benchmark traffic to them."""
+    import alerts
+    import db
+    import llm
+    import render_service
+    import resend
+
+    db.MongoClient = lambda uri=None, **options: mongo
+    db._clients.clear()
+    llm.API_BASE = base_url + "/v1"
+    llm.API_KEY = "bench"
+    llm._client = None
+    resend.api_url = base_url
+    os.environ["RESEND_API_KEY"] = "bench"
+    llm._cache = llm.LLMCache(os.path.join(workdir, "llm_cache.sqlite3"))
+    # Renders are deferred past the end of the run, so they never overlap a
+    # timed call; PDF.create_pdf is timed on its own
+    render_service._service = render_service.RenderService(workers=0, delay=3600)
+    # Alerts are only queued, in an outbox of the run: the shared one is not
+    # drained at exit, after the stand-in server has stopped
+    alerts._dispatcher = alerts.AlertDispatcher(os.path.join(workdir, "alerts.sqlite3"))
+    os.chdir(workdir)
+    os.makedirs("records", exist_ok=True)
+
+
+def seed(mongo, size, rng):
+    """Fill a fresh database with size patients, one nurse per 25 patients,
+    and a record of size / 10 notes for the first patient
+
+    Returns:
+        dict: The IDs of the benchmarked patient and nurse"""
+    from emotions import EMOTIONS, encode_vector
+    from indexes import ensure_indexes
+    from note_history import NoteHistory
+    from search_index import patient_index
+    from triage_queue import get_triage_queue
+    import vector_index
+
+    mongo.drop_database("nursecheck")
+    db = mongo["nursecheck"]
+    ensure_indexes(db, force=True)
+
+    nurses = [
+        {
+            "_id": ObjectId(),
+            "first_name": "Nurse",
+            "last_name": str(i),
+            "email": "nurse{}@example.com".format(i),
+        }
+        for i in range(size // 25 + 1)
+    ]
+    db["nurses"].insert_many(nurses)
+    patients = []
+    for i in range(size):
+        patients.append({
+            "_id": ObjectId(),
+            "first_name": "Patient",
+            "last_name": str(i),
+            "age": rng.randint(18, 95),
+            "dob": "1970-01-01",
+            "address": "{} Main Street".format(i),
+            "weight": rng.randint(45, 120),
+            "blood_type": rng.choice(["A+", "B+", "O+", "AB-"]),
+            "phone": "555-{:04d}".format(i),
+            "email": "patient{}@example.com".format(i),
+            "gender": rng.choice(["Female", "Male"]),
+            "room_number": str(100 + i),
+            "assign_nurse_id": str(nurses[i % len(nurses)]["_id"]),
+            "order": rng.randint(1, 10),
+            "note": " ".join(rng.sample(WORDS, 12)),
+            "process": rng.random() < 0.2,
+            "version": 0,
+        })
+    patients[0]["process"] = False
+    db["patients"].insert_many(patients)
+
+    patient = patients[0]
+    history = NoteHistory(db)
+    notes = max(10, size // 10)
+    start = datetime(2024, 1, 1)
+    for i in range(notes):
+        timestamp = (start + timedelta(hours=6 * i)).strftime("%Y-%m-%d %H:%M:%S")
+        history.append(patient["_id"], {
+            "content": "Nurse: How are you?\nPatient: I have a {}.\n".format(rng.choice(WORDS)),
+            "note": " ".join(rng.sample(WORDS, 10)),
+            "timestamp": timestamp,
+            "emotion_vector": encode_vector([rng.random() for _ in EMOTIONS]),
+            "emotion_events": 20,
+            "priority": rng.randint(1, 10),
+        })
+    db["records"].insert_one({
+        "patient_id": patient["_id"],
+        "patient_name": "Patient 0",
+        "age": patient["age"],
+        "gender": patient["gender"],
+        "weight": patient["weight"],
+        "blood_type": patient["blood_type"],
+        "date_created": "2024-01-01 00:00:00",
+        "last_updated": timestamp,
+        "doctor_id": "789",
+        "note_count": notes,
+    })
+
+    # The in-process indexes are rebuilt untimed, as a long-running app has them
+    vector_index._index = vector_index.VectorIndex(os.path.join("vector_index", str(size)))
+    patient_index.build(db["patients"])
+    get_triage_queue().resync(db["patients"])
+    return {"patient_id": str(patient["_id"]), "nurse_id": patient["assign_nurse_id"]}
+
+
+def summarize(times):
+    """Milliseconds statistics of a list of durations in seconds"""
+    ms = sorted(t * 1000 for t in times)
+    return {
+        "runs": len(ms),
+        "min_ms": round(ms[0], 3),
+        "median_ms": round(statistics.median(ms), 3),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "p95_ms": round(ms[min(len(ms) - 1, int(0.95 * len(ms)))], 3),
+    }
+
+
+def measure(function, repeat, setup=None, warmup=1):
+    """Time repeat calls of function, after warmup untimed ones. setup runs
+    untimed before every call. The output of both is discarded."""
+    times = []
+    for i in range(warmup + repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start
+        if i >= warmup:
+            times.append(elapsed)
+    return summarize(times)
+
+
+def bench_size(mongo, base_url, size, repeat, workdir, rng):
+    """Run every benchmark against a database of size patients
+
+    Returns:
+        dict: Benchmark name -> statistics"""
+    from chat import Chat, HumeChatClient
+    import llm
+    from pdf import PDF
+    from record import Record
+    from system import System
+    import ui
+
+    ids = seed(mongo, size, rng)
+    patient_id, nurse_id = ids["patient_id"], ids["nurse_id"]
+    ui.db = mongo["nursecheck"]
+    ui.patients_collection = ui.db.patients
+    ui.st.session_state.clear()
+    portal = ui.System()
+    system = System(client=mongo)
+    hume = HumeChatClient(api_key="bench", base_url=base_url, cache_dir=os.path.join(workdir, "hume"))
+    results = {}
+
+    def cold_llm_and_hume():
+        llm.get_llm_cache().clear()
+        hume.transcripts.clear()
+        shutil.rmtree(hume.cache_dir, ignore_errors=True)
+
+    results["chat.process_conversation"] = measure(
+        lambda: Chat(patient_id, client=mongo, hume_client=hume).process_conversation(),
+        repeat,
+        setup=cold_llm_and_hume,
+    )
+
+    record = Record("Nurse: How are you?\nPatient: Better today.\n", client=mongo)
+    note = {
+        "content": "Nurse: How are you?\nPatient: Better today.\n",
+        "note": "Patient feels better today; mild headache remains.",
+        "emotion_events": 2,
+        "priority": 4,
+    }
+    results["record.update_record"] = measure(
+        lambda: record.update_record(
+            patient_id, dict(note, timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        ),
+        repeat,
+    )
+
+    pdf = PDF(client=mongo)
+    results["pdf.create_pdf"] = measure(lambda: pdf.create_pdf(patient_id), repeat)
+
+    results["ui.similarity_search"] = measure(
+        lambda: portal.similarity_search(patient_id),
+        repeat,
+        # Cold for the portal cache, warm for the shared word index
+        setup=lambda: portal.data.invalidate(),
+    )
+
+    results["system.check_patients_order"] = measure(
+        lambda: system.check_patients_order(nurse_id=nurse_id, n=20), repeat
+    )
+    results["system.check_patients_order_all"] = measure(
+        lambda: system.check_patients_order(n=20), repeat
+    )
+    return results
+
+
+@dataclass
+class LegacyPatient(BaseModel):
+    """The Patient model before objects.Model, for --models"""
+    first_name: str
+    last_name: str
+    age: int
+    dob: str
+    address: str
+    weight: int
+    blood_type: str
+    phone: str
+    email: str
+    gender: str
+    room_number: str
+    assign_nurse_id: str = None
+    order: int = None
+    note: str = None
+    process: bool = False
+
+    def __init__(self, first_name, last_name, age, dob, address, weight, blood_type, phone, email, gender, room_number, assign_nurse_id, order, note, process=False):
+        super().__init__(first_name=first_name, last_name=last_name, age=age, dob=dob, address=address, weight=weight, blood_type=blood_type, phone=phone, email=email, gender=gender, room_number=room_number, assign_nurse_id=assign_nurse_id, order=order, note=note, process=process)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in type(self).model_fields}
+
+
+def bench_models(count, repeat, rng):
+    """Time building, dumping and validating count patients with
+    LegacyPatient and objects.Patient, whose documents are also decoded in
+    one batch
+
+    Returns:
+        dict: Benchmark name -> statistics, with the microseconds per model"""
+    from objects import Patient, decode
+
+    rows = [(
+        "First{}".format(i), "Last{}".format(i), rng.randint(18, 95), "1950-01-01", "{} Main St".format(i),
+        rng.randint(40, 120), "O+", "555-{:04d}".format(i), "p{}@example.com".format(i), "F",
+        str(100 + i % 300), str(ObjectId()), rng.randint(1, 10), " ".join(rng.sample(WORDS, 6)), False,
+    ) for i in range(count)]
+    legacy = [LegacyPatient(*row) for row in rows]
+    current = [Patient(*row) for row in rows]
+    documents = [dict(patient.to_dict(), _id=ObjectId(), version=0) for patient in current]
+
+    benchmarks = {
+        "models.legacy.construct": lambda: [LegacyPatient(*row) for row in rows],
+        "models.patient.construct": lambda: [Patient(*row) for row in rows],
+        "models.legacy.to_dict": lambda: [patient.to_dict() for patient in legacy],
+        "models.patient.to_dict": lambda: [patient.to_dict() for patient in current],
+        # Its __init__ rejects _id and version, so only the fields are passed
+        "models.legacy.validate": lambda: [
+            LegacyPatient(**{field: document[field] for field in LegacyPatient.model_fields})
+            for document in documents
+        ],
+        "models.patient.validate": lambda: [Patient.model_validate(document) for document in documents],
+        "models.patient.decode": lambda: decode(Patient, documents),
+        "models.patient.decode_projected": lambda: decode(Patient, documents, ("first_name", "order", "note")),
+    }
+    results = {}
+    for name, function in benchmarks.items():
+        stats = measure(function, repeat)
+        stats["per_model_us"] = round(stats["median_ms"] * 1000 / count, 3)
+        results[name] = stats
+    return results
+
+
+def import_times(module):
+    """Import a module in a fresh interpreter under -X importtime
+
+    Returns:
+        tuple: (milliseconds to import the module, [(direct import, ms)])"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total = None
+    children = []
+    pending = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match is None:
+            continue
+        cumulative_ms = int(match.group(2)) / 1000
+        depth = len(match.group(3)) // 2
+        # Children are listed before their parent
+        if depth == 1:
+            pending.append((match.group(4), cumulative_ms))
+        elif depth == 0:
+            if match.group(4) == module:
+                total = cumulative_ms
+                children = pending
+            pending = []
+    return total, sorted(children, key=lambda child: -child[1])
+
+
+def bench_startup(modules, repeat):
+    """Time the import of each entry module in fresh interpreters
+
+    Returns:
+        tuple: (benchmark name -> statistics, module -> its 10 heaviest direct imports)"""
+    results = {}
+    heaviest = {}
+    for module in modules:
+        runs = [import_times(module) for _ in range(repeat)]
+        results["import." + module] = summarize([total / 1000 for total, _ in runs])
+        heaviest[module] = [(name, round(ms, 1)) for name, ms in runs[-1][1][:10]]
+    return results, heaviest
+
+
+def git_commit():
+    """The current commit and whether the tree has uncommitted changes"""
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=root, capture_output=True, text=True, check=True,
+        ).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def run(sizes, repeat, latency, seed_value=0, startup=False, models=0):
+    """Run the benchmarks at every size, and the startup and models
+    benchmarks if asked
+
+    Returns:
+        dict: The report written to JSON"""
+    commit, dirty = git_commit()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"sizes": sizes, "repeat": repeat, "llm_latency": latency, "seed": seed_value, "models": models},
+        "results": {},
+    }
+    if startup:
+        print("Benchmarking startup...")
+        results, report["startup"] = bench_startup(STARTUP_MODULES, repeat)
+        for name, stats in results.items():
+            report["results"][name] = {"startup": stats}
+            print("  {:<36} {:>10.2f} ms median".format(name, stats["median_ms"]))
+            for module, ms in report["startup"][name.split(".", 1)[1]][:3]:
+                print("    {:<34} {:>10.1f} ms".format(module, ms))
+    if models:
+        print("Benchmarking {} models...".format(models))
+        for name, stats in bench_models(models, repeat, random.Random(seed_value)).items():
+            report["results"][name] = {"models": stats}
+            print("  {:<36} {:>10.2f} ms median {:>8.2f} us/model".format(
+                name, stats["median_ms"], stats["per_model_us"]
+            ))
+    if not sizes:
+        return report
+
+    server = start_fake_api(latency)
+    base_url = "http://127.0.0.1:{}".format(server.server_port)
+    mongo = mongomock.MongoClient()
+    cwd = os.getcwd()
+    rng = random.Random(seed_value)
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        try:
+            use_fakes(mongo, base_url, workdir)
+            for size in sizes:
+                print("Benchmarking {} patients...".format(size))
+                for name, stats in bench_size(mongo, base_url, size, repeat, workdir, rng).items():
+                    report["results"].setdefault(name, {})[str(size)] = stats
+                    print("  {:<36} {:>10.2f} ms median".format(name, stats["median_ms"]))
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+    return report
+
+
+def compare(baseline, report, threshold):
+    """Print the median of each benchmark against a baseline report
+
+    Returns:
+        list: (name, size, ratio) of the benchmarks slower by more than threshold"""
+    regressions = []
+    print("{:<36} {:>6} {:>12} {:>12} {:>8}".format("benchmark", "size", "baseline ms", "current ms", "ratio"))
+    for name, sizes in report["results"].items():
+        for size, stats in sizes.items():
+            old = baseline.get("results", {}).get(name, {}).get(size)
+            if old is None:
+                continue
+            ratio = stats["median_ms"] / old["median_ms"] if old["median_ms"] else float("inf")
+            flag = ""
+            if ratio > 1 + threshold:
+                regressions.append((name, size, ratio))
+                flag = "  REGRESSION"
+            print("{:<36} {:>6} {:>12.2f} {:>12.2f} {:>7.2f}x{}".format(
+                name, size, old["median_ms"], stats["median_ms"], ratio, flag
+            ))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against local stand-ins")
+    parser.add_argument(
+        "--sizes", type=int, nargs="*", default=[100, 1000, 5000],
+        help="Patients in the database. Pass no value to skip the pipeline benchmarks.",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per benchmark and size")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds the fake APIs wait per request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup", action="store_true", help="Also time the imports of app, chat and ui")
+    parser.add_argument("--models", type=int, default=0, metavar="N", help="Also benchmark the models on N patients")
+    parser.add_argument("--output", help="The JSON report. Defaults to cache/bench/<commit>.json.")
+    parser.add_argument("--compare", metavar="BASELINE", help="A previous report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        # Read before running, in case --output overwrites it
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    report = run(args.sizes, args.repeat, args.llm_latency, args.seed, args.startup, args.models)
+    output = args.output or os.path.join(
+        CACHE_DIR, "bench", "{}.json".format((report["commit"] or "unknown")[:12] + ("-dirty" if report["dirty"] else ""))
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to {}".format(output))
+
+    if args.compare:
+        regressions = compare(baseline, report, args.threshold)
+        if regressions:
+            print("{} regression(s) over {:.0%}".format(len(regressions), args.threshold))
+            sys.exit(1)
@@ -0,0 +1,139 @@
+"""Import patients from a CSV or JSONL admission file.
+
+Usage:
+    python3 bulk_import.py admissions.csv --batch-size 500
+
+Rows are read one at a time, validated with objects.Patient a batch at a time
+and inserted in insert_many batches, so memory stays bounded by the batch size. Patients
+that already exist (same name, date of birth and email) are skipped by the
+unique identity index. QR codes of the new patients can then be generated
+with `python3 qr_codes.py generate-missing`.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from db import get_client
+from indexes import ensure_indexes
+from objects import Patient, validate_many
+from vector_index import get_vector_index, patient_key
+
+DUPLICATE_KEY = 11000
+OPTIONAL_FIELDS = ("assign_nurse_id", "order", "note", "process")
+
+
+def read_rows(path):
+    """Yield (line, row) for every row of a CSV or JSONL file"""
+    with open(path, newline="") as f:
+        if path.endswith((".jsonl", ".ndjson")):
+            for line, text in enumerate(f, 1):
+                if text.strip():
+                    yield line, json.loads(text)
+        else:
+            # Line 1 is the header
+            for line, row in enumerate(csv.DictReader(f), 2):
+                yield line, row
+
+
+def clean_row(row):
+    """The patient fields of a row, with CSV empty strings as missing values"""
+    fields = {key.strip(): value for key, value in row.items() if key and key.strip() in Patient.model_fields}
+    fields.pop("id", None)
+    for field in OPTIONAL_FIELDS:
+        # CSV leaves missing values as empty strings
+        if fields.get(field) == "":
+            fields[field] = None
+    if fields.get("note") is None:
+        fields["note"] = ""
+    if fields.get("process") is None:
+        fields["process"] = False
+    return fields
+
+
+def parse_patient(row):
+    """Validate a row as a Patient
+
+    Raises:
+        ValueError: If the row is not a valid patient"""
+    patients, errors = validate_many(Patient, [clean_row(row)])
+    if errors:
+        raise ValueError(errors[0])
+    return patients[0][1]
+
+
+class BulkImport:
+    MAX_ERRORS = 100
+
+    def __init__(self, client=None, batch_size=500):
+        """
+        Args:
+            client (MongoClient): The client to use. Defaults to the shared client.
+            batch_size (int): Patients per insert_many
+        """
+        self.client = client or get_client()
+        self.patients = self.client["nursecheck"]["patients"]
+        self.batch_size = batch_size
+        self.inserted = 0
+        self.duplicate = 0
+        self.invalid = 0
+        self.errors = []
+
+    def run(self, rows):
+        """Import (line, row) pairs, e.g. from read_rows()
+
+        Returns:
+            dict: The inserted, duplicate and invalid counts"""
+        ensure_indexes(self.client["nursecheck"])
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                break
+            self.insert_batch(batch)
+        return {"inserted": self.inserted, "duplicate": self.duplicate, "invalid": self.invalid}
+
+    def insert_batch(self, batch):
+        # The whole batch is validated in one call
+        patients, errors = validate_many(Patient, [clean_row(row) for _, row in batch])
+        for index, error in errors.items():
+            self.invalid += 1
+            if len(self.errors) < self.MAX_ERRORS:
+                self.errors.append((batch[index][0], error))
+        documents = [dict(patient.to_dict(), _id=ObjectId(), version=0) for _, patient in patients]
+        if not documents:
+            return
+
+        failed = set()
+        try:
+            self.patients.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                if error["code"] != DUPLICATE_KEY:
+                    raise
+                failed.add(error["index"])
+        self.duplicate += len(failed)
+        inserted = [document for index, document in enumerate(documents) if index not in failed]
+        self.inserted += len(inserted)
+
+        index = get_vector_index()
+        for document in inserted:
+            if document["note"]:
+                index.upsert(patient_key(document["_id"]), document["_id"], document["note"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import patients from a CSV or JSONL file")
+    parser.add_argument("path")
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("IMPORT_BATCH_SIZE", "500")))
+    args = parser.parse_args()
+
+    bulk_import = BulkImport(batch_size=args.batch_size)
+    counts = bulk_import.run(read_rows(args.path))
+    for line, error in bulk_import.errors[:20]:
+        print("Line {}: {}".format(line, error))
+    print("{inserted} inserted, {duplicate} duplicate, {invalid} invalid".format(**counts))
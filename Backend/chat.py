@@ -1,27 +1,188 @@
-import google.generativeai as genai
-from pymongo import MongoClient
-from hume import HumeVoiceClient, MicrophoneInterface
 import os
 from system import System
 from datetime import datetime
 import asyncio
+import re
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
-from dotenv import load_dotenv
+from env import load_env
 from record import Record 
-import openai
-from openai import OpenAI
-load_dotenv(override=True)
+from db import get_client
+from emotions import EmotionMatrix, encode_vector, top_emotions_dict
+import llm
+from llm import CACHE_DIR
+from metrics import span, traced
+from alerts import get_alert_dispatcher, urgent_priority
+from render_service import get_render_service
+from triage import get_scorer, needs_llm, resolve_priority, triage_fields
+load_env()
+
+EMOTION_PROMPT = "From these emotion, determine if there are any negative emotions. Only return True or False.\n {}"
+SUMMARY_PROMPT = "From the conversation, generate a summarized note on patient's health. Don't overlook anything. Return the summary in 1 line. \n {}"
+PRIORITY_PROMPT = "Process the priority of the patient from scale 1-10 based on the conversation and priority.  Return in format <priority number> \n Conversation: {} \n Emotion: {}"
+
+
+def stage_timeout(stage):
+    """Timeout in seconds of an LLM stage ("emotion", "summary" or "priority")"""
+    default = os.getenv("LLM_STAGE_TIMEOUT", "30")
+    return float(os.getenv("LLM_{}_TIMEOUT".format(stage.upper()), default))
+
+
+async def gather_or_cancel(coroutines):
+    """Run coroutines concurrently and return their results in order. If one
+    raises, the others are cancelled before the error is re-raised."""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class HumeChatClient:
+    """REST client for the Hume EVI chat history API.
+
+    Requests go through one keep-alive session with a timeout and retries on
+    transient errors. Listings are read page by page through generators, and
+    finished chats are cached in memory and on disk by chat ID, so a
+    transcript is only ever downloaded once."""
+
+    PAGE_KEYS = ("events_page", "page_number", "page_size", "total_pages")
+
+    def __init__(self, api_key=None, base_url=None, timeout=None, retries=3, page_size=100, cache_dir=None):
+        """
+        Args:
+            api_key (str): The Hume API key. Defaults to HUME_API_KEY.
+            base_url (str): The API root. Defaults to HUME_API_BASE or https://api.hume.ai.
+            timeout (float): Seconds per request. Defaults to HUME_TIMEOUT (10).
+            retries (int): Retries on connection errors, 429 and 5xx responses
+            page_size (int): Items per page (the API allows up to 100)
+            cache_dir (str): Where finished transcripts are kept
+        """
+        self.base_url = (base_url or os.getenv("HUME_API_BASE", "https://api.hume.ai")).rstrip("/")
+        self.timeout = timeout or float(os.getenv("HUME_TIMEOUT", "10"))
+        self.page_size = page_size
+        self.cache_dir = cache_dir or os.path.join(CACHE_DIR, "hume_chats")
+        self.transcripts = {}
+        self.session = requests.Session()
+        self.session.headers["X-Hume-Api-Key"] = api_key or os.getenv("HUME_API_KEY") or ""
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+        )
+        adapter = HTTPAdapter(max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, path, **params):
+        with span("hume.get"):
+            response = self.session.get(self.base_url + path, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def iter_pages(self, path, items_key, ascending=True):
+        """Yield every page of a paginated listing"""
+        page_number = 0
+        while True:
+            page = self.get(
+                path,
+                page_number=page_number,
+                page_size=self.page_size,
+                ascending_order="true" if ascending else "false",
+            )
+            yield page
+            total_pages = page.get("total_pages")
+            page_number += 1
+            if not page.get(items_key) or total_pages is None or page_number >= total_pages:
+                return
+
+    def iter_chats(self, ascending=True):
+        """Yield every chat of the account, oldest first by default"""
+        for page in self.iter_pages("/v0/evi/chats", "chats_page", ascending):
+            yield from page["chats_page"]
+
+    def latest_chat(self):
+        """Return the most recent chat, or None"""
+        page = self.get("/v0/evi/chats", page_number=0, page_size=1, ascending_order="false")
+        chats = page.get("chats_page") or []
+        return chats[0] if chats else None
+
+    def get_chat(self, chat_id):
+        """Return a chat with all of its events under the "events" key"""
+        chat = self.transcripts.get(chat_id) or self._load_transcript(chat_id)
+        if chat is not None:
+            return chat
+
+        events = []
+        for page in self.iter_pages("/v0/evi/chats/{}".format(chat_id), "events_page"):
+            if chat is None:
+                chat = {key: value for key, value in page.items() if key not in self.PAGE_KEYS}
+            events.extend(page.get("events_page") or [])
+        chat["events"] = events
+        if chat.get("end_timestamp") and chat.get("status") != "ACTIVE":
+            self._store_transcript(chat_id, chat)
+        return chat
+
+    def _transcript_path(self, chat_id):
+        return os.path.join(self.cache_dir, re.sub(r"[^A-Za-z0-9_-]", "_", chat_id) + ".json")
+
+    def _load_transcript(self, chat_id):
+        try:
+            with open(self._transcript_path(chat_id)) as f:
+                chat = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        self.transcripts[chat_id] = chat
+        return chat
+
+    def _store_transcript(self, chat_id, chat):
+        self.transcripts[chat_id] = chat
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._transcript_path(chat_id)
+        with open(path + ".tmp", "w") as f:
+            json.dump(chat, f)
+        os.replace(path + ".tmp", path)
+
+
+_hume_client = None
+_hume_lock = threading.Lock()
+
+
+def get_hume_client():
+    """Return the process-wide Hume client, so its session is reused"""
+    global _hume_client
+    if _hume_client is None:
+        with _hume_lock:
+            if _hume_client is None:
+                _hume_client = HumeChatClient()
+    return _hume_client
 
 
 class Chat:
-    def __init__(self, patient_id):
+    def __init__(self, patient_id, client=None, hume_client=None):
+        """
+        Args:
+            patient_id (str): The patient ID
+            client (MongoClient): The client to use. Defaults to the shared client.
+            hume_client (HumeChatClient): The Hume client. Defaults to the shared client.
+        """
         if not patient_id:
             raise ValueError("Patient ID is required")
         self.patient_id = patient_id
-        self.client = MongoClient(os.getenv("MONGODB_URI"))
+        self.client = client or get_client()
+        self.hume = hume_client or get_hume_client()
 
     async def record_streaming(self):
+        # The Hume SDK (and its audio stack) is only needed by the kiosk
+        from hume import HumeVoiceClient, MicrophoneInterface
+
         # Retrieve the Hume API key from the environment variables
         HUME_API_KEY = os.getenv("HUME_API_KEY")
         # Connect and authenticate with Hume
@@ -32,51 +193,21 @@ class Chat:
             await MicrophoneInterface.start(socket )
         
     def list_chats(self): 
-        # Retrieve the Hume API key from the environment variables
-        HUME_API_KEY = os.getenv("HUME_API_KEY")
-        # Connect and authenticate with Hume
-        headers = {
-        "X-Hume-Api-Key": HUME_API_KEY
-        }
-        response = requests.get("https://api.hume.ai/v0/evi/chats", headers=headers, params={"page_size": 45, "page_number": 1})
-
-        return [chat["id"] for chat in response.json()["chats_page"]]
+        """List the IDs of every chat, oldest first"""
+        return [chat["id"] for chat in self.hume.iter_chats()]
 
     def get_latest_chat_id(self):
-        return self.list_chats()[-1]
+        return self.hume.latest_chat()["id"]
 
     def list_chat_messages(self, chat_id): 
-        # Retrieve the Hume API key from the environment variables
-        HUME_API_KEY = os.getenv("HUME_API_KEY")
-        # Connect and authenticate with Hume
-        headers = {
-        "X-Hume-Api-Key": HUME_API_KEY
-        }
-        response = requests.get(f"https://api.hume.ai/v0/evi/chats/{chat_id}", headers=headers)
-        result = response.json()
+        result = self.hume.get_chat(chat_id)
         start_timestamp = result["start_timestamp"]
         end_timestamp = result["end_timestamp"]
-        events_page = result["events_page"]
-        if events_page:
-            emotion_features_dict = json.loads(events_page[0]["emotion_features"])
-        else:
-            emotion_features_dict = {}
+        events_page = result["events"]
+        conversation = [{"role": event["role"], "message": event["message_text"]} for event in events_page]
+        emotions = EmotionMatrix.from_events(events_page)
 
-        conversation = []
-    
-        for event in events_page:
-            message = event["message_text"]
-            role = event["role"]
-            conversation.append({"role": role, "message": message})
-            if event["emotion_features"]:
-                event_dict = json.loads(event["emotion_features"])
-                for key, value in event_dict.items():
-                    if key in emotion_features_dict:
-                        emotion_features_dict[key] += float(value)
-                    else:
-                        emotion_features_dict[key] = float(value)
-
-        return {"start_timestamp": start_timestamp, "end_timestamp": end_timestamp, "conversation": conversation, "emotion_features": emotion_features_dict}
+        return {"start_timestamp": start_timestamp, "end_timestamp": end_timestamp, "conversation": conversation, "emotions": emotions}
 
     def chat(self):
         try:
@@ -85,122 +216,172 @@ class Chat:
         except KeyboardInterrupt:
             print("Conversation recorded. Processing conversation...")
             self.process_conversation()
+            # The kiosk exits next, before a delayed render or alert would go out
+            get_render_service().flush()
+            get_alert_dispatcher().drain()
             print("Conversation processed. Exiting...")
             return
         
-    def process_conversation(self):
-        conversation = ""
-        emotion_dict = {}
-        chat_id = self.get_latest_chat_id()
-        chat_messages = self.list_chat_messages(chat_id)
-        for message in chat_messages["conversation"]:
-            if message["role"] == "USER":
-                conversation += "Patient: " + message["message"] + "\n" 
-            else: 
-                conversation += "Nurse: " + message["message"] + "\n"
-
-        if conversation == "":
+    @traced("chat.process_conversation")
+    def process_conversation(self, chat_id=None):
+        """Process a Hume chat of the patient, by default the latest one"""
+        with span("chat.fetch_chat"):
+            chat_messages = self.list_chat_messages(chat_id or self.get_latest_chat_id())
+        prepared = self.prepare_conversation(chat_messages)
+        if prepared is None:
             print("No conversation recorded. Exiting...")
             return
-        emotion_features = chat_messages["emotion_features"]
-        self.client = MongoClient(os.getenv("MONGODB_URI"))
-        system = System()
-        patient_info = system.get_patient(self.patient_id)
-        top_5_emotions = sorted(emotion_features, key=emotion_features.get, reverse=True)[:5]
-        for emotion in top_5_emotions:
-            emotion_dict[emotion] = round(emotion_features[emotion], 2)
-        # emotion_dict = json.dumps(emotion_dict)
-
-        print("Conversation: ", conversation)
-        print("Top 5 emotions: ", emotion_dict)
-
-      
-        API_BASE = "https://api.01.ai/v1"
-        API_KEY = "your key"
-        client = OpenAI(
-            api_key=API_KEY,
-            base_url=API_BASE
+        conversation, emotion_dict, emotions = prepared
+        system = System(client=self.client)
+        patient_info = system.get_patient(
+            self.patient_id, {"first_name": 1, "last_name": 1, "assign_nurse_id": 1}
         )
-        
-        completion = client.chat.completions.create(
-            model="yi-large",
-            messages=[{"role": "user", "content": "From these emotion, determine if there are any negative emotions. Only return True or False.\n {}".format(
-                emotion_dict
-            )}]
-        )
-        emotion_result = completion.choices[0].message.content.strip()
-        print("Should visit or not based on emotion: ", emotion_result)
 
-
-        # genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
-        # model = genai.GenerativeModel("gemini-1.0-pro-latest")
-        # response = model.generate_content(
-        #     "From these emotion, determine if there are any negative emotion. Only return True or False.\n {}".format(
-        #         emotion_dict
-        #     )
-        # )
-
-        # emotion_result = response.text
-
-
-        print("Should visit or not based on emotion: ", emotion_result)
-
-        completion_summary = client.chat.completions.create(
-            model="yi-large",
-            messages=[{"role": "user", "content": "From the conversation, generate a summarized note on patient's health. Don't overlook anything. Return the summary in 1 line. \n {}".format(
-                conversation
-            )}]
+        triage = self.pre_triage(conversation, emotions)
+
+        client = llm.get_llm_client()
+        with span("llm.emotion"):
+            emotion_result = self.complete(client, EMOTION_PROMPT.format(emotion_dict))
+        with span("llm.summary"):
+            summary_result = self.complete(client, SUMMARY_PROMPT.format(conversation))
+        priority_result = None
+        if needs_llm(triage):
+            with span("llm.priority"):
+                priority_result = self.complete(client, PRIORITY_PROMPT.format(conversation, emotion_dict))
+
+        self.finish_conversation(
+            system, patient_info, conversation, emotion_dict, emotions,
+            emotion_result, summary_result, priority_result, triage,
         )
-        summary_result = completion_summary.choices[0].message.content.strip()
-        print("Should visit or not based on emotion: ", summary_result)
-
+        return conversation
 
+    @traced("chat.process_conversation")
+    async def process_conversation_async(self, chat_id=None):
+        """Process the latest conversation without blocking the event loop.
+
+        The emotion check, summary and (when the local triage is not
+        confident) priority LLM calls are independent, so they run concurrently, each bounded by its stage timeout
+        (LLM_<STAGE>_TIMEOUT, falling back to LLM_STAGE_TIMEOUT). When one
+        stage fails or times out the others are cancelled. Blocking
+        work (Hume fetch, Mongo, record, PDF and email) runs in threads.
+
+        Raises:
+            asyncio.TimeoutError: If an LLM stage exceeds its timeout"""
+        with span("chat.fetch_chat"):
+            if chat_id is None:
+                chat_id = await asyncio.to_thread(self.get_latest_chat_id)
+            chat_messages = await asyncio.to_thread(self.list_chat_messages, chat_id)
+        prepared = self.prepare_conversation(chat_messages)
+        if prepared is None:
+            print("No conversation recorded. Exiting...")
+            return
+        conversation, emotion_dict, emotions = prepared
+        system = System(client=self.client)
+        patient_info = await asyncio.to_thread(
+            system.get_patient,
+            self.patient_id,
+            {"first_name": 1, "last_name": 1, "assign_nurse_id": 1},
+        )
 
-        # genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
-        # model = genai.GenerativeModel("gemini-1.0-pro-latest")
-        today = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        # response = model.generate_content(
-        #     "From the conversation, generate a summarized note on patient's health. Don't overlook anything. Return the summary in 1 line. \n {}".format(
-        #         conversation
-        #     )
-        # )
-
-        # summary_result = response.text
-        # print("Summary of patient's health: ", summary_result)
-
-        priority_summary = client.chat.completions.create(
-            model="yi-large",
-            messages=[{"role": "user", "content": "Process the priority of the patient from scale 1-10 based on the conversation and priority.  Return in format <priority number> \n Conversation: {} \n Emotion: {}".format(conversation, emotion_dict)}]
+        triage = self.pre_triage(conversation, emotions)
+
+        client = llm.get_async_llm_client()
+        stages = [
+            self.complete_async(client, "emotion", EMOTION_PROMPT.format(emotion_dict)),
+            self.complete_async(client, "summary", SUMMARY_PROMPT.format(conversation)),
+        ]
+        if needs_llm(triage):
+            stages.append(
+                self.complete_async(client, "priority", PRIORITY_PROMPT.format(conversation, emotion_dict))
+            )
+        emotion_result, summary_result, *priority = await gather_or_cancel(stages)
+        priority_result = priority[0] if priority else None
+
+        await asyncio.to_thread(
+            self.finish_conversation,
+            system, patient_info, conversation, emotion_dict, emotions,
+            emotion_result, summary_result, priority_result, triage,
         )
+        return conversation
+
+    def prepare_conversation(self, chat_messages):
+        """Turn a Hume chat into the transcript and top 5 emotions sent to the LLM
 
-        priority_result = priority_summary.choices[0].message.content.strip()
+        Returns:
+            tuple: (conversation, emotion_dict, emotions), or None if nothing
+            was said. emotions is the EmotionMatrix of the chat."""
+        conversation = ""
+        for message in chat_messages["conversation"]:
+            if message["role"] == "USER":
+                conversation += "Patient: " + message["message"] + "\n" 
+            else: 
+                conversation += "Nurse: " + message["message"] + "\n"
+        if conversation == "":
+            return None
 
-        # response = model.generate_content("Process the priority of the patient from scale 1-10 based on the conversation and priority.  Return in format <priority number> \n Conversation: {} \n Emotion: {}".format(conversation, emotion_dict))
-        # priority_result = response.text
-        priority_result = int(priority_result)
+        emotions = chat_messages["emotions"]
+        emotion_dict = top_emotions_dict(emotions.sums(), 5)
 
+        print("Conversation: ", conversation)
+        print("Top 5 emotions: ", emotion_dict)
+        return conversation, emotion_dict, emotions
+
+    def pre_triage(self, conversation, emotions):
+        """Score the priority locally, so the LLM is only asked when unsure"""
+        with span("triage.score"):
+            triage = get_scorer().score_chat(conversation, emotions)
+        print("Local priority: {} (confidence {})".format(triage.priority, triage.confidence))
+        return triage
+
+    def complete(self, client, prompt):
+        """Send a single-message prompt to the LLM through the response cache"""
+        return llm.complete(client, prompt)
+
+    async def complete_async(self, client, stage, prompt):
+        """Send a single-message prompt to the LLM through the response cache,
+        bounded by the stage timeout"""
+        with span("llm." + stage):
+            return await llm.complete_async(client, prompt, timeout=stage_timeout(stage))
+
+    @traced("chat.finish_conversation")
+    def finish_conversation(self, system, patient_info, conversation, emotion_dict, emotions,
+                            emotion_result, summary_result, priority_result, triage=None):
+        """Store the LLM results: conversation document, patient order,
+        record and PDF, and alert the nurse on negative emotions. The
+        priority is the local triage's when the LLM was not asked for it."""
+        print("Should visit or not based on emotion: ", emotion_result)
+        print("Summary of patient's health: ", summary_result)
+        priority_result, priority_source = resolve_priority(priority_result, triage)
         print("Priority of the patient: ", str(priority_result))
+        today = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        self.save_to_db(patient_info, conversation, top_5_emotions)
+        self.save_to_db(patient_info, conversation, emotions)
 
         notes_str = summary_result
-        assert system.update_patient_order(self.patient_id, str(priority_result), notes_str) == "Patient order updated"
+        assert system.update_patient_order(self.patient_id, priority_result, notes_str) == "Patient order updated"
 
-        system = System()
-        system.update_patient_order(self.patient_id, str(priority_result), notes_str)
-        
-        record = Record(conversation)
-        record.update_record(self.patient_id, {"content": conversation, "note": notes_str, "timestamp": today, "emotions": emotion_dict, "priority": priority_result})
+        record = Record(conversation, client=self.client)
+        record.update_record(self.patient_id, {"content": conversation, "note": notes_str, "timestamp": today, "emotion_vector": encode_vector(emotions.sums()), "emotion_events": len(emotions), "priority": priority_result, **triage_fields(priority_source, triage)})
         
         nurse_id = patient_info["assign_nurse_id"]
 
         if emotion_result == "True":
-            system.send_email(nurse_id, self.patient_id)
-            print("Email sent to nurse")
-        
-        return conversation
-
+            # Sent in the background, coalesced with the nurse's other alerts
+            # unless the patient is urgent
+            get_alert_dispatcher().alert(
+                nurse_id, self.patient_id, patient_info["first_name"] + " " + patient_info["last_name"],
+                urgent=priority_result >= urgent_priority(),
+            )
+            print("Alert queued for nurse")
+
+    @traced("chat.save_to_db")
     def save_to_db(self, patient_info, conversation, emotions):
+        """Save the conversation with its summed emotion vector
+
+        Args:
+            patient_info (dict): The patient
+            conversation (str): The transcript
+            emotions (EmotionMatrix): The emotion scores of the chat"""
         patient_id = patient_info["_id"]
         patient_name = patient_info["first_name"] + " " + patient_info["last_name"]
         content = conversation
@@ -213,7 +394,8 @@ class Chat:
                 "patient_id": patient_id,
                 "patient_name": patient_name,
                 "content": content,
-                "emotions": emotions,
+                "emotion_vector": encode_vector(emotions.sums()),
+                "emotion_events": len(emotions),
                 "processed": processed,
             }
         )
@@ -224,7 +406,8 @@ class Chat:
 if __name__ == "__main__":
     PATIENT_ID = "662eda3d515f741c72939ecf"
     system = System()
-    patient_info = system.get_patient(PATIENT_ID)
+    system.ensure_indexes()
+    patient_info = system.get_patient(PATIENT_ID, {"_id": 1})
     if patient_info:
         chat = Chat(PATIENT_ID)
         chat.chat()
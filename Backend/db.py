@@ -0,0 +1,65 @@
+import os
+import threading
+from pymongo import MongoClient
+from env import load_env
+from metrics import event_listeners
+
+load_env()
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def client_options():
+    """Connection pool and timeout settings for MongoClient, read from the environment"""
+    return {
+        "maxPoolSize": int(os.getenv("MONGODB_MAX_POOL_SIZE", "50")),
+        "minPoolSize": int(os.getenv("MONGODB_MIN_POOL_SIZE", "0")),
+        "maxIdleTimeMS": int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", "300000")),
+        "connectTimeoutMS": int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "5000")),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+        "socketTimeoutMS": int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "30000")),
+    }
+
+
+def get_client(uri=None):
+    """Return the shared MongoClient for a URI, creating it on first use.
+
+    MongoClient is thread-safe and pools its own connections, so one client
+    per process is shared by System, Record, Chat, PDF and ui.py (it
+    survives Streamlit reruns because the module stays imported).
+
+    Args:
+        uri (str): The MongoDB URI. Defaults to MONGODB_URI.
+
+    Returns:
+        MongoClient: The shared client"""
+    uri = uri or os.getenv("MONGODB_URI")
+    client = _clients.get(uri)
+    if client is None:
+        with _lock:
+            client = _clients.get(uri)
+            if client is None:
+                client = MongoClient(uri, event_listeners=event_listeners(), **client_options())
+                _clients[uri] = client
+    return client
+
+
+def close_clients():
+    """Close every shared client, e.g. on application shutdown"""
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def _reset_after_fork():
+    # A MongoClient must not be used across fork() (uvicorn workers,
+    # process pools), so a child process starts with an empty registry.
+    global _lock
+    _lock = threading.Lock()
+    _clients.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,144 @@
+import json
+from functools import lru_cache
+
+import numpy as np
+from bson import Binary
+
+# The 48 expressions Hume EVI scores on every user message, in the fixed
+# column order used by every emotion matrix and stored vector
+EMOTIONS = (
+    "Admiration", "Adoration", "Aesthetic Appreciation", "Amusement", "Anger",
+    "Anxiety", "Awe", "Awkwardness", "Boredom", "Calmness", "Concentration",
+    "Confusion", "Contemplation", "Contempt", "Contentment", "Craving", "Desire",
+    "Determination", "Disappointment", "Disgust", "Distress", "Doubt", "Ecstasy",
+    "Embarrassment", "Empathic Pain", "Entrancement", "Envy", "Excitement", "Fear",
+    "Guilt", "Horror", "Interest", "Joy", "Love", "Nostalgia", "Pain", "Pride",
+    "Realization", "Relief", "Romance", "Sadness", "Satisfaction", "Shame",
+    "Surprise (negative)", "Surprise (positive)", "Sympathy", "Tiredness", "Triumph",
+)
+EMOTION_INDEX = {name: column for column, name in enumerate(EMOTIONS)}
+
+
+@lru_cache(maxsize=64)
+def _columns(names):
+    """Map a tuple of feature names to (columns, known) arrays. Hume sends the
+    same key order on every event, so this is computed once per chat."""
+    columns = np.array([EMOTION_INDEX.get(name, -1) for name in names], dtype=np.int64)
+    return columns, columns >= 0
+
+
+class EmotionMatrix:
+    """Emotion scores of a chat as a float32 matrix of events x EMOTIONS"""
+
+    def __init__(self, matrix, timestamps=None):
+        self.matrix = matrix
+        self.timestamps = timestamps if timestamps is not None else np.arange(len(matrix))
+
+    @classmethod
+    def from_events(cls, events):
+        """Parse the emotion_features of Hume chat events. Events without
+        emotion features (e.g. assistant messages) are skipped.
+
+        Args:
+            events (list): Hume chat events
+
+        Returns:
+            EmotionMatrix: One row per scored event"""
+        rows = []
+        timestamps = []
+        for event in events:
+            features = event.get("emotion_features")
+            if not features:
+                continue
+            if isinstance(features, str):
+                features = json.loads(features)
+            columns, known = _columns(tuple(features))
+            values = np.fromiter(features.values(), dtype=np.float32, count=len(columns))
+            row = np.zeros(len(EMOTIONS), dtype=np.float32)
+            row[columns[known]] = values[known]
+            rows.append(row)
+            timestamps.append(event.get("timestamp", len(timestamps)))
+        if not rows:
+            return cls(np.zeros((0, len(EMOTIONS)), dtype=np.float32), np.zeros(0))
+        return cls(np.vstack(rows), np.asarray(timestamps))
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def sums(self):
+        return self.matrix.sum(axis=0, dtype=np.float64).astype(np.float32)
+
+    def means(self):
+        if not len(self.matrix):
+            return np.zeros(len(EMOTIONS), dtype=np.float32)
+        return self.matrix.mean(axis=0, dtype=np.float64).astype(np.float32)
+
+    def top_k(self, k=5, reduce="sum"):
+        """Return the k strongest emotions over the chat
+
+        Args:
+            k (int): The number of emotions
+            reduce (str): "sum" or "mean" over the events
+
+        Returns:
+            list: (emotion, score) tuples, strongest first"""
+        return top_k(self.sums() if reduce == "sum" else self.means(), k)
+
+    def series(self, emotion):
+        """Return the per-utterance scores of one emotion
+
+        Returns:
+            tuple: (timestamps, scores) arrays"""
+        return self.timestamps, self.matrix[:, EMOTION_INDEX[emotion]]
+
+
+def top_k(vector, k=5):
+    """Return the k largest (emotion, score) pairs of an emotion vector.
+    Emotions that did not score above 0 are left out."""
+    vector = np.asarray(vector, dtype=np.float32)
+    scored = np.flatnonzero(vector > 0)
+    k = min(k, len(scored))
+    if k <= 0:
+        return []
+    top = np.sort(scored[np.argpartition(-vector[scored], k - 1)[:k]])
+    top = top[np.argsort(-vector[top], kind="stable")]
+    return [(EMOTIONS[column], float(vector[column])) for column in top]
+
+
+def top_emotions_dict(vector, k=5, decimals=2):
+    """The top k emotions of a vector as a rounded {emotion: score} dict"""
+    return {emotion: round(score, decimals) for emotion, score in top_k(vector, k)}
+
+
+def encode_vector(vector):
+    """Pack an emotion vector into compact BSON binary (float32, EMOTIONS order)"""
+    return Binary(np.asarray(vector, dtype="<f4").tobytes())
+
+
+def decode_vector(value):
+    """Unpack a stored emotion vector. Also accepts the {emotion: score}
+    dicts stored by older versions."""
+    if value is None:
+        return np.zeros(len(EMOTIONS), dtype=np.float32)
+    if isinstance(value, dict):
+        vector = np.zeros(len(EMOTIONS), dtype=np.float32)
+        for emotion, score in value.items():
+            if emotion in EMOTION_INDEX:
+                vector[EMOTION_INDEX[emotion]] = float(score)
+        return vector
+    return np.frombuffer(bytes(value), dtype="<f4")
+
+
+def note_vector(note):
+    """The emotion vector of a record note, old or new format"""
+    if "emotion_vector" in note:
+        return decode_vector(note["emotion_vector"])
+    return decode_vector(note.get("emotions"))
+
+
+def stack_notes(notes):
+    """Stack the emotion vectors of record notes into a notes x EMOTIONS
+    matrix, e.g. for trend analysis"""
+    if not notes:
+        return np.zeros((0, len(EMOTIONS)), dtype=np.float32)
+    return np.vstack([note_vector(note) for note in notes])
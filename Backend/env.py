@@ -0,0 +1,20 @@
+import threading
+
+from dotenv import load_dotenv
+
+_loaded = False
+_lock = threading.Lock()
+
+
+def load_env():
+    """Load the .env file into the environment, once per process.
+
+    Values in .env take precedence over the environment, as they always
+    have; later calls are no-ops, so a setting changed at runtime (e.g. by a
+    test or bench.py) is not overwritten by the next module imported."""
+    global _loaded
+    if not _loaded:
+        with _lock:
+            if not _loaded:
+                load_dotenv(override=True)
+                _loaded = True
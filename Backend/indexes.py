@@ -0,0 +1,133 @@
+import threading
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import OperationFailure
+
+from triage_queue import order_value
+
+# collection -> list of (keys, options) passed to create_index
+INDEXES = {
+    "documents": [
+        ([("patient_id", ASCENDING), ("timestamp", DESCENDING)], {"name": "patient_timestamp"}),
+        ([("processed", ASCENDING), ("_id", ASCENDING)], {"name": "processed_id"}),
+    ],
+    "records": [
+        ([("patient_id", ASCENDING)], {"name": "patient"}),
+    ],
+    "record_notes": [
+        (
+            [("patient_id", ASCENDING), ("last_timestamp", DESCENDING), ("_id", DESCENDING)],
+            {"name": "patient_latest"},
+        ),
+        ([("patient_id", ASCENDING), ("month", ASCENDING), ("count", ASCENDING)], {"name": "open_bucket"}),
+    ],
+    "patients": [
+        ([("assign_nurse_id", ASCENDING), ("order", DESCENDING)], {"name": "nurse_order"}),
+        (
+            [("assign_nurse_id", ASCENDING), ("process", ASCENDING), ("order", DESCENDING), ("_id", ASCENDING)],
+            {"name": "nurse_process_page"},
+        ),
+        (
+            [("first_name", ASCENDING), ("last_name", ASCENDING), ("dob", ASCENDING), ("email", ASCENDING)],
+            {"name": "patient_identity_unique", "unique": True},
+        ),
+    ],
+    "nurses": [
+        (
+            [("first_name", ASCENDING), ("last_name", ASCENDING), ("age", ASCENDING), ("phone", ASCENDING)],
+            {"name": "nurse_identity_unique", "unique": True},
+        ),
+    ],
+}
+
+# Indexes replaced by the ones above (old name -> new name). ensure_indexes
+# only drops an old index once its replacement exists.
+OBSOLETE_INDEXES = {
+    "patients": {"patient_identity": "patient_identity_unique"},
+    "nurses": {"nurse_identity": "nurse_identity_unique"},
+}
+
+# MongoDB error code when an index with the same keys but other options exists
+INDEX_OPTIONS_CONFLICT = 85
+
+_ensured = set()
+_lock = threading.Lock()
+
+
+def ensure_indexes(db, force=False):
+    """Create the indexes the query methods rely on, and convert the legacy
+    string orders (see migrate_orders). create_index is a no-op for indexes
+    that already exist, and each database is only checked once per process
+    unless force is set.
+
+    Args:
+        db: The MongoDB database (e.g. client["nursecheck"])
+        force (bool): Check again even if this process already did
+
+    Returns:
+        list: The names of the indexes that were checked"""
+    with _lock:
+        if db.name in _ensured and not force:
+            return []
+        names = []
+        for collection_name, indexes in INDEXES.items():
+            collection = db[collection_name]
+            existing = collection.index_information()
+            replaced = {
+                new: (old, existing[old]["key"])
+                for old, new in OBSOLETE_INDEXES.get(collection_name, {}).items() if old in existing
+            }
+            for keys, options in indexes:
+                try:
+                    names.append(create_index(collection, keys, options, replaced.get(options["name"])))
+                except OperationFailure as e:
+                    # e.g. duplicates created before the identity index was unique
+                    print("Could not create index {}.{}: {}".format(collection_name, options["name"], e))
+            current = collection.index_information()
+            for new, (old, _) in replaced.items():
+                if new in current and old in current:
+                    collection.drop_index(old)
+        migrate_orders(db["patients"])
+        _ensured.add(db.name)
+        return names
+
+
+def migrate_orders(patients):
+    """Convert the orders older versions stored as strings to numbers. Strings
+    sort ahead of every number, so "10" would come before 99 and page cursors
+    would not be numeric.
+
+    Returns:
+        int: The number of patients converted"""
+    requests = [
+        UpdateOne({"_id": patient["_id"], "order": patient["order"]}, {"$set": {"order": order_value(patient["order"])}})
+        for patient in patients.find({"order": {"$type": "string"}}, {"order": 1})
+    ]
+    if requests:
+        patients.bulk_write(requests, ordered=False)
+    return len(requests)
+
+
+def create_index(collection, keys, options, replaces=None):
+    """Create an index. MongoDB refuses to build an index next to one with
+    the same keys but other options (e.g. not unique); then the old index
+    given by replaces is swapped for it, and restored if the new one cannot
+    be built, so the queries always keep an index.
+
+    Args:
+        replaces (tuple): (name, keys) of the index this one replaces
+
+    Returns:
+        str: The name of the index"""
+    try:
+        return collection.create_index(keys, **options)
+    except OperationFailure as e:
+        if replaces is None or e.code != INDEX_OPTIONS_CONFLICT:
+            raise
+    old, old_keys = replaces
+    collection.drop_index(old)
+    try:
+        return collection.create_index(keys, **options)
+    except OperationFailure:
+        collection.create_index(old_keys, name=old)
+        raise
@@ -0,0 +1,240 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from llm import CACHE_DIR
+from metrics import span
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+ACTIVE = (QUEUED, RUNNING)
+
+
+class JobQueue:
+    """Background jobs persisted in a SQLite file and run by a pool of
+    worker threads. No broker needed.
+
+    A job enqueued with an idempotency key that matches a queued or running
+    job returns that job instead of creating a second one. A worker claims a
+    job with a lease in its owner's name, renewed while the job runs; any
+    process sharing the file can reclaim a job whose lease expired, e.g.
+    after its owner was killed, up to max_attempts runs. Jobs of a live
+    owner are never claimed twice."""
+
+    def __init__(self, path=None, workers=None, max_attempts=None, poll_interval=1.0, lease=None):
+        """
+        Args:
+            path (str): The SQLite file. Defaults to JOBS_PATH.
+            workers (int): Worker threads. Defaults to JOB_WORKERS (2).
+            max_attempts (int): Runs before a job interrupted by restarts fails.
+                Defaults to JOB_MAX_ATTEMPTS (3).
+            poll_interval (float): Seconds between checks for jobs enqueued by
+                other processes
+            lease (float): Seconds a claimed job is reserved to this queue
+                without a renewal. Defaults to JOB_LEASE (60).
+        """
+        self.path = path or os.getenv("JOBS_PATH", os.path.join(CACHE_DIR, "jobs.sqlite3"))
+        self.workers = workers if workers is not None else int(os.getenv("JOB_WORKERS", "2"))
+        self.max_attempts = max_attempts or int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+        self.poll_interval = poll_interval
+        self.lease = lease if lease is not None else float(os.getenv("JOB_LEASE", "60"))
+        self.owner = "{}-{}".format(os.getpid(), uuid.uuid4().hex[:12])
+        self.running = set()
+        self.handlers = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition()
+        self.stopping = threading.Event()
+        self.threads = []
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT, idempotency_key TEXT, payload TEXT, state TEXT, "
+            "result TEXT, error TEXT, attempts INTEGER DEFAULT 0, "
+            "created_at REAL, started_at REAL, finished_at REAL)"
+        )
+        columns = {row["name"] for row in self.connection.execute("PRAGMA table_info(jobs)")}
+        # Added after the first job files were created; old running jobs
+        # get an expired lease
+        for column, definition in (("owner", "TEXT"), ("lease_until", "REAL DEFAULT 0")):
+            if column not in columns:
+                self.connection.execute("ALTER TABLE jobs ADD COLUMN {} {}".format(column, definition))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)")
+        # At most one queued or running job per key, also across processes
+        self.connection.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_key ON jobs (idempotency_key) "
+            "WHERE idempotency_key IS NOT NULL AND state IN ('queued', 'running')"
+        )
+
+    def register(self, kind, handler):
+        """Run handler(payload) for jobs of this kind. Its return value,
+        which must be JSON-serializable, becomes the job result."""
+        self.handlers[kind] = handler
+
+    def enqueue(self, kind, payload, idempotency_key=None):
+        """Queue a job
+
+        Returns:
+            tuple: (job, created). created is False if an active job with
+                the same idempotency key was returned instead."""
+        with self.lock:
+            while True:
+                job_id = uuid.uuid4().hex
+                try:
+                    self.connection.execute(
+                        "INSERT INTO jobs (id, kind, idempotency_key, payload, state, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (job_id, kind, idempotency_key, json.dumps(payload), QUEUED, time.time()),
+                    )
+                    created = True
+                    break
+                except sqlite3.IntegrityError:
+                    row = self.connection.execute(
+                        "SELECT id FROM jobs WHERE idempotency_key = ? AND state IN (?, ?)",
+                        (idempotency_key, *ACTIVE),
+                    ).fetchone()
+                    # Otherwise the active job finished in between; try again
+                    if row is not None:
+                        job_id = row["id"]
+                        created = False
+                        break
+        if created:
+            with self.wakeup:
+                self.wakeup.notify()
+        return self.get(job_id), created
+
+    def get(self, job_id):
+        """Return a job as a dict, or None"""
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def counts(self):
+        """The number of jobs in each state"""
+        with self.lock:
+            rows = self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
+
+    def start(self):
+        """Start the workers, and the thread renewing the leases of their jobs"""
+        self.stopping.clear()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name="job-worker-{}".format(number), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        if self.workers:
+            thread = threading.Thread(target=self._renew_leases, name="job-leases", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop the workers after their current job"""
+        self.stopping.set()
+        with self.wakeup:
+            self.wakeup.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def _claim(self):
+        """Lease the oldest queued job, or a running one whose lease expired"""
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(
+                    "UPDATE jobs SET state = ?, error = 'Interrupted too many times', finished_at = ? "
+                    "WHERE state = ? AND lease_until < ? AND attempts >= ?",
+                    (FAILED, now, RUNNING, now, self.max_attempts),
+                )
+                row = self.connection.execute(
+                    "SELECT id, kind, payload FROM jobs "
+                    "WHERE state = ? OR (state = ? AND lease_until < ?) ORDER BY created_at LIMIT 1",
+                    (QUEUED, RUNNING, now),
+                ).fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE jobs SET state = ?, attempts = attempts + 1, started_at = ?, owner = ?, "
+                        "lease_until = ? WHERE id = ?",
+                        (RUNNING, now, self.owner, now + self.lease, row["id"]),
+                    )
+                    self.running.add(row["id"])
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return row
+
+    def _finish(self, job_id, state, result=None, error=None):
+        with self.lock:
+            self.running.discard(job_id)
+            # A job whose lease was lost belongs to its new owner
+            finished = self.connection.execute(
+                "UPDATE jobs SET state = ?, result = ?, error = ?, finished_at = ? WHERE id = ? AND owner = ?",
+                (state, json.dumps(result) if result is not None else None, error, time.time(), job_id, self.owner),
+            ).rowcount
+        if not finished:
+            print("Job {} was reclaimed by another worker; its result is dropped".format(job_id))
+
+    def _renew_leases(self):
+        # Until the workers have finished their last job
+        while not (self.stopping.is_set() and not self.running):
+            with self.lock:
+                if self.running:
+                    self.connection.execute(
+                        "UPDATE jobs SET lease_until = ? WHERE state = ? AND owner = ? AND id IN ({})".format(
+                            ",".join("?" * len(self.running))
+                        ),
+                        (time.time() + self.lease, RUNNING, self.owner, *self.running),
+                    )
+            time.sleep(min(self.lease / 3, self.poll_interval))
+
+    def _work(self):
+        while not self.stopping.is_set():
+            row = self._claim()
+            if row is None:
+                with self.wakeup:
+                    self.wakeup.wait(self.poll_interval)
+                continue
+            self.run(row["id"], row["kind"], json.loads(row["payload"]))
+
+    def run(self, job_id, kind, payload):
+        handler = self.handlers.get(kind)
+        if handler is None:
+            self._finish(job_id, FAILED, error="No handler for job kind {}".format(kind))
+            return
+        try:
+            with span("job." + kind):
+                result = handler(payload)
+        except Exception as e:
+            print("Job {} ({}) failed: {}".format(job_id, kind, e))
+            self._finish(job_id, FAILED, error="{}: {}".format(type(e).__name__, e))
+        else:
+            self._finish(job_id, SUCCEEDED, result=result)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Return the process-wide job queue"""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue()
+    return _queue
@@ -0,0 +1,245 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from env import load_env
+from metrics import LLM_CACHE, span
+
+load_env()
+
+API_BASE = os.getenv("YI_API_BASE", "https://api.01.ai/v1")
+API_KEY = os.getenv("YI_API_KEY", "your key")
+LLM_MODEL = "yi-large"
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+
+def normalize_prompt(prompt):
+    """Collapse whitespace so prompts that only differ in spacing share a cache entry"""
+    return " ".join(prompt.split())
+
+
+def cache_key(model, prompt):
+    return hashlib.sha256("{}\0{}".format(model, normalize_prompt(prompt)).encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """Cache of chat-completion answers keyed on model and normalized prompt.
+
+    Lookups go to an in-memory LRU first and then to a SQLite file shared by
+    every process on the machine. Entries expire after ttl seconds and the
+    file keeps at most max_entries answers, least recently used first out."""
+
+    PRUNE_EVERY = 100
+
+    def __init__(self, path=None, ttl=None, max_entries=None, memory_entries=None):
+        """
+        Args:
+            path (str): The SQLite file. Defaults to LLM_CACHE_PATH.
+            ttl (float): Seconds an answer stays valid. Defaults to LLM_CACHE_TTL (7 days).
+            max_entries (int): Size cap of the file. Defaults to LLM_CACHE_MAX_ENTRIES.
+            memory_entries (int): Size of the in-memory LRU. Defaults to LLM_CACHE_MEMORY_ENTRIES.
+        """
+        self.path = path or os.getenv("LLM_CACHE_PATH", os.path.join(CACHE_DIR, "llm_cache.sqlite3"))
+        self.ttl = ttl if ttl is not None else float(os.getenv("LLM_CACHE_TTL", "604800"))
+        self.max_entries = max_entries or int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+        self.memory_entries = memory_entries or int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "1024"))
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.writes = 0
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL, accessed_at REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed_at)")
+
+    def get(self, model, prompt):
+        """Return the cached answer of a prompt, or None"""
+        key = cache_key(model, prompt)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return entry[0]
+            self.memory.pop(key, None)
+
+            row = self.connection.execute(
+                "SELECT response, created_at FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.connection.execute("UPDATE completions SET accessed_at = ? WHERE key = ?", (now, key))
+            self._remember(key, row[0], row[1])
+            self.hits += 1
+            self.disk_hits += 1
+            return row[0]
+
+    def set(self, model, prompt, response):
+        """Store the answer of a prompt"""
+        key = cache_key(model, prompt)
+        now = time.time()
+        with self.lock:
+            self._remember(key, response, now)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now),
+            )
+            self.writes += 1
+            if self.writes % self.PRUNE_EVERY == 0:
+                self._prune(now)
+
+    def _remember(self, key, response, created_at):
+        self.memory[key] = (response, created_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _prune(self, now):
+        self.connection.execute("DELETE FROM completions WHERE created_at < ?", (now - self.ttl,))
+        self.connection.execute(
+            "DELETE FROM completions WHERE key IN ("
+            "SELECT key FROM completions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def prune(self):
+        """Drop expired answers and enforce the size cap now"""
+        with self.lock:
+            self._prune(time.time())
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.connection.execute("DELETE FROM completions")
+
+    def stats(self):
+        """Hit/miss counters of this process"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory),
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """Return the process-wide LLM cache"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LLMCache()
+    return _cache
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_llm_client():
+    """Return the process-wide OpenAI-compatible client of API_BASE. The
+    openai SDK is only imported on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+
+                _client = OpenAI(api_key=API_KEY, base_url=API_BASE)
+    return _client
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_llm_client():
+    """Return the AsyncOpenAI client of API_BASE shared by the running event
+    loop. Its connection pool belongs to that loop, so each loop gets its own
+    client, which is closed by close_async_llm_client()."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        from openai import AsyncOpenAI
+
+        client = _async_clients[loop] = AsyncOpenAI(api_key=API_KEY, base_url=API_BASE)
+    return client
+
+
+async def close_async_llm_client():
+    """Close the AsyncOpenAI client of the running event loop, if any"""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+def complete(client, prompt, model=LLM_MODEL):
+    """Send a single-message prompt to the LLM and return the stripped
+    answer, served from the cache when the same prompt was seen before
+
+    Args:
+        client (OpenAI): An OpenAI-compatible client
+        prompt (str): The prompt
+        model (str): The model name
+
+    Returns:
+        str: The answer"""
+    cache = get_llm_cache()
+    response = cache.get(model, prompt)
+    LLM_CACHE.inc("miss" if response is None else "hit")
+    if response is None:
+        with span("llm.request"):
+            completion = client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}]
+            )
+        response = completion.choices[0].message.content.strip()
+        cache.set(model, prompt, response)
+    return response
+
+
+async def complete_async(client, prompt, model=LLM_MODEL, timeout=None):
+    """Async variant of complete() for an AsyncOpenAI client. The SQLite
+    cache is read and written in a thread so the event loop is not blocked.
+
+    Raises:
+        asyncio.TimeoutError: If the LLM takes longer than timeout seconds"""
+    cache = get_llm_cache()
+    response = await asyncio.to_thread(cache.get, model, prompt)
+    LLM_CACHE.inc("miss" if response is None else "hit")
+    if response is None:
+        with span("llm.request"):
+            completion = await asyncio.wait_for(
+                client.chat.completions.create(
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}]
+                ),
+                timeout=timeout,
+            )
+        response = completion.choices[0].message.content.strip()
+        await asyncio.to_thread(cache.set, model, prompt, response)
+    return response
@@ -0,0 +1,250 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from pymongo import monitoring
+
+from env import load_env
+
+# Before reading METRICS_ENABLED, whichever module imports this one first
+load_env()
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+ENABLED = os.getenv("METRICS_ENABLED", "1") not in ("0", "false", "False", "")
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """A metric family: one value per combination of label values"""
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            items = sorted(self.values.items())
+            lines.extend(self._lines(labels, value) for labels, value in items)
+        return "\n".join(lines)
+
+    def _lines(self, labels, value):
+        return "{}{} {}".format(self.name, format_labels(self.labelnames, labels), format_value(value))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    """Cumulative buckets, sum and count of observed values, e.g. seconds"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        # Buckets are counted individually and summed up on render
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _lines(self, labels, entry):
+        counts, total, count = entry
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            lines.append("{}_bucket{} {}".format(
+                self.name, format_labels(self.labelnames, labels, ("le", format_value(bound))), cumulative
+            ))
+        label_text = format_labels(self.labelnames, labels)
+        lines.append("{}_sum{} {}".format(self.name, label_text, format_value(total)))
+        lines.append("{}_count{} {}".format(self.name, label_text, count))
+        return "\n".join(lines)
+
+    def snapshot(self, *labels):
+        """The count and sum of a label combination, e.g. for tests"""
+        with self.lock:
+            entry = self.values.get(labels)
+            return (entry[2], entry[1]) if entry else (0, 0.0)
+
+
+class Registry:
+    """The metrics of the process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = Registry()
+
+SPAN_SECONDS = registry.histogram(
+    "nursecheck_span_seconds", "Duration of pipeline stages and outbound calls", ("span",)
+)
+SPAN_ERRORS = registry.counter("nursecheck_span_errors_total", "Spans that raised", ("span",))
+SPAN_IN_FLIGHT = registry.gauge("nursecheck_span_in_flight", "Spans currently running", ("span",))
+MONGO_SECONDS = registry.histogram(
+    "nursecheck_mongo_command_seconds", "Duration of MongoDB commands", ("command",)
+)
+MONGO_ERRORS = registry.counter("nursecheck_mongo_command_errors_total", "MongoDB commands that failed", ("command",))
+MONGO_IN_FLIGHT = registry.gauge("nursecheck_mongo_commands_in_flight", "MongoDB commands awaiting a reply")
+LLM_CACHE = registry.counter("nursecheck_llm_cache_total", "LLM prompts by cache result", ("result",))
+TRIAGE = registry.counter("nursecheck_triage_total", "Chat priorities by source", ("source",))
+
+
+class span:
+    """Time a block as a named span:
+
+        with span("chat.fetch_chat"):
+            ...
+
+    The duration goes to nursecheck_span_seconds, exceptions to
+    nursecheck_span_errors_total, and the span counts as in flight until it
+    ends. Costs a few microseconds, or nothing with METRICS_ENABLED=0."""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if ENABLED:
+            SPAN_IN_FLIGHT.inc(self.name)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if ENABLED:
+            SPAN_SECONDS.observe(time.perf_counter() - self.start, self.name)
+            SPAN_IN_FLIGHT.dec(self.name)
+            if exc_type is not None:
+                SPAN_ERRORS.inc(self.name)
+        return False
+
+
+def traced(name):
+    """Decorate a function, or a coroutine function, to run as a span"""
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe(name, seconds, error=False):
+    """Record a span timed elsewhere, e.g. a render in another process"""
+    if ENABLED:
+        SPAN_SECONDS.observe(seconds, name)
+        if error:
+            SPAN_ERRORS.inc(name)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command of the MongoClients it is passed to"""
+
+    def started(self, event):
+        MONGO_IN_FLIGHT.inc()
+
+    def succeeded(self, event):
+        MONGO_IN_FLIGHT.dec()
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        MONGO_IN_FLIGHT.dec()
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+        MONGO_ERRORS.inc(event.command_name)
+
+
+def event_listeners():
+    """The pymongo event listeners to pass to MongoClient"""
+    return [MongoCommandMetrics()] if ENABLED else []
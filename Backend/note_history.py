@@ -0,0 +1,220 @@
+"""Note history of patient records, kept in time-bucketed documents.
+
+Usage:
+    python3 note_history.py migrate
+
+Each document of the record_notes collection holds the notes of one patient
+for one month, up to NOTE_BUCKET_SIZE notes; a full month continues in a new
+bucket. Appending is a single $push upsert into the open bucket, so its cost
+does not depend on how long the history is, and concurrent writers cannot
+lose each other's notes. Reads project $slice from the newest buckets.
+
+Records written before buckets existed keep their notes in records.notes.
+Those are older than any bucketed note, so readers put them first until
+migrate() moves them into sealed buckets.
+"""
+import os
+import re
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+MONTH = re.compile(r"^\d{4}-\d{2}")
+
+
+def bucket_month(timestamp):
+    """The bucket month ("YYYY-MM") of a note timestamp"""
+    if isinstance(timestamp, datetime):
+        return timestamp.strftime("%Y-%m")
+    if isinstance(timestamp, str) and MONTH.match(timestamp):
+        return timestamp[:7]
+    return datetime.now().strftime("%Y-%m")
+
+
+def note_projection(fields):
+    """Projection of the given fields of every note of a document"""
+    if not fields:
+        return None
+    return {"notes.{}".format(field): 1 for field in fields}
+
+
+class NoteHistory:
+    def __init__(self, db, bucket_size=None):
+        """
+        Args:
+            db: The MongoDB database (e.g. client["nursecheck"])
+            bucket_size (int): Notes per bucket. Defaults to NOTE_BUCKET_SIZE (100).
+        """
+        self.buckets = db["record_notes"]
+        self.records = db["records"]
+        self.bucket_size = bucket_size or int(os.getenv("NOTE_BUCKET_SIZE", "100"))
+
+    def append(self, patient_id, note):
+        """Append a note to the history of a patient
+
+        Args:
+            patient_id (ObjectId): The patient ID
+            note (dict): The note. Its timestamp picks the bucket."""
+        timestamp = note.get("timestamp")
+        update = {
+            "$push": {"notes": note},
+            "$inc": {"count": 1},
+        }
+        if timestamp is not None:
+            update["$min"] = {"first_timestamp": timestamp}
+            update["$max"] = {"last_timestamp": timestamp}
+        # Matches the open bucket of the month; once it is full the upsert
+        # starts the next one
+        self.buckets.update_one(
+            {
+                "patient_id": patient_id,
+                "month": bucket_month(timestamp),
+                "count": {"$lt": self.bucket_size},
+                "sealed": {"$ne": True},
+            },
+            update,
+            upsert=True,
+        )
+
+    def latest(self, patient_id, n=1, fields=None):
+        """Return the last n notes of a patient, oldest first
+
+        Args:
+            patient_id (ObjectId): The patient ID
+            n (int): The number of notes
+            fields (list): Only return these note fields
+
+        Returns:
+            list: The notes"""
+        notes = []
+        last_notes = {"$slice": ["$notes", -n]}
+        if fields:
+            last_notes = {
+                "$map": {
+                    "input": last_notes,
+                    "as": "note",
+                    "in": {field: "$$note.{}".format(field) for field in fields},
+                }
+            }
+        cursor = self.buckets.aggregate([
+            {"$match": {"patient_id": patient_id}},
+            {"$sort": {"last_timestamp": -1, "_id": -1}},
+            {"$project": {"notes": last_notes}},
+        ])
+        for bucket in cursor:
+            notes[:0] = bucket.get("notes", [])[-(n - len(notes)):]
+            if len(notes) >= n:
+                return notes
+        legacy = self.records.find_one(
+            {"patient_id": patient_id, "notes": {"$exists": True}},
+            {"_id": 0, "notes": {"$slice": -(n - len(notes))}},
+        )
+        if legacy:
+            notes[:0] = legacy["notes"]
+        return notes
+
+    def last(self, patient_id, fields=None):
+        """Return the latest note of a patient, or None"""
+        notes = self.latest(patient_id, 1, fields)
+        return notes[-1] if notes else None
+
+    def iter_notes(self, patient_id, fields=None):
+        """Yield every note of a patient, oldest first, one bucket in memory at a time"""
+        legacy = self.records.find_one(
+            {"patient_id": patient_id, "notes": {"$exists": True}},
+            note_projection(fields) or {"notes": 1},
+        )
+        if legacy:
+            yield from legacy.get("notes", [])
+        projection = note_projection(fields) or {"notes": 1}
+        cursor = self.buckets.find({"patient_id": patient_id}, projection).sort(
+            [("last_timestamp", 1), ("_id", 1)]
+        )
+        for bucket in cursor:
+            yield from bucket.get("notes", [])
+
+    def count(self, patient_id):
+        """The number of bucketed notes of a patient"""
+        return sum(
+            bucket.get("count", 0)
+            for bucket in self.buckets.find({"patient_id": patient_id}, {"count": 1})
+        )
+
+    def delete(self, patient_id):
+        return self.buckets.delete_many({"patient_id": patient_id}).deleted_count
+
+    def migrate(self, batch_size=100):
+        """Move the notes of legacy records into sealed buckets. Safe to
+        interrupt and run again.
+
+        Returns:
+            int: The number of records migrated"""
+        migrated = 0
+        for record in self.records.find({"notes": {"$exists": True}}, {"patient_id": 1, "notes": 1}):
+            requests = []
+            for chunk, bucket in enumerate(self._legacy_buckets(record["notes"])):
+                month, notes = bucket
+                timestamps = [note["timestamp"] for note in notes if note.get("timestamp") is not None]
+                requests.append(UpdateOne(
+                    {"patient_id": record["patient_id"], "legacy_record": record["_id"], "legacy_chunk": chunk},
+                    {"$setOnInsert": {
+                        "month": month,
+                        "notes": notes,
+                        "count": len(notes),
+                        "first_timestamp": min(timestamps) if timestamps else None,
+                        "last_timestamp": max(timestamps) if timestamps else None,
+                        "sealed": True,
+                    }},
+                    upsert=True,
+                ))
+                if len(requests) >= batch_size:
+                    self.buckets.bulk_write(requests, ordered=False)
+                    requests = []
+            if requests:
+                self.buckets.bulk_write(requests, ordered=False)
+            self.records.update_one(
+                {"_id": record["_id"]},
+                {"$unset": {"notes": ""}, "$set": {"note_count": len(record["notes"])}},
+            )
+            migrated += 1
+        return migrated
+
+    def _legacy_buckets(self, notes):
+        """Split a legacy notes array into (month, notes) buckets"""
+        bucket = []
+        month = None
+        for note in notes:
+            note_month = bucket_month(note.get("timestamp"))
+            if bucket and (note_month != month or len(bucket) >= self.bucket_size):
+                yield month, bucket
+                bucket = []
+            month = note_month
+            bucket.append(note)
+        if bucket:
+            yield month, bucket
+
+
+def iter_all_notes(db, fields=None):
+    """Yield (patient_id, note) for every note of the database"""
+    projection = note_projection(fields) or {"notes": 1}
+    for record in db["records"].find({"notes": {"$exists": True}}, {"patient_id": 1, **projection}):
+        for note in record.get("notes", []):
+            yield record["patient_id"], note
+    for bucket in db["record_notes"].find({}, {"patient_id": 1, **projection}):
+        for note in bucket.get("notes", []):
+            yield bucket["patient_id"], note
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from db import get_client
+    from indexes import ensure_indexes
+
+    parser = argparse.ArgumentParser(description="Manage bucketed record notes")
+    parser.add_argument("command", choices=["migrate"])
+    args = parser.parse_args()
+
+    db = get_client()["nursecheck"]
+    ensure_indexes(db)
+    print("Migrated {} records".format(NoteHistory(db).migrate()))
@@ -1,78 +1,142 @@
-from dataclasses import dataclass
-from pydantic import BaseModel
+from functools import lru_cache
+from typing import Annotated, ClassVar, List, Optional, Tuple
+
+from bson import ObjectId
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field, TypeAdapter, ValidationError, create_model
+
+
+def object_id_str(value):
+    return str(value) if isinstance(value, ObjectId) else value
+
+
+# Mongo _id, exposed as a string
+DocumentId = Annotated[Optional[str], BeforeValidator(object_id_str)]
+
+
+class Model(BaseModel):
+    """Base of the stored models.
+
+    Models take their fields positionally, in the order of positional, or
+    by name. Documents read from Mongo are validated with model_validate()
+    (or the batch helpers below); unknown fields such as version are
+    ignored. to_dict() is the document to insert, without the _id."""
+
+    model_config = ConfigDict(populate_by_name=True, extra="ignore")
+
+    positional: ClassVar[Tuple[str, ...]] = ()
+
+    id: DocumentId = Field(default=None, alias="_id")
+
+    def __init__(self, *args, **fields):
+        if len(args) > len(self.positional):
+            raise TypeError("{} takes at most {} positional arguments".format(type(self).__name__, len(self.positional)))
+        fields.update(zip(self.positional, args))
+        super().__init__(**fields)
+
+    def to_dict(self):
+        # The fields are all scalars, so a copy of the validated values is
+        # the document, several times faster than model_dump()
+        document = dict(self.__dict__)
+        del document["id"]
+        return document
+
+
+class Patient(Model):
+    positional = (
+        "first_name", "last_name", "age", "dob", "address", "weight", "blood_type", "phone", "email",
+        "gender", "room_number", "assign_nurse_id", "order", "note", "process",
+    )
 
-@dataclass
-class Patient(BaseModel):  
     first_name: str
     last_name: str
     age: int
     dob: str
     address: str
     weight: int
-    blood_type : str
+    blood_type: str
     phone: str
     email: str
     gender: str
-    room_number: str 
-    assign_nurse_id: str = None
-    order: int = None
-    note: str = None
+    room_number: str
+    assign_nurse_id: Optional[str] = None
+    order: Optional[int] = None
+    note: Optional[str] = None
     process: bool = False
 
-    def __init__(self, first_name, last_name, age, dob, address, weight, blood_type, phone, email, gender, room_number, assign_nurse_id, order, note, process=False):
-        super().__init__(first_name=first_name, last_name=last_name, age=age, dob=dob, address=address, weight=weight, blood_type=blood_type, phone=phone, email=email, gender=gender, room_number=room_number, assign_nurse_id=assign_nurse_id, order=order, note=note, process=process)
 
+class Nurse(Model):
+    positional = ("first_name", "last_name", "age", "work_shift", "phone", "email")
 
-    def to_dict(self):
-        return {
-            "first_name": self.first_name,
-            "last_name": self.last_name,
-            "age": self.age,
-            "dob": self.dob,
-            "address": self.address,
-            "weight": self.weight,
-            "blood_type": self.blood_type,
-            "phone": self.phone,
-            "email": self.email,
-            "gender": self.gender,
-            "room_number": self.room_number,
-            "assign_nurse_id": self.assign_nurse_id,
-            "order": self.order,
-            "note": self.note,
-            "process": self.process
-        }
-
-    def __str__(self) -> str:
-        return super().__str__()
-    
-    def __repr__(self) -> str:
-        return super().__repr__()
-        
-@dataclass
-class Nurse(BaseModel): 
     first_name: str
     last_name: str
     age: int
     work_shift: str
     phone: str
-    email: str = None
+    email: Optional[str] = None
 
-    def __init__(self, first_name, last_name, age, work_shift, phone, email):
-        super().__init__(first_name=first_name, last_name=last_name, age=age, work_shift=work_shift, phone=phone, email=email)
 
-    def to_dict(self):
-        return {
-            "first_name": self.first_name,
-            "last_name": self.last_name,
-            "age": self.age,
-            "work_shift": self.work_shift,
-            "phone": self.phone,
-            "email": self.email
-        }
-    
-    def __str__(self) -> str:
-        return super().__str__()
-    
-    def __repr__(self) -> str:
-        return super().__repr__()
-    
+@lru_cache(maxsize=None)
+def adapter(model):
+    """The cached TypeAdapter validating and dumping lists of a model"""
+    return TypeAdapter(List[model])
+
+
+@lru_cache(maxsize=None)
+def partial_model(model, fields):
+    """A model with only some fields of another, all optional, for
+    documents read with a projection
+
+    Args:
+        model (type): e.g. Patient
+        fields (tuple): The projected field names"""
+    definitions = {
+        name: (Optional[info.annotation], None)
+        for name, info in model.model_fields.items()
+        if name in fields and name != "id"
+    }
+    return create_model(
+        "Partial{}".format(model.__name__),
+        __base__=Model,
+        **definitions,
+    )
+
+
+def decode(model, documents, fields=None):
+    """Validate Mongo documents, e.g. a cursor, as typed models in one call
+
+    Args:
+        model (type): Patient or Nurse
+        documents (iterable): The documents
+        fields (iterable): The projected fields, if the documents were read
+            with a projection. The result then has only these fields.
+
+    Returns:
+        list: The models
+
+    Raises:
+        ValidationError: If a document does not match the model"""
+    if fields is not None:
+        model = partial_model(model, tuple(sorted(fields)))
+    return adapter(model).validate_python(list(documents))
+
+
+def validate_many(model, rows):
+    """Validate many dicts at once, collecting the invalid ones
+
+    Returns:
+        tuple: (models, errors). models are the valid rows, in order, with
+            their row index; errors maps a row index to its error message."""
+    rows = list(rows)
+    errors = {}
+    try:
+        return list(enumerate(adapter(model).validate_python(rows))), errors
+    except ValidationError as e:
+        for error in e.errors():
+            index, *loc = error["loc"]
+            message = "{}: {}".format(".".join(map(str, loc)), error["msg"]) if loc else error["msg"]
+            errors[index] = "{}; {}".format(errors[index], message) if index in errors else message
+    # Second pass over the valid rows only
+    valid = [index for index in range(len(rows)) if index not in errors]
+    models = adapter(model).validate_python([rows[index] for index in valid])
+    return list(zip(valid, models)), errors
+
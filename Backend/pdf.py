@@ -1,77 +1,159 @@
-from fpdf import FPDF
+import hashlib
+import json
+import os
+from datetime import datetime
 from system import System
+from emotions import note_vector, top_emotions_dict
+from metrics import traced
+
+RECORDS_DIR = "records"
+
+
 class PDF:
-    def __init__(self):
-        pass
+    def __init__(self, client=None):
+        """
+        Args:
+            client (MongoClient): The client to use. Defaults to the shared client.
+        """
+        self.client = client
+
+    @traced("pdf.load_inputs")
+    def load_inputs(self, patient_id: str):
+        """Read everything the record PDF shows, as plain JSON-serializable data"""
+        system = System(client=self.client)
+        patient = system.get_patient(
+            patient_id,
+            {"first_name": 1, "last_name": 1, "dob": 1, "gender": 1, "weight": 1, "blood_type": 1},
+        )
+        # The full conversation text of each note is not rendered, so leave it on the server
+        notes = system.get_patient_notes(
+            patient["_id"], fields=["timestamp", "emotions", "emotion_vector", "note"]
+        )
+        rows = []
+        for note in reversed(notes):
+            emotions_dict = top_emotions_dict(note_vector(note), 5)
+            emotion_list = ["{} ({}%)".format(key, value*10) for key, value in emotions_dict.items()]    
+            emotion_str = ", ".join(emotion_list)
+            rows.append((note["timestamp"], emotion_str, note["note"]))
+        return {
+            "patient_id": str(patient["_id"]),
+            "first_name": patient["first_name"],
+            "last_name": patient["last_name"],
+            "dob": patient["dob"],
+            "gender": patient["gender"],
+            "weight": patient["weight"],
+            "blood_type": patient["blood_type"],
+            "rows": rows,
+        }
 
+    @traced("pdf.create_pdf")
     def create_pdf(self, patient_id: str):
-        system = System()
-        patient = system.get_patient(patient_id)
-        patient_id = patient["_id"]
-        patient_first_name = patient["first_name"]
-        patient_last_name = patient["last_name"]
-        patient_dob = patient["dob"]
-        patient_gender = patient["gender"]
-        patient_note = patient["note"]
-        patient_weight = patient["weight"]
-        patient_blood_type = patient["blood_type"]
-
-        patient_records = system.get_patient_record(patient_id)
-        patient_reocords_notes = patient_records["notes"]
-
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_font("helvetica", size=25)  # Increased font size for header title
-        pdf.cell(text="{}'s Pixie Check-in Record".format(patient_first_name + " " + patient_last_name), ln=1, align='C')
-
-        
-        pdf.set_font("helvetica", size=15)  # Reset font size
-
-        # Patient Information section
-        info_text = "Age: {}  Gender: {}  Weight: {} lbs  Blood Type: {}".format(patient_dob, patient_gender,
-                                                                                 patient_weight, patient_blood_type)
-        pdf.cell(text=info_text, ln=2, align='L')
-        
-        pdf.ln(10)  # Line break
-
-        # # Patient Notes section
-        pdf.set_font("helvetica", size=16)  # Reset font size
-        # if patient_note:
-        #     pdf.cell(text=patient_note, ln=2, align='L')
-        
+        inputs = self.load_inputs(patient_id)
+        render_pdf(inputs, pdf_path(inputs["patient_id"]))
+        write_render_state(inputs["patient_id"], rendered(inputs_hash(inputs)))
+        return "PDF created successfully"
+
+
+def pdf_path(patient_id):
+    return os.path.join(RECORDS_DIR, "patient_{}.pdf".format(patient_id))
+
+
+def state_path(patient_id):
+    return os.path.join(RECORDS_DIR, "patient_{}.json".format(patient_id))
+
+
+def inputs_hash(inputs):
+    """Hash of the rendered inputs; equal hashes render identical PDFs"""
+    payload = json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+def read_render_state(patient_id):
+    """Return the hash and time of the last render of a patient, or None"""
+    try:
+        with open(state_path(patient_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_render_state(patient_id, state):
+    path = state_path(patient_id)
+    os.makedirs(RECORDS_DIR, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+    return state
+
+
+def mark_render_state(patient_id, state, **fields):
+    """Set the state ("pending", "fresh" or "failed") of a patient's PDF,
+    keeping the hash and time of the last render"""
+    current = read_render_state(patient_id) or {}
+    current.update(fields, state=state)
+    return write_render_state(patient_id, current)
+
+
+def rendered(digest):
+    return {"hash": digest, "state": "fresh", "rendered_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+
+
+@traced("pdf.render")
+def render_pdf(inputs, path):
+    """Render the record PDF of load_inputs() output to path"""
+    # fpdf is only imported by the processes that render
+    from fpdf import FPDF
+
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("helvetica", size=25)  # Increased font size for header title
+    pdf.cell(text="{}'s Pixie Check-in Record".format(inputs["first_name"] + " " + inputs["last_name"]), ln=1, align='C')
+
+    pdf.set_font("helvetica", size=15)  # Reset font size
+
+    # Patient Information section
+    info_text = "Age: {}  Gender: {}  Weight: {} lbs  Blood Type: {}".format(inputs["dob"], inputs["gender"],
+                                                                             inputs["weight"], inputs["blood_type"])
+    pdf.cell(text=info_text, ln=2, align='L')
     
-        pdf.set_font("helvetica", style='B', size=15, )  # Set font style to bold and increase font size
-        pdf.cell(text="Notes History:", ln=2, align='L')
-        pdf.ln(5)  # Line break
-        pdf.set_font("helvetica", size=11)  # Reset font size
+    pdf.ln(10)  # Line break
 
-        # pdf.cell(200, 10, txt=patient_note, ln=5, align='L')
+    pdf.set_font("helvetica", style='B', size=15, )  # Set font style to bold and increase font size
+    pdf.cell(text="Notes History:", ln=2, align='L')
+    pdf.ln(5)  # Line break
+    pdf.set_font("helvetica", size=11)  # Reset font size
 
-        # Conversation History section (title removed)
+    TABLE_DATA = [
+        ("Date", "Top 5 emotions", "Note"),
+    ] + [tuple(row) for row in inputs["rows"]]
 
-        TABLE_DATA = [
-            ("Date", "Top 5 emotions", "Note"),
-        ]
-        for note in reversed(patient_reocords_notes):
-            emotions_dict = note["emotions"]
-            emotion_list = ["{} ({}%)".format(key, value*10) for key, value in emotions_dict.items()]    
-            emotion_str = ", ".join(emotion_list)
-            TABLE_DATA.append(
-                (note["timestamp"], emotion_str, note["note"]),
-            )
+    with pdf.table() as table:
+        for data_row in TABLE_DATA:
+            row = table.row()
+            for datum in data_row:
+                row.cell(datum, align='L', rowspan=1)
 
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Write next to the target and swap, so readers never see a partial file
+    pdf.output(path + ".tmp")
+    os.replace(path + ".tmp", path)
 
-        with pdf.table() as table:
-            for data_row in TABLE_DATA:
-                row = table.row()
-                for datum in data_row:
-                    # if datum == "Date": 
 
-                    row.cell(datum, align='L', rowspan=1)
+def render_patient_pdf(patient_id):
+    """Render a patient's record PDF unless its inputs are unchanged since
+    the last render. Runs in the render service worker processes.
 
-        pdf.output("records/patient_{}.pdf".format(patient_id)) 
+    Returns:
+        dict: The render state, with rendered False if the render was skipped"""
+    inputs = PDF().load_inputs(patient_id)
+    digest = inputs_hash(inputs)
+    patient_id = inputs["patient_id"]
+    state = read_render_state(patient_id)
+    if state and state.get("hash") == digest and os.path.exists(pdf_path(patient_id)):
+        return dict(write_render_state(patient_id, dict(state, state="fresh")), rendered=False)
+    render_pdf(inputs, pdf_path(patient_id))
+    return dict(write_render_state(patient_id, rendered(digest)), rendered=True)
 
-        return "PDF created successfully"
 
 if __name__ == "__main__":
     pdf = PDF()
@@ -0,0 +1,157 @@
+import os
+import time
+
+from bson import ObjectId
+
+from system import System, page_sort_key, patients_page
+
+# The patient fields the portal shows (see format_patient in ui.py)
+PATIENT_FIELDS = {
+    "order": 1,
+    "first_name": 1,
+    "last_name": 1,
+    "age": 1,
+    "dob": 1,
+    "address": 1,
+    "weight": 1,
+    "blood_type": 1,
+    "phone": 1,
+    "email": 1,
+    "gender": 1,
+    "room_number": 1,
+    "assign_nurse_id": 1,
+    "note": 1,
+    "process": 1,
+}
+
+
+class PortalData:
+    """Reads of the nurse portal, cached per session.
+
+    Entries live in the given state mapping (st.session_state in the portal)
+    for ttl seconds, so Streamlit reruns within that window do not query the
+    database again. Writes made through this class update or drop the cached
+    entries they affect."""
+
+    STATE_KEY = "portal_cache"
+
+    def __init__(self, db, state, ttl=None):
+        """
+        Args:
+            db: The MongoDB database (e.g. client["nursecheck"])
+            state (dict): Where to keep the cache, e.g. st.session_state
+            ttl (float): Seconds an entry stays valid. Defaults to PORTAL_CACHE_TTL (30).
+        """
+        self.patients_collection = db["patients"]
+        self.system = System(client=db.client)
+        self.ttl = ttl if ttl is not None else float(os.getenv("PORTAL_CACHE_TTL", "30"))
+        if self.STATE_KEY not in state:
+            state[self.STATE_KEY] = {}
+        self.cache = state[self.STATE_KEY]
+        self.page_size = int(os.getenv("PORTAL_PAGE_SIZE", "20"))
+        self.reads = 0
+
+    def _get(self, key):
+        entry = self.cache.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def _set(self, key, value):
+        self.cache[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def nurse_patients(self, nurse_id, processed=False):
+        """The loaded pages of a nurse's patients, highest priority first
+
+        Returns:
+            dict: The patients loaded so far and the cursor of the next page"""
+        pages = self._get(("list", nurse_id, processed))
+        if pages is None:
+            pages = self._set(("list", nurse_id, processed), {"patients": [], "next_cursor": None})
+            self._load(pages, nurse_id, processed, None)
+        return pages
+
+    def load_more(self, nurse_id, processed=False):
+        """Append the next page to the loaded patients of a nurse"""
+        pages = self.nurse_patients(nurse_id, processed)
+        if pages["next_cursor"]:
+            self._load(pages, nurse_id, processed, pages["next_cursor"])
+
+    def _load(self, pages, nurse_id, processed, cursor):
+        self.reads += 1
+        page = patients_page(
+            self.patients_collection, nurse_id, processed, self.page_size, cursor, PATIENT_FIELDS
+        )
+        pages["patients"].extend(page["patients"])
+        pages["next_cursor"] = page["next_cursor"]
+        for patient in page["patients"]:
+            self._set(("patient", str(patient["_id"])), patient)
+
+    def patient(self, patient_id):
+        """One patient, or None"""
+        return self.patients([patient_id]).get(str(patient_id))
+
+    def patients(self, patient_ids):
+        """Several patients keyed by string ID. The ones not cached are
+        fetched in a single $in query."""
+        found = {}
+        missing = []
+        for patient_id in patient_ids:
+            patient = self._get(("patient", str(patient_id)))
+            if patient is None:
+                missing.append(ObjectId(patient_id))
+            else:
+                found[str(patient_id)] = patient
+        if missing:
+            self.reads += 1
+            for patient in self.patients_collection.find({"_id": {"$in": missing}}, PATIENT_FIELDS):
+                found[str(patient["_id"])] = self._set(("patient", str(patient["_id"])), patient)
+        return found
+
+    def cached(self, key, compute):
+        """Cache the result of compute(), e.g. a similar-case search"""
+        value = self._get(key)
+        if value is None:
+            value = self._set(key, compute())
+        return value
+
+    def set_process(self, patient_id, process_status):
+        """Mark a patient processed or not. The write goes through System, so
+        the triage queue and API response cache see it too. The cached lists
+        are updated in place, so the rerun after a checkbox click reads nothing."""
+        self.system.set_patient_fields(ObjectId(patient_id), {"process": process_status})
+        lists = [(key, pages) for key, (_, pages) in self.cache.items() if key[0] == "list"]
+        patient = self._get(("patient", str(patient_id)))
+        for _, pages in lists:
+            for other in pages["patients"]:
+                if str(other["_id"]) == str(patient_id):
+                    patient = other
+        if patient is None:
+            return
+        patient["process"] = process_status
+        for key, pages in lists:
+            if key[1] != patient.get("assign_nurse_id"):
+                continue
+            listed = pages["patients"]
+            listed[:] = [other for other in listed if other["_id"] != patient["_id"]]
+            if key[2] == process_status:
+                # Only place it if it sorts within the loaded pages; otherwise
+                # the next page will contain it
+                position = page_sort_key(patient)
+                if not pages["next_cursor"] or (listed and position < page_sort_key(listed[-1])):
+                    listed.append(patient)
+                    listed.sort(key=page_sort_key)
+
+    def invalidate(self, kind=None, key=None):
+        """Drop cached entries: all of them, all of a kind ("list",
+        "patient" or a search), or one"""
+        for cached_key in list(self.cache):
+            if kind is None or (cached_key[0] == kind and (key is None or cached_key[1] == key)):
+                del self.cache[cached_key]
+
+    def patient_created(self, nurse_id):
+        """Drop the entries a new patient of a nurse makes stale"""
+        self.invalidate("list", nurse_id)
+        self.invalidate("similarity")
+        self.invalidate("semantic")
@@ -0,0 +1,198 @@
+"""QR codes of patient IDs, kept as encoded PNG bytes.
+
+Usage:
+    python3 qr_codes.py generate-missing --workers 4
+
+Encoded PNGs are held in a bounded in-memory LRU and served from there.
+Writing them to the qr_code folder happens on a background thread, so
+creating a patient does not wait for PNG encoding or the filesystem.
+"""
+import argparse
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+QR_DIR = "qr_code"
+
+
+def qr_path(patient_id):
+    return os.path.join(QR_DIR, "patient_{}_qrcode.png".format(patient_id))
+
+
+def encode_png(patient_id):
+    """Encode the QR code of a patient ID as PNG bytes"""
+    import qrcode
+
+    buffer = io.BytesIO()
+    qrcode.make(str(patient_id)).save(buffer)
+    return buffer.getvalue()
+
+
+def write_png(patient_id, data):
+    """Write the PNG of a patient to the qr_code folder"""
+    path = qr_path(patient_id)
+    os.makedirs(QR_DIR, exist_ok=True)
+    # Write next to the target and swap, so readers never see a partial file
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def generate_file(patient_id):
+    """Encode and write the QR code of a patient. Runs in the bulk workers."""
+    write_png(patient_id, encode_png(patient_id))
+    return str(patient_id)
+
+
+class QRCodeStore:
+    """Bounded LRU of encoded QR PNGs keyed by patient ID, backed by the
+    qr_code folder"""
+
+    def __init__(self, max_entries=None, writers=1):
+        """
+        Args:
+            max_entries (int): PNGs kept in memory. Defaults to QR_CACHE_ENTRIES (1024).
+            writers (int): Threads writing PNGs to disk
+        """
+        self.max_entries = max_entries or int(os.getenv("QR_CACHE_ENTRIES", "1024"))
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.writes = {}
+        self.executor = ThreadPoolExecutor(writers, thread_name_prefix="qr-writer")
+
+    def __contains__(self, patient_id):
+        with self.lock:
+            return str(patient_id) in self.memory
+
+    def get(self, patient_id):
+        """Return the PNG bytes of a patient's QR code, encoding it if needed"""
+        patient_id = str(patient_id)
+        with self.lock:
+            data = self.memory.get(patient_id)
+            if data is not None:
+                self.memory.move_to_end(patient_id)
+                return data
+        try:
+            with open(qr_path(patient_id), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = encode_png(patient_id)
+            self._remember(patient_id, data)
+            self._write_later(patient_id, data)
+            return data
+        self._remember(patient_id, data)
+        return data
+
+    def generate(self, patient_id):
+        """Encode a patient's QR code and write it to disk in the background
+
+        Returns:
+            Future: Resolves to the path of the PNG once it is written"""
+        patient_id = str(patient_id)
+        with self.lock:
+            future = self.writes.get(patient_id)
+            if future is not None:
+                return future
+            future = self.writes[patient_id] = self.executor.submit(self._generate, patient_id)
+        future.add_done_callback(lambda _: self._written(patient_id))
+        return future
+
+    def _generate(self, patient_id):
+        data = encode_png(patient_id)
+        self._remember(patient_id, data)
+        return write_png(patient_id, data)
+
+    def _write_later(self, patient_id, data):
+        with self.lock:
+            if patient_id in self.writes:
+                return
+            future = self.writes[patient_id] = self.executor.submit(write_png, patient_id, data)
+        future.add_done_callback(lambda _: self._written(patient_id))
+
+    def _written(self, patient_id):
+        with self.lock:
+            self.writes.pop(patient_id, None)
+
+    def _remember(self, patient_id, data):
+        with self.lock:
+            self.memory[patient_id] = data
+            self.memory.move_to_end(patient_id)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def delete(self, patient_id):
+        """Forget a patient's QR code and remove its file"""
+        patient_id = str(patient_id)
+        with self.lock:
+            self.memory.pop(patient_id, None)
+            future = self.writes.get(patient_id)
+        if future is not None:
+            future.result()
+        try:
+            os.remove(qr_path(patient_id))
+        except FileNotFoundError:
+            pass
+
+    def flush(self):
+        """Wait for the pending writes"""
+        with self.lock:
+            futures = list(self.writes.values())
+        for future in futures:
+            future.result()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_qr_store():
+    """Return the process-wide QR code store"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = QRCodeStore()
+    return _store
+
+
+def missing_patient_ids(collection):
+    """IDs of the patients without a QR code file"""
+    existing = set(os.listdir(QR_DIR)) if os.path.isdir(QR_DIR) else set()
+    return [
+        str(patient["_id"])
+        for patient in collection.find({}, {"_id": 1})
+        if os.path.basename(qr_path(patient["_id"])) not in existing
+    ]
+
+
+def generate_missing(collection, workers=None, chunksize=32):
+    """Generate the QR codes of every patient missing one on a process pool
+
+    Args:
+        collection: The patients collection
+        workers (int): Worker processes. Defaults to QR_WORKERS or the CPU count.
+        chunksize (int): Patients handed to a worker at a time
+
+    Returns:
+        int: The number of QR codes generated"""
+    patient_ids = missing_patient_ids(collection)
+    if not patient_ids:
+        return 0
+    workers = workers or int(os.getenv("QR_WORKERS", "0")) or os.cpu_count()
+    with ProcessPoolExecutor(workers) as executor:
+        return sum(1 for _ in executor.map(generate_file, patient_ids, chunksize=chunksize))
+
+
+if __name__ == "__main__":
+    from db import get_client
+
+    parser = argparse.ArgumentParser(description="Manage patient QR codes")
+    parser.add_argument("command", choices=["generate-missing"])
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    generated = generate_missing(get_client()["nursecheck"]["patients"], workers=args.workers)
+    print("Generated {} QR codes".format(generated))
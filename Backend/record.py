@@ -1,43 +1,48 @@
-from pymongo import MongoClient
 import os
-from dotenv import load_dotenv
-from system import System
+from env import load_env
+from system import System, as_object_id
+from db import get_client
 from pdf import PDF
-import google.generativeai as genai
+from note_history import NoteHistory
+from response_cache import record_tag, response_cache
+from render_service import get_render_service
+from metrics import traced
 from datetime import datetime
-import openai
-from openai import OpenAI
+from vector_index import get_vector_index, note_key
+import llm
 
-load_dotenv(override=True)
+load_env()
 
 class Record:
-    def __init__(self, conversation=None):
+    def __init__(self, conversation=None, client=None):
         """
         Args: 
             conversation (list): A list of conversation between nurse and patient. 
+            client (MongoClient): The client to use. Defaults to the shared client.
         """
         
         if conversation:
             self.conversation = conversation
         else:
             self.conversation = []
-        self.client = MongoClient(os.getenv("MONGODB_URI"))
-        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-        API_BASE = "https://api.01.ai/v1"
-        API_KEY = "your key"
+        self.client = client or get_client()
+        self.history = NoteHistory(self.client["nursecheck"])
         # self.model = genai.GenerativeModel('gemini-pro')
-        self.clientY1 = OpenAI(
-            api_key=API_KEY,
-            base_url=API_BASE
-        )
+
+    @property
+    def clientY1(self):
+        """The shared LLM client, created on first use"""
+        return llm.get_llm_client()
 
     def check_conversation(self, patient_id):
         """Check if the latest conversation is processed or not.
         If not process, process the conversation, change the processed status to True,
         and process.
         """
-        system = System()
-        conversation_dict = system.get_latest_conversation(patient_id)
+        system = System(client=self.client)
+        conversation_dict = system.get_latest_conversation(
+            patient_id, {"processed": 1, "content": 1}
+        )
         if conversation_dict["processed"]:
             return "Conversation has been processed"
         else:
@@ -48,35 +53,35 @@ class Record:
         Use Gemini with functional calling to generate a record from a conversation.
         """
         today = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        response = self.summarize_conversation(conversation)
-
-        result = response.text
+        result = self.summarize_conversation(conversation)
 
         return {"content": result, "timestamp": today}
     
     def summarize_conversation(self, conversation):
-        """Summarize the conversation."""
+        """Summarize the conversation.
+
+        Args:
+            conversation: A conversation document or its content, either the
+                transcript string saved by Chat or a list of question/answer dicts.
+        """
         task_description = ("I'm going to give you a list of questions and answers between nurse and patient. "
                             "You will give me a summary of the conversation.")
         
-        # Generate the task description message using the client
-        completion_summary = self.clientY1.chat.completions.create(
-            model="yi-large",
-            messages=[{"role": "user", "content": task_description}]
-        )
-        summary_result = completion_summary.choices[0].message.content.strip()
+        # Generate the task description message using the client. The prompt
+        # never changes, so after the first call it is served from the cache.
+        summary_result = llm.complete(self.clientY1, task_description)
         print("Task description acknowledgement: ", summary_result)
 
         # Prepare the conversation data
-        conversation_data = "\n".join([f"Q: {qa['question']}\nA: {qa['answer']}" for qa in conversation["content"]])
+        content = conversation["content"] if isinstance(conversation, dict) else conversation
+        if isinstance(content, str):
+            conversation_data = content
+        else:
+            conversation_data = "\n".join([f"Q: {qa['question']}\nA: {qa['answer']}" for qa in content])
         query = f"Here is the conversation:\n{conversation_data}\nPlease provide a summary."
 
         # Generate the summary using the client
-        response = self.clientY1.chat.completions.create(
-            model="yi-large",
-            messages=[{"role": "user", "content": query}]
-        )
-        summary_response = response.choices[0].message.content.strip()
+        summary_response = llm.complete(self.clientY1, query)
 
         print("Summary of the conversation: ", summary_response)
 
@@ -108,28 +113,24 @@ class Record:
         """Save the record to document DB. 
         """
         db = self.client.get_database()
-        collection_name = "records"
-
-        if collection_name not in db.list_collection_names():
-            db.create_collection(collection_name)
-
-        records_collection = db.get_collection(collection_name)
-
-        records_collection.insert_one(record)
+        # insert_one creates the collection on first use
+        db.get_collection("records").insert_one(record)
     
-    def get_record(self, patient_id):
-        system = System()
-        patient_info = system.get_patient(patient_id)
-        patient_id = patient_info["_id"]
-        
-        result = self.client["nursecheck"]["records"].find_one({"patient_id": patient_id})
+    def get_record(self, patient_id, projection=None):
+        result = self.client["nursecheck"]["records"].find_one(
+            {"patient_id": as_object_id(patient_id)}, projection
+        )
         return result
 
 
+    @traced("record.update_record")
     def update_record(self, patient_id, processed_conversation):
         """Generate a record from a conversation."""
-        system = System()
-        patient_info = system.get_patient(patient_id)
+        system = System(client=self.client)
+        patient_info = system.get_patient(
+            patient_id,
+            {"first_name": 1, "last_name": 1, "age": 1, "gender": 1, "weight": 1, "blood_type": 1},
+        )
         patient_id = patient_info["_id"]
         patient_name = patient_info["first_name"] + " " + patient_info["last_name"]
         patient_age = patient_info["age"]
@@ -137,30 +138,41 @@ class Record:
         patient_weight = patient_info["weight"]
         patient_blood = patient_info["blood_type"]
 
-        if self.get_record(patient_id):
-            record = self.get_record(patient_id)
-            record["notes"].append(processed_conversation)
-            self.client["nursecheck"]["records"].update_one({"patient_id": patient_id}, {"$set": record})
-        else:
-            record = {
-                "patient_id": patient_id,
-                "patient_name": patient_name,
-                "age": patient_age,
-                "gender": patient_gender,
-                "weight": patient_weight,
-                "blood_type": patient_blood,
-                # "last_updated": processed_conversation["timestamp"],
-                "date_created": processed_conversation["timestamp"],
-                "notes": [processed_conversation],
-                "doctor_id": "789",
-            }
-            self.client["nursecheck"]["records"].insert_one(record)
-        self.generate_record_pdf(patient_id)
+        # Only the header lives in the record; notes go to its bucketed history
+        self.client["nursecheck"]["records"].update_one(
+            {"patient_id": patient_id},
+            {
+                "$setOnInsert": {
+                    "patient_id": patient_id,
+                    "patient_name": patient_name,
+                    "age": patient_age,
+                    "gender": patient_gender,
+                    "weight": patient_weight,
+                    "blood_type": patient_blood,
+                    "date_created": processed_conversation["timestamp"],
+                    "doctor_id": "789",
+                },
+                "$set": {"last_updated": processed_conversation["timestamp"]},
+                "$inc": {"note_count": 1},
+            },
+            upsert=True,
+        )
+        self.history.append(patient_id, processed_conversation)
+        response_cache.invalidate(record_tag(patient_id))
+        if processed_conversation.get("note"):
+            get_vector_index().upsert(
+                note_key(patient_id, processed_conversation["timestamp"]),
+                patient_id,
+                processed_conversation["note"],
+                kind="note",
+            )
+        # The PDF is re-rendered in the background, once per burst of notes
+        get_render_service().request(patient_id)
         # self.save_record(record)
         return "Record updated successfully"
     
     def generate_record_pdf(self, patient_id):
-        pdf = PDF()
+        pdf = PDF(client=self.client)
         pdf.create_pdf(patient_id)
         return "PDF created successfully"
     
@@ -174,10 +186,12 @@ class Record:
             return "Record generated successfully"
         
     def get_latest_record_priority(self, patient_id):
-        record = self.get_record(patient_id)
-        notes = record["notes"]
-        latest_note = notes[-1]
+        latest_note = self.history.last(as_object_id(patient_id), ["priority"])
         return latest_note["priority"]
+
+    def get_latest_notes(self, patient_id, n=1, fields=None):
+        """Return the last n notes of a patient's record, oldest first"""
+        return self.history.latest(as_object_id(patient_id), n, fields)
         
 if __name__ == "__main__":
     record = Record()
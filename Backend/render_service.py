@@ -0,0 +1,200 @@
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+from pdf import mark_render_state, pdf_path, read_render_state, render_patient_pdf
+
+
+class RenderService:
+    """Renders record PDFs in the background, off the conversation pipeline.
+
+    Requests for the same patient are coalesced: a request made while a render
+    is waiting to start is absorbed by it, and any number of requests made
+    while one is running cause a single follow-up render. The renderer hashes
+    its inputs and skips the fpdf work when nothing visible changed, so a
+    backlog of notes costs at most two renders per patient.
+
+    Short-lived processes (e.g. the kiosk) call flush() before exiting; the
+    process-wide service also flushes at exit, rendering in this process
+    once the executor is shut down."""
+
+    def __init__(self, workers=None, delay=None, executor=None):
+        """
+        Args:
+            workers (int): Render processes. Defaults to PDF_RENDER_WORKERS (2);
+                0 renders on a thread of this process instead.
+            delay (float): Seconds to wait for more updates before rendering.
+                Defaults to PDF_RENDER_DELAY (2).
+            executor (Executor): Use this executor instead of creating one
+        """
+        workers = workers if workers is not None else int(os.getenv("PDF_RENDER_WORKERS", "2"))
+        self.delay = delay if delay is not None else float(os.getenv("PDF_RENDER_DELAY", "2"))
+        if executor is None:
+            if workers > 0:
+                # spawn, not fork: the app process runs threads and holds Mongo sockets
+                executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                executor = ThreadPoolExecutor(1, thread_name_prefix="pdf-render")
+        self.executor = executor
+        self.jobs = {}
+        self.timers = {}
+        # Set while flushing: renders start without the delay
+        self.immediate = False
+        self.lock = threading.Condition()
+        self.requested = 0
+        self.submitted = 0
+
+    def request(self, patient_id):
+        """Ask for the PDF of a patient to be brought up to date
+
+        Returns:
+            str: "scheduled" or "coalesced" """
+        patient_id = str(patient_id)
+        with self.lock:
+            self.requested += 1
+            job = self.jobs.get(patient_id)
+            if job is None or job["state"] == "failed":
+                job = self.jobs[patient_id] = {"state": "waiting", "dirty": False, "error": None}
+                self._schedule(patient_id)
+                return "scheduled"
+            if job["state"] == "running":
+                job["dirty"] = True
+            return "coalesced"
+
+    def _schedule(self, patient_id):
+        # Other processes (e.g. the portal) read the state from the file
+        mark_render_state(patient_id, "pending")
+        if self.delay > 0 and not self.immediate:
+            timer = threading.Timer(self.delay, self._submit, (patient_id,))
+            timer.daemon = True
+            self.timers[patient_id] = timer
+            timer.start()
+        else:
+            self._submit(patient_id)
+
+    def _submit(self, patient_id):
+        with self.lock:
+            job = self.jobs.get(patient_id)
+            # Already started by flush()
+            if job is None or job["state"] != "waiting":
+                return
+            timer = self.timers.pop(patient_id, None)
+            if timer is not None:
+                timer.cancel()
+            job["state"] = "running"
+            job["dirty"] = False
+            self.submitted += 1
+        started = time.perf_counter()
+        try:
+            future = self.executor.submit(render_patient_pdf, patient_id)
+        except RuntimeError:
+            # The executor is shut down, e.g. at interpreter exit
+            future = Future()
+            try:
+                future.set_result(render_patient_pdf(patient_id))
+            except Exception as e:
+                future.set_exception(e)
+        future.add_done_callback(lambda future: self._done(patient_id, future, started))
+
+    def _done(self, patient_id, future, started):
+        error = future.exception()
+        # Renders run in other processes, so their spans are timed from here
+        metrics.observe("pdf.render_job", time.perf_counter() - started, error=error is not None)
+        if error is not None:
+            print("Failed to render the PDF of patient {}: {}".format(patient_id, error))
+        with self.lock:
+            job = self.jobs[patient_id]
+            if job["dirty"]:
+                job["state"] = "waiting"
+                self._schedule(patient_id)
+            else:
+                del self.jobs[patient_id]
+                if error is not None:
+                    self.jobs[patient_id] = {"state": "failed", "dirty": False, "error": str(error)}
+                    mark_render_state(patient_id, "failed", error=str(error))
+            self.lock.notify_all()
+
+    def status(self, patient_id):
+        """Return whether the PDF of a patient is fresh
+
+        Returns:
+            dict: state ("pending", "fresh", "failed" or "missing"), path,
+                and the hash and time of the last render if there was one"""
+        status = render_status(patient_id)
+        with self.lock:
+            job = self.jobs.get(status["patient_id"])
+        if job is not None and job["state"] != "failed":
+            status["state"] = "pending"
+        elif job is not None:
+            status.update(state="failed", error=job["error"])
+        return status
+
+    def wait(self, patient_id=None, timeout=None):
+        """Block until the renders of a patient, or of everyone, are done
+
+        Returns:
+            bool: False if the timeout expired first"""
+        def idle():
+            if patient_id is None:
+                return all(job["state"] == "failed" for job in self.jobs.values())
+            job = self.jobs.get(str(patient_id))
+            return job is None or job["state"] == "failed"
+
+        with self.lock:
+            return self.lock.wait_for(idle, timeout)
+
+    def flush(self, timeout=None):
+        """Start the delayed renders now and wait for every render, e.g.
+        before a short-lived process exits
+
+        Returns:
+            bool: False if the timeout expired first"""
+        with self.lock:
+            self.immediate = True
+            waiting = [patient_id for patient_id, job in self.jobs.items() if job["state"] == "waiting"]
+        try:
+            for patient_id in waiting:
+                self._submit(patient_id)
+            return self.wait(timeout=timeout)
+        finally:
+            with self.lock:
+                self.immediate = False
+
+    def shutdown(self, wait=True):
+        """Stop the executor. With wait, the pending renders are done first."""
+        if wait:
+            self.flush()
+        self.executor.shutdown(wait=wait)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_render_service():
+    """Return the process-wide render service"""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = RenderService()
+                # Render what is still pending when the process exits
+                atexit.register(_service.flush)
+    return _service
+
+
+def render_status(patient_id):
+    """Freshness of a patient's PDF from the state file the render service
+    and the renderer keep next to it. Readable from any process."""
+    patient_id = str(patient_id)
+    status = {"patient_id": patient_id, "path": pdf_path(patient_id)}
+    status.update(read_render_state(patient_id) or {})
+    if not os.path.exists(status["path"]):
+        if status.get("state") not in ("pending", "failed"):
+            status["state"] = "missing"
+    status.setdefault("state", "fresh")
+    return status
@@ -0,0 +1,130 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+from bson import Binary, ObjectId
+
+from env import load_env
+
+# Before the module-level cache reads its settings
+load_env()
+
+CachedResponse = namedtuple("CachedResponse", ["body", "etag", "tags", "expires_at"])
+
+
+def default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (bytes, Binary)):
+        return base64.b64encode(bytes(value)).decode("ascii")
+    raise TypeError("Cannot serialize {}".format(type(value).__name__))
+
+
+def dumps(data):
+    """Serialize a response body, with ObjectIds as strings"""
+    return json.dumps(data, default=default, separators=(",", ":")).encode("utf-8")
+
+
+def make_etag(body):
+    return '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header matches an ETag"""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    # Weak comparison, as for GET
+    return "*" in candidates or etag in candidates or "W/" + etag in candidates
+
+
+class ResponseCache:
+    """LRU of serialized API responses with their ETags.
+
+    Each entry carries tags (e.g. "patient:<id>"). System invalidates the
+    tags a write affects, so entries are dropped as soon as the data behind
+    them changes in this process; the ttl bounds staleness from writes made
+    elsewhere (e.g. the portal)."""
+
+    def __init__(self, max_entries=None, ttl=None):
+        """
+        Args:
+            max_entries (int): Cached responses. Defaults to RESPONSE_CACHE_ENTRIES (512).
+            ttl (float): Seconds a response stays valid. Defaults to RESPONSE_CACHE_TTL (30).
+        """
+        self.max_entries = max_entries or int(os.getenv("RESPONSE_CACHE_ENTRIES", "512"))
+        self.ttl = ttl if ttl is not None else float(os.getenv("RESPONSE_CACHE_TTL", "30"))
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached response of a key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at < time.monotonic():
+                self._drop(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, tags=()):
+        """Cache a serialized response
+
+        Returns:
+            CachedResponse: The entry, with its ETag"""
+        entry = CachedResponse(body, make_etag(body), tuple(tags), time.monotonic() + self.ttl)
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = entry
+            for tag in entry.tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+        return entry
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        for tag in entry.tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def invalidate(self, *tags):
+        """Drop every response carrying one of the tags"""
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+
+response_cache = ResponseCache()
+
+
+def patient_tag(patient_id):
+    return "patient:{}".format(patient_id)
+
+
+def record_tag(patient_id):
+    return "record:{}".format(patient_id)
+
+
+# Nurse lists depend on the order, process flag and nurse of every patient
+NURSES_TAG = "nurses"
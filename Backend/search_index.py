@@ -0,0 +1,141 @@
+import heapq
+import os
+import threading
+import time
+from collections import Counter
+
+
+def tokenize(note):
+    """Split a note into the set of tokens compared by similarity search"""
+    if not note:
+        return set()
+    return set(note.split())
+
+
+class InvertedIndex:
+    """Token inverted index over patient notes.
+
+    Each token maps to the posting list (set) of patient ids whose note
+    contains it, so a query only touches the postings of its own tokens
+    instead of every patient in the collection."""
+
+    def __init__(self):
+        self.postings = {}
+        self.tokens = {}
+        self.built_at = None
+        self.lock = threading.RLock()
+
+    def __contains__(self, patient_id):
+        return str(patient_id) in self.tokens
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def update(self, patient_id, note):
+        """Add or replace the note of a patient
+
+        Args:
+            patient_id (str): The patient ID
+            note (str): The new note"""
+        patient_id = str(patient_id)
+        new_tokens = tokenize(note)
+        with self.lock:
+            old_tokens = self.tokens.get(patient_id, set())
+            for token in old_tokens - new_tokens:
+                self._discard(token, patient_id)
+            for token in new_tokens - old_tokens:
+                self.postings.setdefault(token, set()).add(patient_id)
+            self.tokens[patient_id] = new_tokens
+
+    def remove(self, patient_id):
+        """Remove a patient from the index"""
+        patient_id = str(patient_id)
+        with self.lock:
+            for token in self.tokens.pop(patient_id, set()):
+                self._discard(token, patient_id)
+
+    def _discard(self, token, patient_id):
+        posting = self.postings.get(token)
+        if posting is None:
+            return
+        posting.discard(patient_id)
+        if not posting:
+            del self.postings[token]
+
+    def build(self, collection):
+        """Rebuild the index from the patients collection
+
+        Args:
+            collection: The MongoDB patients collection"""
+        postings = {}
+        tokens = {}
+        for patient in collection.find({}, {"note": 1}):
+            patient_id = str(patient["_id"])
+            patient_tokens = tokenize(patient.get("note"))
+            tokens[patient_id] = patient_tokens
+            for token in patient_tokens:
+                postings.setdefault(token, set()).add(patient_id)
+        with self.lock:
+            self.postings = postings
+            self.tokens = tokens
+            self.built_at = time.monotonic()
+
+    def is_stale(self, max_age):
+        """Check if the index was never built or is older than max_age seconds"""
+        if self.built_at is None:
+            return True
+        return max_age is not None and time.monotonic() - self.built_at > max_age
+
+    def search(self, patient_id, k=10, min_score=1):
+        """Find the patients whose notes share the most tokens with a patient
+
+        Args:
+            patient_id (str): The patient ID to compare against
+            k (int): The maximum number of results
+            min_score (int): The minimum number of shared tokens
+
+        Returns:
+            list: (patient_id, score) tuples, best match first"""
+        patient_id = str(patient_id)
+        with self.lock:
+            query_tokens = self.tokens.get(patient_id, set())
+            return self._top_k(query_tokens, patient_id, k, min_score)
+
+    def search_tokens(self, query_tokens, k=10, min_score=1, exclude=None):
+        """Find the patients whose notes share the most tokens with query_tokens"""
+        with self.lock:
+            return self._top_k(query_tokens, exclude, k, min_score)
+
+    def _top_k(self, query_tokens, exclude, k, min_score):
+        scores = Counter()
+        for token in query_tokens:
+            scores.update(self.postings.get(token, ()))
+        scores.pop(exclude, None)
+        candidates = (
+            (score, patient_id)
+            for patient_id, score in scores.items()
+            if score >= min_score
+        )
+        return [(patient_id, score) for score, patient_id in heapq.nlargest(k, candidates)]
+
+
+# Shared by every System in the process so incremental updates made on
+# create/update are visible to the similar-case search.
+patient_index = InvertedIndex()
+_build_lock = threading.Lock()
+
+
+def get_patient_index(collection, max_age=None):
+    """Return the process-wide patient index, building it on first use
+
+    Args:
+        collection: The MongoDB patients collection
+        max_age (float): Rebuild after this many seconds to pick up writes
+            made by other processes. Defaults to PATIENT_INDEX_MAX_AGE."""
+    if max_age is None:
+        max_age = float(os.getenv("PATIENT_INDEX_MAX_AGE", "300"))
+    if patient_index.is_stale(max_age):
+        with _build_lock:
+            if patient_index.is_stale(max_age):
+                patient_index.build(collection)
+    return patient_index
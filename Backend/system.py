@@ -1,18 +1,185 @@
-from pymongo import MongoClient
+import base64
+import io
+import json
 import os
-from dotenv import load_dotenv
-from objects import Patient, Nurse
-import qrcode
-import google.generativeai as genai
+from env import load_env
+from objects import Patient, Nurse, decode
+from search_index import patient_index
+from vector_index import get_vector_index, patient_key
+from triage_queue import get_triage_queue, order_value
+from qr_codes import get_qr_store
 from bson import ObjectId
-import resend
+from bson.errors import InvalidId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from indexes import ensure_indexes, migrate_orders
+from note_history import NoteHistory
+from response_cache import NURSES_TAG, patient_tag, record_tag, response_cache
+from db import get_client
+from metrics import span, traced
 
-load_dotenv(override=True)
+load_env()
+
+
+def as_object_id(value):
+    """Convert a patient/nurse ID string to an ObjectId, leaving anything
+    that is not a valid ObjectId unchanged"""
+    if isinstance(value, ObjectId):
+        return value
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return value
+
+
+# The fields the triage queue needs after a patient update
+QUEUE_FIELDS = {"assign_nurse_id": 1, "order": 1, "process": 1, "version": 1}
+
+
+class StalePatientError(Exception):
+    """The patient was changed by someone else since the version the caller read"""
+
+    def __init__(self, patient_id, expected_version):
+        super().__init__(
+            "Patient {} is no longer at version {}".format(patient_id, expected_version)
+        )
+        self.patient_id = patient_id
+        self.expected_version = expected_version
+
+
+def patient_filter(patient_id, expected_version=None):
+    query = {"_id": as_object_id(patient_id)}
+    if expected_version is not None:
+        # Patients created before versioning have no version field
+        query["version"] = {"$in": [0, None]} if expected_version == 0 else expected_version
+    return query
+
+
+def patient_update(fields=None, inc=None):
+    """A field-level patient update that also bumps its version"""
+    update = {"$inc": dict(inc or {}, version=1)}
+    if fields:
+        update["$set"] = fields
+    return update
+
+
+def patient_identity(patient):
+    """The fields that identify a patient, as a query"""
+    return {
+        "first_name": patient.first_name,
+        "last_name": patient.last_name,
+        "dob": patient.dob,
+        "email": patient.email,
+    }
+
+
+def nurse_identity(nurse):
+    """The fields that identify a nurse, as a query"""
+    return {
+        "first_name": nurse.first_name,
+        "last_name": nurse.last_name,
+        "age": nurse.age,
+        "phone": nurse.phone,
+    }
+
+
+def upsert_identity(collection, identity, document):
+    """Insert document unless a document matching identity exists, in one
+    round trip. The unique identity indexes make concurrent creates safe.
+
+    Returns:
+        ObjectId: The _id of the existing document, or document["_id"] if
+            it was inserted"""
+    for attempt in range(2):
+        try:
+            existing = collection.find_one_and_update(
+                identity,
+                {"$setOnInsert": document},
+                projection={"_id": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            return existing["_id"]
+        except DuplicateKeyError:
+            # A concurrent create won the race; the retry finds its document
+            if attempt:
+                raise
+
+
+def encode_cursor(patient):
+    """An opaque cursor positioned after a patient in priority order"""
+    order = patient.get("order")
+    if order is not None and not isinstance(order, (int, float)):
+        # A legacy string order not yet converted by migrate_orders
+        order = order_value(order)
+    key = json.dumps({"order": order, "id": str(patient["_id"])})
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """The (order, _id) of a cursor made by encode_cursor
+
+    Raises:
+        ValueError: If the cursor is malformed"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        order = key["order"]
+        if order is not None and not isinstance(order, (int, float)):
+            raise ValueError("order is not a number")
+        return order, ObjectId(key["id"])
+    except (ValueError, KeyError, TypeError, InvalidId) as e:
+        raise ValueError("Invalid cursor: {}".format(e)) from e
+
+
+def page_sort_key(patient):
+    """Python equivalent of the page order: order descending with missing
+    orders last, then _id"""
+    order = patient.get("order")
+    if order is not None and not isinstance(order, (int, float)):
+        order = order_value(order)
+    return (order is None, -(order or 0), patient["_id"])
+
+
+def patients_page(collection, nurse_id, processed=False, limit=20, cursor=None, projection=None):
+    """Keyset pagination over the patients of a nurse, see System.get_patients_page"""
+    query = {
+        "assign_nurse_id": nurse_id,
+        # Patients created before the process flag existed count as unprocessed
+        "process": True if processed else {"$in": [False, None]},
+    }
+    if cursor:
+        order, last_id = decode_cursor(cursor)
+        if order is None:
+            query["order"] = None
+            query["_id"] = {"$gt": last_id}
+        else:
+            query["$or"] = [
+                {"order": {"$lt": order}},
+                {"order": order, "_id": {"$gt": last_id}},
+                {"order": None},
+            ]
+    if projection is not None:
+        projection = dict(projection, order=1)
+    documents = list(
+        collection.find(query, projection)
+        .sort([("order", DESCENDING), ("_id", ASCENDING)])
+        .limit(limit + 1)
+    )
+    next_cursor = encode_cursor(documents[limit - 1]) if len(documents) > limit else None
+    return {"patients": documents[:limit], "next_cursor": next_cursor}
 
 
 class System:
-    def __init__(self):
-        self.client = MongoClient(os.getenv("MONGODB_URI"))
+    def __init__(self, client=None):
+        """
+        Args:
+            client (MongoClient): The client to use. Defaults to the shared client.
+        """
+        self.client = client or get_client()
+
+    def ensure_indexes(self):
+        """Create the database indexes used by the query methods"""
+        return ensure_indexes(self.client["nursecheck"])
 
     def ping_database(self):
         """Check if the database is connected"""
@@ -23,72 +190,89 @@ class System:
             return False
 
     def create_patient(self, patient_info: Patient):
-        """Create a new patient in the database
+        """Create a new patient in the database. Creating a patient that
+        already exists (same name, date of birth and email) returns the
+        existing patient's ID.
 
         Args:
             patient_info (Patient): The patient information
 
         Returns:
             str: The patient ID"""
-        if self.find_patient(
-            patient_info.first_name,
-            patient_info.last_name,
-            patient_info.dob,
-            patient_info.email,
-        ):
+        new_id = ObjectId()
+        patient_id = upsert_identity(
+            self.client["nursecheck"]["patients"],
+            patient_identity(patient_info),
+            dict(patient_info.to_dict(), _id=new_id, version=0),
+        )
+        if patient_id != new_id:
             print("Patient already exists")
-            return self.get_patient(
-                self.find_patient(
-                    patient_info.first_name,
-                    patient_info.last_name,
-                    patient_info.dob,
-                    patient_info.email,
-                )["_id"]
-            )["_id"]
-        else:
-            result = self.client["nursecheck"]["patients"].insert_one(
-                patient_info.to_dict()
-            )
-            patient_id = result.inserted_id
-            assert self.generate_qr_code(
-                patient_id
-            ) == "QR code generated for patient {}".format(patient_id)
             return patient_id
-
-    def find_patient(self, first_name, last_name, dob, email):
+        patient_index.update(patient_id, patient_info.note)
+        get_triage_queue().update(
+            patient_id,
+            patient_info.assign_nurse_id,
+            patient_info.order,
+            patient_info.process,
+        )
+        if patient_info.note:
+            get_vector_index().upsert(patient_key(patient_id), patient_id, patient_info.note)
+        response_cache.invalidate(NURSES_TAG)
+        # Encoded and written in the background; get_qr_code serves it from memory
+        get_qr_store().generate(patient_id)
+        return patient_id
+
+    def find_patient(self, first_name, last_name, dob, email, projection=None):
+        """Find the patient in the database"""
         patient = self.client["nursecheck"]["patients"].find_one(
             {
-                "first_name ": first_name,
+                "first_name": first_name,
                 "last_name": last_name,
                 "dob": dob,
                 "email": email,
-            }
+            },
+            projection,
         )
         return patient
 
-    def get_patient(self, patient_id):
+    def get_patient(self, patient_id, projection=None):
         """Get the patient information from the database
 
         Args:
             patient_id (str): The patient ID
+            projection (dict): Only return these fields
 
         Returns:
             dict: The patient information"""
         patient = self.client["nursecheck"]["patients"].find_one(
-            {"_id": ObjectId(patient_id)}
+            {"_id": ObjectId(patient_id)}, projection
         )
         return patient
 
-    def get_patient_record(self, patient_id):
+    def get_patient_record(self, patient_id, projection=None):
         """Get the patient record from the database
 
         Args:
-            patient_id (str): The patient ID"""
+            patient_id (str): The patient ID
+            projection (dict): Only return these fields"""
         patient = self.client["nursecheck"]["records"].find_one(
-            {"patient_id": patient_id}
+            {"patient_id": as_object_id(patient_id)}, projection
         )
         return patient
 
+    def get_patient_notes(self, patient_id, n=None, fields=None):
+        """Get the notes of the patient record, oldest first
+
+        Args:
+            patient_id (str): The patient ID
+            n (int): Only the last n notes. Defaults to all of them.
+            fields (list): Only return these note fields"""
+        history = NoteHistory(self.client["nursecheck"])
+        if n is None:
+            return list(history.iter_notes(as_object_id(patient_id), fields))
+        return history.latest(as_object_id(patient_id), n, fields)
+
+    @traced("system.update_patient_record")
     def update_patient_record(self, patient_id, new_note, timestamp):
         """Update the patient record in the database
 
@@ -96,11 +280,15 @@ class System:
             patient_id (str): The patient ID
             new_note (str): The new note
             timestamp (str): The timestamp"""
-        patient = self.get_patient_record(patient_id)
-        patient["notes"].append({"content": new_note, "timestamp": timestamp})
+        patient_id = as_object_id(patient_id)
+        NoteHistory(self.client["nursecheck"]).append(
+            patient_id, {"content": new_note, "timestamp": timestamp}
+        )
         self.client["nursecheck"]["records"].update_one(
-            {"patient_id": patient_id}, {"$set": patient}
+            {"patient_id": patient_id},
+            {"$set": {"last_updated": timestamp}, "$inc": {"note_count": 1}},
         )
+        response_cache.invalidate(record_tag(patient_id))
         return "Patient record updated"
 
     def delete_patient(self, patient_id):
@@ -109,50 +297,84 @@ class System:
         Args:
             patient_id (str): The patient ID"""
         self.client["nursecheck"]["patients"].delete_one({"_id": patient_id})
+        patient_index.remove(patient_id)
+        get_triage_queue().remove(patient_id)
+        get_vector_index().delete(patient_key(patient_id))
+        response_cache.invalidate(patient_tag(patient_id), record_tag(patient_id), NURSES_TAG)
         self.delete_qr_code(patient_id)
         return "Patient deleted"
 
     def generate_qr_code(self, patient_id: str):
         """Generate a QR code for the patient"""
-        img = qrcode.make(patient_id)
-
-        img.save("qr_code/patient_{}_qrcode.png".format(patient_id))
+        get_qr_store().generate(patient_id).result()
         return "QR code generated for patient {}".format(patient_id)
 
+    def get_qr_code(self, patient_id):
+        """Get the QR code of the patient
+
+        Returns:
+            bytes: The QR code as PNG"""
+        return get_qr_store().get(patient_id)
+
     def delete_qr_code(self, patient_id):
         """Delete the QR code for the patient"""
-        os.remove("qr_code/patient_{}_qrcode.png".format(patient_id))
+        get_qr_store().delete(patient_id)
 
     def show_qr_code(self, patient_id):
         """Show the QR code for the patient"""
-        img = qrcode.make(patient_id)
-        img.show()
+        from PIL import Image
+
+        Image.open(io.BytesIO(self.get_qr_code(patient_id))).show()
         return "QR code shown for patient {}".format(patient_id)
 
-    def get_all_patients(self):
+    def get_all_patients(self, projection=None):
         """Retrieve all patients from the database"""
-        patients = self.client["nursecheck"]["patients"].find()
+        patients = self.client["nursecheck"]["patients"].find({}, projection)
         return [patient for patient in patients]
 
-    def get_all_documents(self):
+    def find_patients(self, query=None, fields=None, limit=0):
+        """Read patients as typed models, validated in one call
+
+        Args:
+            query (dict): The filter. Defaults to every patient.
+            fields (list): Only read these fields; the models then have only
+                these fields and their id
+            limit (int): The most patients to read, 0 for all
+
+        Returns:
+            list: objects.Patient models"""
+        projection = {field: 1 for field in fields} if fields is not None else None
+        cursor = self.client["nursecheck"]["patients"].find(query or {}, projection).limit(limit)
+        return decode(Patient, cursor, fields)
+
+    def find_nurses(self, query=None, fields=None, limit=0):
+        """Read nurses as typed models, see find_patients"""
+        projection = {field: 1 for field in fields} if fields is not None else None
+        cursor = self.client["nursecheck"]["nurses"].find(query or {}, projection).limit(limit)
+        return decode(Nurse, cursor, fields)
+
+    def get_all_documents(self, projection=None):
         """Retrieve all documents from the database"""
-        documents = self.client["nursecheck"]["documents"].find()
+        documents = self.client["nursecheck"]["documents"].find({}, projection)
         return [document for document in documents]
 
-    def retrieve_conversations(self, patient_id):
-        """Retrieve the conversation between nurse and patient from the database"""
-        documents = self.get_all_documents()
-        conversations = [
-            document
-            for document in documents
-            if document["patient_id"] == ObjectId(patient_id)
-        ]
-        return conversations
+    def retrieve_conversations(self, patient_id, projection=None, limit=0):
+        """Retrieve the conversations between nurse and patient from the database, oldest first"""
+        documents = (
+            self.client["nursecheck"]["documents"]
+            .find({"patient_id": ObjectId(patient_id)}, projection)
+            .sort([("timestamp", 1), ("_id", 1)])
+            .limit(limit)
+        )
+        return [document for document in documents]
 
-    def get_latest_conversation(self, patient_id):
+    def get_latest_conversation(self, patient_id, projection=None):
         """Retrieve the latest conversation between nurse and patient from the database"""
-        conversations = self.retrieve_conversations(patient_id)
-        return conversations[-1]
+        return self.client["nursecheck"]["documents"].find_one(
+            {"patient_id": ObjectId(patient_id)},
+            projection,
+            sort=[("timestamp", -1), ("_id", -1)],
+        )
 
     def convert_dict_to_text(self, conversation):
         """Convert the conversation from dictionary to text"""
@@ -163,74 +385,195 @@ class System:
             text += c["answer"] + "\n"
         return text
 
+    @traced("system.update_patient_order")
     def update_patient_order(self, patient_id, order, note):
         """Update the order of the patient"""
-        patient = self.get_patient(patient_id)
-        patient["order"] = order
-        patient["note"] = note
-        self.client["nursecheck"]["patients"].update_one(
-            {"_id": patient_id}, {"$set": patient}
-        )
+        patient_id = as_object_id(patient_id)
+        self.set_patient_fields(patient_id, {"order": order_value(order), "note": note})
+        patient_index.update(patient_id, note)
+        get_vector_index().upsert(patient_key(patient_id), patient_id, note)
         return "Patient order updated"
 
-    def process_patient(self, patient_id):
-        """Process the patient information"""
-        patient = self.get_patient(patient_id)
-        if patient["process"] is True:
-            patient["process"] = False
-        else:
-            patient["process"] = True
-        self.client["nursecheck"]["patients"].update_one(
-            {"_id": ObjectId(patient_id)}, {"$set": patient}
+    def set_patient_fields(self, patient_id, fields=None, inc=None, expected_version=None):
+        """Atomically update some fields of the patient and bump its version
+
+        Args:
+            patient_id (str): The patient ID
+            fields (dict): Fields to $set
+            inc (dict): Fields to $inc
+            expected_version (int): Only update if the patient is still at
+                this version, e.g. the version the caller read
+
+        Returns:
+            dict: The updated queue fields (assign_nurse_id, order, process,
+                version) of the patient, or None if it does not exist
+
+        Raises:
+            StalePatientError: If the patient is no longer at expected_version"""
+        patient = self.client["nursecheck"]["patients"].find_one_and_update(
+            patient_filter(patient_id, expected_version),
+            patient_update(fields, inc),
+            projection=QUEUE_FIELDS,
+            return_document=ReturnDocument.AFTER,
         )
+        if patient is None and expected_version is not None:
+            raise StalePatientError(patient_id, expected_version)
+        self._patient_changed(patient)
+        return patient
+
+    def bulk_update_patients(self, updates, ordered=False):
+        """Apply many field-level patient updates, the unversioned ones in a
+        single bulk_write
+
+        Args:
+            updates (list): Dicts with a patient_id and any of set, inc and
+                expected_version, as in set_patient_fields
+            ordered (bool): Stop the bulk_write at the first failed update
 
-    def check_patients_order(self):
-        """Check the order of the patients"""
-        patients = self.get_all_patients()
-        # patients = [patient for patient in patients if patient["assign_nurse_id"] == nurse_id]
-        sort_order = sorted(patients, key=lambda x: x["order"], reverse=True)
-        # handle duplicate
+        Returns:
+            dict: The matched and modified counts, and the IDs of the
+                patients not updated because their version had moved on"""
+        if not updates:
+            return {"matched": 0, "modified": 0, "stale": []}
+        patients = self.client["nursecheck"]["patients"]
+        ids = [as_object_id(update["patient_id"]) for update in updates]
+        requests = [
+            UpdateOne({"_id": patient_id}, patient_update(update.get("set"), update.get("inc")))
+            for patient_id, update in zip(ids, updates)
+            if update.get("expected_version") is None
+        ]
+        result = patients.bulk_write(requests, ordered=ordered) if requests else None
+        matched = result.matched_count if result else 0
+        modified = result.modified_count if result else 0
+
+        # A bulk result only has totals, so versioned updates are sent one by
+        # one: the version in the filter keeps a patient that moved on from
+        # being written, and its matched count tells which did
+        stale = []
+        for patient_id, update in zip(ids, updates):
+            expected = update.get("expected_version")
+            if expected is None:
+                continue
+            written = patients.update_one(
+                patient_filter(patient_id, expected), patient_update(update.get("set"), update.get("inc"))
+            )
+            matched += written.matched_count
+            modified += written.modified_count
+            if not written.matched_count:
+                stale.append(patient_id)
+
+        # One read to bring the triage queue up to date
+        for patient in patients.find({"_id": {"$in": ids}}, QUEUE_FIELDS):
+            self._patient_changed(patient)
+        return {"matched": matched, "modified": modified, "stale": stale}
+
+    def _patient_changed(self, patient):
+        """Bring the triage queue and API response cache up to date after an update"""
+        if patient is not None:
+            get_triage_queue().update(
+                patient["_id"], patient.get("assign_nurse_id"), patient.get("order"), patient.get("process")
+            )
+            response_cache.invalidate(patient_tag(patient["_id"]), NURSES_TAG)
+
+    def process_patient(self, patient_id, expected_version=None):
+        """Toggle whether the patient is processed. The toggle runs in the
+        database, so concurrent toggles never overwrite each other.
 
-        print("Patients order:")
+        Returns:
+            dict: The updated queue fields of the patient
+
+        Raises:
+            StalePatientError: If the patient is no longer at expected_version"""
+        patient = self.client["nursecheck"]["patients"].find_one_and_update(
+            patient_filter(patient_id, expected_version),
+            [{"$set": {
+                "process": {"$ne": ["$process", True]},
+                "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+            }}],
+            projection=QUEUE_FIELDS,
+            return_document=ReturnDocument.AFTER,
+        )
+        if patient is None and expected_version is not None:
+            raise StalePatientError(patient_id, expected_version)
+        self._patient_changed(patient)
+        return patient
 
-        result_dict = set()
+    @traced("system.check_patients_order")
+    def check_patients_order(self, nurse_id=None, n=None, projection=None):
+        """Check the order of the patients, highest priority first
 
-        
-        return sort_order
+        Args:
+            nurse_id (str): Only return the unprocessed patients of this nurse,
+                read from the in-process triage queue
+            n (int): Only return the top n patients
+            projection (dict): Only return these fields
+
+        Returns:
+            list: The patients, highest priority first"""
+        patients = self.client["nursecheck"]["patients"]
+        if not nurse_id:
+            cursor = patients.find({}, projection).sort("order", -1).limit(n or 0)
+            return [patient for patient in cursor]
+
+        queue = get_triage_queue()
+        queue.ensure_loaded(patients, nurse_id)
+        ranked = queue.top(nurse_id, n)
+        if not ranked:
+            return []
+        cursor = patients.find(
+            {"_id": {"$in": [ObjectId(patient_id) for patient_id, _ in ranked]}},
+            projection,
+        )
+        documents = {str(patient["_id"]): patient for patient in cursor}
+        return [documents[patient_id] for patient_id, _ in ranked if patient_id in documents]
+
+    def get_patients_page(self, nurse_id, processed=False, limit=20, cursor=None, projection=None):
+        """One page of a nurse's patients, highest priority first
+
+        Args:
+            nurse_id (str): The nurse ID
+            processed (bool): Return processed instead of unprocessed patients
+            limit (int): The page size
+            cursor (str): The next_cursor of the previous page
+            projection (dict): Only return these fields
+
+        Returns:
+            dict: The patients of the page and the next_cursor, None on the last page"""
+        return patients_page(
+            self.client["nursecheck"]["patients"], nurse_id, processed, limit, cursor, projection
+        )
+
+    def resync_triage_queue(self):
+        """Rebuild the triage queue from the database, e.g. after a restart.
+        Orders stored as strings by older versions are converted to numbers
+        first so that "10" sorts above "9"."""
+        patients = self.client["nursecheck"]["patients"]
+        migrate_orders(patients)
+        return get_triage_queue().resync(patients)
 
     def create_nurse(self, nurse_info: Nurse):
-        """Create a new nurse in the database"""
-        if self.find_nurse(
-            nurse_info.first_name,
-            nurse_info.last_name,
-            nurse_info.age,
-            nurse_info.phone,
-        ):
+        """Create a new nurse in the database, or return the ID of the
+        existing nurse with the same name, age and phone"""
+        new_id = ObjectId()
+        nurse_id = upsert_identity(
+            self.client["nursecheck"]["nurses"],
+            nurse_identity(nurse_info),
+            dict(nurse_info.to_dict(), _id=new_id),
+        )
+        if nurse_id != new_id:
             print("Nurse already exists")
-            return self.get_nurse(
-                self.find_nurse(
-                    nurse_info.first_name,
-                    nurse_info.last_name,
-                    nurse_info.age,
-                    nurse_info.phone,
-                )["_id"]
-            )["_id"]
-        else:
-            result = self.client["nursecheck"]["nurses"].insert_one(
-                nurse_info.to_dict()
-            )
-            return result.inserted_id
+        return nurse_id
 
-    def get_nurse(self, nurse_id):
+    def get_nurse(self, nurse_id, projection=None):
         """Get the nurse information from the database"""
         nurse = self.client["nursecheck"]["nurses"].find_one(
-            {"_id": ObjectId(nurse_id)}
+            {"_id": ObjectId(nurse_id)}, projection
         )
         return nurse
 
-    def get_all_nurses(self):
+    def get_all_nurses(self, projection=None):
         """Retrieve all nurses from the database"""
-        nurses = self.client["nursecheck"]["nurses"].find()
+        nurses = self.client["nursecheck"]["nurses"].find({}, projection)
         return [nurse for nurse in nurses]
 
     def delete_nurse(self, nurse_id):
@@ -245,7 +588,7 @@ class System:
         )
         return "Nurse information updated"
 
-    def find_nurse(self, first_name, last_name, age, phone):
+    def find_nurse(self, first_name, last_name, age, phone, projection=None):
         """Find the nurse in the database"""
         nurse = self.client["nursecheck"]["nurses"].find_one(
             {
@@ -253,41 +596,48 @@ class System:
                 "last_name": last_name,
                 "age": age,
                 "phone": phone,
-            }
+            },
+            projection,
         )
         return nurse
 
     def assign_patient_to_nurse(self, patient_id, nurse_id):
         """Assign the patient to a nurse"""
-        patient = self.get_patient(patient_id)
-        patient["assign_nurse_id"] = nurse_id
-        self.client["nursecheck"]["patients"].update_one(
-            {"_id": ObjectId(patient_id)}, {"$set": patient}
-        )
+        self.set_patient_fields(patient_id, {"assign_nurse_id": nurse_id})
         return "Patient assigned to nurse"
 
+    def assign_patients_to_nurse(self, patient_ids, nurse_id):
+        """Assign many patients, e.g. a whole ward, to a nurse in one bulk_write"""
+        return self.bulk_update_patients(
+            [{"patient_id": patient_id, "set": {"assign_nurse_id": nurse_id}} for patient_id in patient_ids]
+        )
+
+    @traced("system.send_email")
     def send_email(self, nurse_id, patient_id):
         """Send an email to the patient"""
-        nurse = self.get_nurse(nurse_id)
-        patient = self.get_patient(patient_id)
+        nurse = self.get_nurse(nurse_id, {"email": 1, "first_name": 1, "last_name": 1})
+        patient = self.get_patient(patient_id, {"first_name": 1, "last_name": 1})
         email = nurse["email"]
+        import resend
+
         resend.api_key = os.getenv("RESEND_API_KEY")
 
         title = "Urgent care alert for nurse {}".format(nurse["first_name"] + " " + nurse["last_name"])
 
-        r = resend.Emails.send(
-            {
-                "from": "onboarding@resend.dev",
-                "to": str(email),
-                "subject": title,
-                "html": """
-                        <html>
-                            <ul>
-                                <li> Patient: {} (ID: {})</li>
-                                <li> Status: Emergent </li>
-                                <li> Action Required: Immediate attention needed. Review patient details promptly and proceed with urgent care protocols. </li>
-                            </ul>
-                        </html>
-                        """.format(patient["first_name"] + " " + patient["last_name"], patient_id),
-            }
-        )
+        with span("resend.send"):
+            r = resend.Emails.send(
+                {
+                    "from": "onboarding@resend.dev",
+                    "to": str(email),
+                    "subject": title,
+                    "html": """
+                            <html>
+                                <ul>
+                                    <li> Patient: {} (ID: {})</li>
+                                    <li> Status: Emergent </li>
+                                    <li> Action Required: Immediate attention needed. Review patient details promptly and proceed with urgent care protocols. </li>
+                                </ul>
+                            </html>
+                            """.format(patient["first_name"] + " " + patient["last_name"], patient_id),
+                }
+            )
@@ -0,0 +1,396 @@
+"""Local pre-triage: a priority from the emotions and words of a chat.
+
+Usage:
+    python3 triage.py evaluate --min-confidence 0.75
+
+The scorer combines the mean Hume emotion scores of the chat with keyword
+rules matched on what the patient said, e.g. "chest pain" or "pain is 8 out
+of 10". It returns a 1-10 priority and a 0-1 confidence in microseconds;
+the priority LLM call is only made when the confidence is below
+TRIAGE_MIN_CONFIDENCE. The weights and rules come from DEFAULT_CONFIG,
+overridden by the JSON file at TRIAGE_CONFIG; every priority stored in a
+record note carries the version of the config that produced it.
+
+`evaluate` replays the scorer on the notes whose priority came from the
+LLM (records.notes[] and their buckets) and reports how well it agrees.
+"""
+import json
+import os
+import re
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from emotions import EMOTION_INDEX, EMOTIONS, note_vector
+from metrics import TRIAGE
+
+Triage = namedtuple("Triage", ["priority", "confidence", "version", "features"])
+
+# Where the priority of a note came from
+LLM = "llm"
+LOCAL = "local"
+
+NUMBER = re.compile(r"\d+(?:\.\d+)?")
+# How an LLM answer states its priority, most explicit first
+SCALE_RANGE = re.compile(r"\b[01]\s*(?:-|–|to)\s*10\b")
+PRIORITY_NUMBER = re.compile(r"priority\b\D{0,30}?(\d+(?:\.\d+)?)", re.IGNORECASE)
+RATING = re.compile(r"(\d+(?:\.\d+)?)\s*(?:/|out of)\s*10\b")
+
+DEFAULT_CONFIG = {
+    "version": "rules-1",
+    # Priority of a calm chat
+    "base": 3.0,
+    # Added to the priority per unit of mean score over the chat
+    "emotion_weights": {
+        "Pain": 8.0, "Distress": 7.0, "Fear": 6.0, "Horror": 6.0, "Anxiety": 5.0,
+        "Empathic Pain": 4.0, "Sadness": 4.0, "Anger": 3.0, "Confusion": 3.0,
+        "Tiredness": 2.0, "Disappointment": 2.0, "Doubt": 1.0,
+        "Calmness": -3.0, "Contentment": -3.0, "Relief": -2.0, "Joy": -2.0,
+        "Satisfaction": -2.0, "Amusement": -1.0,
+    },
+    # Matched on the patient's lines; the highest priority matched wins
+    "rules": [
+        {
+            "name": "critical",
+            "priority": 9,
+            "critical": True,
+            "terms": [
+                "chest pain", "can't breathe", "cannot breathe", "can not breathe", "short of breath",
+                "shortness of breath", "unconscious", "passed out", "fainted", "seizure", "stroke",
+                "suicidal", "kill myself", "coughing up blood", "bleeding a lot", "numb on one side",
+            ],
+        },
+        {
+            "name": "severe",
+            "priority": 7,
+            "terms": [
+                "severe", "unbearable", "worst", "much worse", "getting worse", "fell", "fever",
+                "vomiting", "threw up", "dizzy", "bleeding", "confused", "can't sleep", "swelling",
+            ],
+        },
+        {
+            "name": "moderate",
+            "priority": 5,
+            "terms": [
+                "pain", "hurts", "nausea", "headache", "tired", "anxious", "worried", "cough",
+                "not good", "not well", "not great",
+            ],
+        },
+        {
+            "name": "reassuring",
+            "priority": 2,
+            "terms": ["better", "fine", "good", "no pain", "comfortable", "slept well", "feel great"],
+        },
+    ],
+    # "pain is 8 out of 10", "a 6/10": the rating is the priority
+    "pain_scale": True,
+    # Share of the keyword priority when both sources have one
+    "keyword_weight": 0.6,
+    # Scored messages for full confidence in the emotions
+    "min_events": 3,
+    "emotion_only_confidence": 0.6,
+    "keyword_only_confidence": 0.6,
+    "critical_confidence": 0.95,
+    # A critical term only seen negated ("no chest pain") keeps its priority
+    # but not the confidence, so the LLM decides
+    "negated_critical_confidence": 0.5,
+}
+
+PAIN_SCALE = re.compile(r"\b(10|[0-9])\s*(?:/|out of)\s*10\b")
+# A term right after one of these, in the same clause, does not count
+NEGATION = re.compile(r"\b(?:no|not|without|never|denies|don't|doesn't|didn't)\b(?:\W+\w+){0,2}\W*$")
+# Where the scope of a negation ends: punctuation and clause conjunctions
+CLAUSE_END = re.compile(r"[.!?,;:\n]|\b(?:but|and|or|so|yet|though|although|however|because|except)\b")
+
+
+def load_config(path=None):
+    """DEFAULT_CONFIG overridden by a JSON file, by default TRIAGE_CONFIG"""
+    config = dict(DEFAULT_CONFIG)
+    path = path or os.getenv("TRIAGE_CONFIG")
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    return config
+
+
+def parse_priority(answer):
+    """The 1-10 priority in an LLM answer, e.g. "Priority: 7/10" -> 7. A
+    number after "priority" wins, then a rating such as "8/10", then the
+    last number from 1 to 10; scale ranges such as "1-10" never count.
+
+    Raises:
+        ValueError: If the answer has no number from 1 to 10"""
+    answer = SCALE_RANGE.sub(" ", str(answer))
+    for pattern in (PRIORITY_NUMBER, RATING):
+        for match in pattern.finditer(answer):
+            priority = int(float(match.group(1)) + 0.5)
+            if 1 <= priority <= 10:
+                return priority
+    for match in reversed(list(NUMBER.finditer(answer))):
+        priority = int(float(match.group()) + 0.5)
+        if 1 <= priority <= 10:
+            return priority
+    raise ValueError("No priority in {!r}".format(answer))
+
+
+def matches(pattern, text, negatable=True):
+    """Whether a pattern matches text other than right after a negation in
+    the same clause. Terms that are not negatable always count."""
+    for match in pattern.finditer(text):
+        if not negatable:
+            return True
+        before = CLAUSE_END.split(text[max(0, match.start() - 40):match.start()])[-1]
+        if not NEGATION.search(before):
+            return True
+    return False
+
+
+def patient_text(conversation):
+    """The lowercased lines of the patient in a transcript"""
+    return "\n".join(
+        line[len("Patient:"):] for line in conversation.splitlines() if line.startswith("Patient:")
+    ).lower()
+
+
+class TriageScorer:
+    def __init__(self, config=None):
+        """
+        Args:
+            config (dict): The weights and rules. Defaults to load_config().
+        """
+        self.config = config or load_config()
+        self.version = str(self.config["version"])
+        self.weights = np.zeros(len(EMOTIONS), dtype=np.float32)
+        for emotion, weight in self.config["emotion_weights"].items():
+            self.weights[EMOTION_INDEX[emotion]] = weight
+        # One alternation per rule, longest terms first
+        self.rules = [
+            (
+                rule["name"],
+                rule["priority"],
+                rule.get("critical", False),
+                re.compile(r"\b(?:{})\b".format(
+                    "|".join(re.escape(term) for term in sorted(rule["terms"], key=len, reverse=True))
+                )),
+            )
+            for rule in self.config["rules"]
+        ]
+
+    def score(self, conversation, vector, events):
+        """Score a chat
+
+        Args:
+            conversation (str): The transcript, "Patient: ..." and "Nurse: ..." lines
+            vector: The summed emotion scores of the chat (EMOTIONS order)
+            events (int): The number of scored messages the vector sums
+
+        Returns:
+            Triage: The priority, its confidence, the config version and the
+                features it was computed from"""
+        config = self.config
+        text = patient_text(conversation)
+        # A negated critical term ("no chest pain") still raises the
+        # priority, but is not trusted without the LLM
+        matched = []
+        negated_critical = False
+        for name, priority, critical, pattern in self.rules:
+            if matches(pattern, text, negatable=not critical):
+                matched.append((name, priority, critical))
+                negated_critical = negated_critical or (critical and not matches(pattern, text))
+        keyword = max((priority for _, priority, _ in matched), default=None)
+        critical = any(critical for _, _, critical in matched)
+        if config["pain_scale"]:
+            ratings = [int(rating) for rating in PAIN_SCALE.findall(text)]
+            if ratings:
+                matched.append(("pain_scale", max(ratings), False))
+                # A reported rating is more precise than the pain keywords
+                if not critical:
+                    keyword = max(ratings)
+
+        emotion = None
+        if events:
+            means = np.asarray(vector, dtype=np.float32) / events
+            emotion = min(10.0, max(1.0, config["base"] + float(means @ self.weights)))
+
+        coverage = min(1.0, events / config["min_events"])
+        if emotion is None and keyword is None:
+            priority, confidence = config["base"], 0.0
+        elif keyword is None:
+            priority, confidence = emotion, config["emotion_only_confidence"] * coverage
+        elif emotion is None:
+            priority, confidence = keyword, config["keyword_only_confidence"]
+        else:
+            weight = config["keyword_weight"]
+            priority = weight * keyword + (1 - weight) * emotion
+            # Sources that disagree are left to the LLM
+            agreement = 1 - abs(keyword - emotion) / 9
+            confidence = agreement * (0.5 + 0.5 * coverage)
+        if critical:
+            priority = max(priority, keyword)
+            if negated_critical:
+                confidence = min(confidence, config["negated_critical_confidence"])
+            else:
+                confidence = max(confidence, config["critical_confidence"])
+
+        return Triage(
+            min(10, max(1, int(priority + 0.5))),
+            round(confidence, 3),
+            self.version,
+            {
+                "emotion_priority": None if emotion is None else round(emotion, 2),
+                "keyword_priority": keyword,
+                "rules": [name for name, _, _ in matched],
+                "negated_critical": negated_critical,
+                "events": events,
+            },
+        )
+
+    def score_chat(self, conversation, emotions):
+        """Score a transcript and its EmotionMatrix"""
+        return self.score(conversation, emotions.sums(), len(emotions))
+
+
+def min_confidence():
+    return float(os.getenv("TRIAGE_MIN_CONFIDENCE", "0.75"))
+
+
+def needs_llm(triage):
+    """Whether to ask the LLM for the priority: TRIAGE_MODE "llm" always,
+    "local" never, "hybrid" (default) when the scorer is not confident"""
+    mode = os.getenv("TRIAGE_MODE", "hybrid")
+    if mode == "llm" or triage is None:
+        return True
+    if mode == "local":
+        return False
+    return triage.confidence < min_confidence()
+
+
+def resolve_priority(answer, triage=None):
+    """The priority of a chat from the LLM answer, or the local triage when
+    the LLM was skipped or answered without a priority
+
+    Returns:
+        tuple: (priority, source), source being "llm" or "local:<version>"
+
+    Raises:
+        ValueError: If the answer has no priority and there is no triage"""
+    if answer is not None:
+        try:
+            priority = parse_priority(answer)
+            TRIAGE.inc(LLM)
+            return priority, LLM
+        except ValueError as e:
+            if triage is None:
+                raise
+            print("Using the local priority: {}".format(e))
+            TRIAGE.inc("fallback")
+    else:
+        TRIAGE.inc(LOCAL)
+    return triage.priority, "{}:{}".format(LOCAL, triage.version)
+
+
+def triage_fields(source, triage=None):
+    """The fields a record note keeps about its priority, for evaluate()"""
+    fields = {"priority_source": source}
+    if triage is not None:
+        fields.update(
+            triage_priority=triage.priority, triage_confidence=triage.confidence, triage_version=triage.version
+        )
+    return fields
+
+
+_scorer = None
+_scorer_lock = threading.Lock()
+
+
+def get_scorer():
+    """Return the process-wide scorer, configured from TRIAGE_CONFIG"""
+    global _scorer
+    if _scorer is None:
+        with _scorer_lock:
+            if _scorer is None:
+                _scorer = TriageScorer()
+    return _scorer
+
+
+def note_events(note):
+    """The scored messages of a stored note. Old notes only kept their top
+    emotions, counted as one message."""
+    if "emotion_events" in note:
+        return note["emotion_events"]
+    return 1 if note.get("emotions") else 0
+
+
+def evaluate(notes, scorer, threshold=None):
+    """Compare the scorer with the LLM priorities of stored notes
+
+    Args:
+        notes (iterable): Record notes, e.g. from note_history.iter_all_notes
+        scorer (TriageScorer): The scorer to evaluate
+        threshold (float): The confidence to skip the LLM at. Defaults to
+            TRIAGE_MIN_CONFIDENCE.
+
+    Returns:
+        dict: The number of notes compared, the mean absolute error, exact
+            and off-by-one agreement, overall and on the notes confident
+            enough to skip the LLM, and how many of those there are"""
+    threshold = min_confidence() if threshold is None else threshold
+    errors = []
+    confident = []
+    for note in notes:
+        if note.get("priority") is None or not note.get("content"):
+            continue
+        # Local priorities would be compared with themselves
+        if note.get("priority_source", LLM) != LLM:
+            continue
+        try:
+            expected = parse_priority(note["priority"])
+        except ValueError:
+            continue
+        triage = scorer.score(note["content"], note_vector(note), note_events(note))
+        error = abs(triage.priority - expected)
+        errors.append(error)
+        if triage.confidence >= threshold:
+            confident.append(error)
+
+    def agreement(values):
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return {"mae": None, "exact": None, "within_1": None}
+        return {
+            "mae": round(float(values.mean()), 3),
+            "exact": round(float((values == 0).mean()), 3),
+            "within_1": round(float((values <= 1).mean()), 3),
+        }
+
+    return {
+        "version": scorer.version,
+        "min_confidence": threshold,
+        "notes": len(errors),
+        "all": agreement(errors),
+        "confident": dict(agreement(confident), notes=len(confident)),
+        "llm_calls_avoided": round(len(confident) / len(errors), 3) if errors else None,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from db import get_client
+    from note_history import iter_all_notes
+
+    parser = argparse.ArgumentParser(description="Evaluate the local triage scorer")
+    parser.add_argument("command", choices=["evaluate"])
+    parser.add_argument("--config", help="A JSON config to evaluate. Defaults to TRIAGE_CONFIG.")
+    parser.add_argument("--min-confidence", type=float, help="Defaults to TRIAGE_MIN_CONFIDENCE")
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    fields = ["content", "priority", "priority_source", "emotion_vector", "emotions", "emotion_events"]
+    notes = (note for _, note in iter_all_notes(get_client()["nursecheck"], fields))
+    report = evaluate(notes, TriageScorer(load_config(args.config)), args.min_confidence)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
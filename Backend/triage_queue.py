@@ -0,0 +1,148 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from env import load_env
+
+REMOVED = "<removed>"
+
+
+def order_value(order):
+    """Coerce a stored order (int, float or legacy string such as "10") to an int"""
+    try:
+        return int(float(order))
+    except (TypeError, ValueError):
+        return 0
+
+
+class TriageQueue:
+    """Per-nurse priority queues of the patients waiting to be processed.
+
+    Each nurse has a heap of [-order, sequence, patient_id] entries, so the
+    highest order comes first and ties are served first come, first served.
+    Updates mark the old entry as removed and push a new one (the lazy
+    deletion recipe from the heapq docs); the heap is rebuilt once stale
+    entries outnumber live ones. Reading the top N of a nurse only touches
+    that nurse's heap, whatever the size of the hospital."""
+
+    def __init__(self, max_age=None):
+        """
+        Args:
+            max_age (float): Resync a nurse from the database after this many
+                seconds, to pick up writes made by other processes.
+                Defaults to TRIAGE_QUEUE_MAX_AGE.
+        """
+        if max_age is None:
+            max_age = float(os.getenv("TRIAGE_QUEUE_MAX_AGE", "60"))
+        self.max_age = max_age
+        self.heaps = {}
+        self.entries = {}
+        self.stale = {}
+        self.loaded_at = {}
+        self.counter = itertools.count()
+        self.lock = threading.RLock()
+
+    def update(self, patient_id, nurse_id, order, processed=False):
+        """Insert or move a patient. Processed or unassigned patients leave the queue.
+
+        Args:
+            patient_id (str): The patient ID
+            nurse_id (str): The assigned nurse ID
+            order (int): The patient priority, higher first
+            processed (bool): Whether the patient has been processed"""
+        patient_id = str(patient_id)
+        with self.lock:
+            self._remove(patient_id)
+            if not nurse_id or processed:
+                return
+            nurse_id = str(nurse_id)
+            entry = [-order_value(order), next(self.counter), patient_id]
+            self.entries[patient_id] = (nurse_id, entry)
+            heapq.heappush(self.heaps.setdefault(nurse_id, []), entry)
+
+    def remove(self, patient_id):
+        """Remove a patient from the queue"""
+        with self.lock:
+            self._remove(str(patient_id))
+
+    def _remove(self, patient_id):
+        nurse_id, entry = self.entries.pop(patient_id, (None, None))
+        if entry is None:
+            return
+        entry[-1] = REMOVED
+        heap = self.heaps[nurse_id]
+        self.stale[nurse_id] = self.stale.get(nurse_id, 0) + 1
+        if self.stale[nurse_id] * 2 > len(heap):
+            heap[:] = [e for e in heap if e[-1] is not REMOVED]
+            heapq.heapify(heap)
+            self.stale[nurse_id] = 0
+
+    def top(self, nurse_id, n=None):
+        """Return the highest priority patients of a nurse
+
+        Args:
+            nurse_id (str): The nurse ID
+            n (int): The number of patients, or None for all of them
+
+        Returns:
+            list: (patient_id, order) tuples, highest order first"""
+        with self.lock:
+            live = [e for e in self.heaps.get(str(nurse_id), []) if e[-1] is not REMOVED]
+            entries = sorted(live) if n is None else heapq.nsmallest(n, live)
+        return [(patient_id, -negative_order) for negative_order, _, patient_id in entries]
+
+    def is_loaded(self, nurse_id):
+        loaded_at = self.loaded_at.get(str(nurse_id))
+        return loaded_at is not None and time.monotonic() - loaded_at <= self.max_age
+
+    def resync(self, collection, nurse_id=None):
+        """Rebuild the queue of one nurse, or of every nurse, from the database
+
+        Args:
+            collection: The MongoDB patients collection
+            nurse_id (str): The nurse to rebuild. Rebuilds everyone if None."""
+        query = {"process": {"$ne": True}}
+        if nurse_id is None:
+            query["assign_nurse_id"] = {"$nin": [None, ""]}
+        else:
+            query["assign_nurse_id"] = str(nurse_id)
+        patients = list(collection.find(query, {"assign_nurse_id": 1, "order": 1}))
+        now = time.monotonic()
+        with self.lock:
+            if nurse_id is None:
+                self.heaps.clear()
+                self.entries.clear()
+                self.stale.clear()
+                self.loaded_at.clear()
+            else:
+                for patient_id, _ in self.top(nurse_id):
+                    self._remove(patient_id)
+            for patient in patients:
+                self.update(patient["_id"], patient["assign_nurse_id"], patient.get("order"))
+                self.loaded_at[str(patient["assign_nurse_id"])] = now
+            if nurse_id is not None:
+                self.loaded_at[str(nurse_id)] = now
+        return len(patients)
+
+    def ensure_loaded(self, collection, nurse_id):
+        """Load a nurse's queue from the database on first use or once it is older than max_age"""
+        if not self.is_loaded(nurse_id):
+            self.resync(collection, nurse_id)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_triage_queue():
+    """Return the queue shared by every System in the process. It is built
+    on first use, once .env has been loaded, so TRIAGE_QUEUE_MAX_AGE applies."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                load_env()
+                _queue = TriageQueue()
+    return _queue
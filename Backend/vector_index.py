@@ -0,0 +1,382 @@
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+
+from note_history import iter_all_notes
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vector_index", "patient_notes")
+
+
+@lru_cache(maxsize=65536)
+def _bucket(feature, dim):
+    """Map a feature to a (column, sign) pair. blake2b keeps this stable
+    across processes, unlike the salted builtin hash()."""
+    digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+    return digest % dim, 1.0 if digest >> 63 == 0 else -1.0
+
+
+class HashingVectorizer:
+    """Deterministic, stateless text vectorizer (signed feature hashing of
+    words and word bigrams with sublinear term frequency)."""
+
+    def __init__(self, dim=512):
+        self.dim = dim
+
+    def features(self, text):
+        words = TOKEN_PATTERN.findall((text or "").lower())
+        return words + [a + " " + b for a, b in zip(words, words[1:])]
+
+    def transform(self, text):
+        """Embed a text into an L2-normalized float32 vector"""
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, count in Counter(self.features(text)).items():
+            column, sign = _bucket(feature, self.dim)
+            vector[column] += sign * (1.0 + math.log(count))
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+
+class VectorIndex:
+    """Append-only, memory-mapped float32 matrix of note vectors.
+
+    Layout on disk:
+        <path>.keys          JSON lines. The first line is a header with the
+                             generation, the dimension and whether the index
+                             was ever built from the database (rebuild()),
+                             every other line maps a key (e.g.
+                             "patient:<id>") to a matrix row.
+        <path>.<gen>.f32     Raw float32 rows, one per embedded text.
+
+    Updates append a new row and a new key line; the latest line for a key
+    wins, so superseded and deleted rows stay in the file until compact()
+    rewrites the live rows into the next generation. Readers never lock:
+    they memory-map the matrix read-only, so several processes share the
+    same pages through the page cache, and pick up appended lines on the
+    next query."""
+
+    def __init__(self, path=DEFAULT_PATH, dim=512):
+        self.path = path
+        self.vectorizer = HashingVectorizer(dim)
+        self.dim = dim
+        self.lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._keys_stat = None
+        self._offset = 0
+        self._generation = None
+        self._built = False
+        self._matrix = None
+        self._rows = 0
+        self._entries = {}
+        self._meta = []
+
+    @property
+    def keys_path(self):
+        return self.path + ".keys"
+
+    def _vectors_path(self, generation):
+        return "{}.{}.f32".format(self.path, generation)
+
+    # ------------------------------------------------------------------ writes
+
+    def _file_lock(self):
+        return _FileLock(self.path + ".lock")
+
+    def _ensure_files(self):
+        if os.path.exists(self.keys_path):
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._write_generation(0, [], np.zeros((0, self.dim), dtype=np.float32))
+
+    def _write_generation(self, generation, entries, matrix, built=False):
+        vectors_path = self._vectors_path(generation)
+        with open(vectors_path, "wb") as f:
+            f.write(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_path = self.keys_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({"generation": generation, "dim": self.dim, "built": built}) + "\n")
+            for row, entry in enumerate(entries):
+                f.write(json.dumps(dict(entry, row=row)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.keys_path)
+
+    def _read_header(self):
+        with open(self.keys_path) as f:
+            return json.loads(f.readline())
+
+    def upsert(self, key, patient_id, text, kind="patient"):
+        """Embed a text and append it to the index, replacing any older
+        vector stored under the same key
+
+        Args:
+            key (str): Unique key of the text, e.g. "patient:<id>"
+            patient_id (str): The patient the text belongs to
+            text (str): The text to embed
+            kind (str): "patient" for patient notes, "note" for record notes"""
+        vector = self.vectorizer.transform(text)
+        entry = {"key": key, "patient_id": str(patient_id), "kind": kind, "text": (text or "")[:200]}
+        with self.lock, self._file_lock():
+            self._ensure_files()
+            header = self._read_header()
+            vectors_path = self._vectors_path(header["generation"])
+            with open(vectors_path, "ab") as f:
+                row_bytes = self.dim * 4
+                size = f.seek(0, os.SEEK_END)
+                if size % row_bytes:
+                    # Drop a row left half-written by a crashed writer
+                    f.truncate(size - size % row_bytes)
+                    size -= size % row_bytes
+                f.write(vector.tobytes())
+            entry["row"] = size // row_bytes
+            with open(self.keys_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def delete(self, key):
+        """Remove the vector stored under a key"""
+        with self.lock, self._file_lock():
+            self._ensure_files()
+            with open(self.keys_path, "a") as f:
+                f.write(json.dumps({"key": key, "deleted": True}) + "\n")
+
+    def compact(self):
+        """Rewrite the live rows into a new generation, dropping superseded
+        and deleted vectors
+
+        Returns:
+            int: The number of live vectors kept"""
+        with self.lock, self._file_lock():
+            self._ensure_files()
+            self.refresh()
+            rows = [entry["row"] for entry in self._entries.values()]
+            entries = [{k: v for k, v in entry.items() if k != "row"} for entry in self._entries.values()]
+            if rows:
+                matrix = np.array(self._matrix[rows], dtype=np.float32)
+            else:
+                matrix = np.zeros((0, self.dim), dtype=np.float32)
+            old_generation = self._generation
+            self._write_generation(old_generation + 1, entries, matrix, self._built)
+            # Readers that still map the old file keep it alive until they refresh
+            os.remove(self._vectors_path(old_generation))
+            self.refresh()
+            return len(entries)
+
+    def rebuild(self, documents):
+        """Replace the whole index with freshly embedded documents
+
+        Args:
+            documents (iterable): (key, patient_id, text, kind) tuples"""
+        entries = []
+        vectors = []
+        for key, patient_id, text, kind in documents:
+            entries.append({"key": key, "patient_id": str(patient_id), "kind": kind, "text": (text or "")[:200]})
+            vectors.append(self.vectorizer.transform(text))
+        matrix = np.vstack(vectors) if vectors else np.zeros((0, self.dim), dtype=np.float32)
+        with self.lock, self._file_lock():
+            self._ensure_files()
+            old_generation = self._read_header()["generation"]
+            self._write_generation(old_generation + 1, entries, matrix, built=True)
+            os.remove(self._vectors_path(old_generation))
+            self.refresh()
+        return len(entries)
+
+    # ------------------------------------------------------------------- reads
+
+    def refresh(self):
+        """Pick up key lines and rows appended by any process since the
+        last refresh, or reload everything after a compaction"""
+        with self.lock:
+            try:
+                stat = os.stat(self.keys_path)
+            except FileNotFoundError:
+                self._reset()
+                return
+            if self._keys_stat and self._keys_stat[0] != stat.st_ino:
+                self._reset()
+            if self._keys_stat == (stat.st_ino, stat.st_size):
+                return
+            with open(self.keys_path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                self._apply(json.loads(line))
+            self._offset += end
+            self._keys_stat = (stat.st_ino, self._offset)
+            self._map_vectors()
+
+    def _apply(self, entry):
+        if "generation" in entry:
+            self._generation = entry["generation"]
+            self._built = entry.get("built", False)
+            if entry["dim"] != self.dim:
+                raise ValueError("Index dimension {} does not match {}".format(entry["dim"], self.dim))
+        elif entry.get("deleted"):
+            self._entries.pop(entry["key"], None)
+        else:
+            self._entries[entry["key"]] = entry
+
+    def _map_vectors(self):
+        vectors_path = self._vectors_path(self._generation)
+        rows = os.path.getsize(vectors_path) // (self.dim * 4)
+        if rows != self._rows or self._matrix is None:
+            self._rows = rows
+            self._matrix = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else None
+        live = sorted(self._entries.values(), key=lambda entry: entry["row"])
+        self._meta = live
+        self._live_rows = np.fromiter((entry["row"] for entry in live), dtype=np.int64, count=len(live))
+
+    def __len__(self):
+        self.refresh()
+        return len(self._entries)
+
+    def is_built(self):
+        """Check if the index was ever built from the database by rebuild().
+        Upserts alone do not count: they only cover the texts written since."""
+        self.refresh()
+        return self._built
+
+    def get(self, key):
+        """Return the stored vector of a key, or None"""
+        self.refresh()
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return np.array(self._matrix[entry["row"]])
+
+    def query(self, text=None, vector=None, k=10, exclude_patient_id=None, min_score=0.0):
+        """Find the texts closest to a query by cosine similarity
+
+        Args:
+            text (str): The query text, embedded with the index vectorizer
+            vector (np.ndarray): A query vector, used instead of text
+            k (int): The maximum number of patients to return
+            exclude_patient_id (str): A patient to leave out of the results
+            min_score (float): Only return matches scoring above this
+
+        Returns:
+            list: dicts with patient_id, key, kind, text and score, best
+            match first, at most one per patient"""
+        self.refresh()
+        if vector is None:
+            vector = self.vectorizer.transform(text)
+        if self._matrix is None or not len(self._meta):
+            return []
+        # Rows are unit length, so one mat-vec product gives every cosine
+        scores = self._matrix @ np.asarray(vector, dtype=np.float32)
+        live_scores = scores[self._live_rows]
+        exclude = str(exclude_patient_id) if exclude_patient_id is not None else None
+        results = []
+        seen = set()
+        for order in self._ranked(live_scores, k * 8):
+            if live_scores[order] <= min_score:
+                break
+            entry = self._meta[order]
+            patient_id = entry["patient_id"]
+            if patient_id == exclude or patient_id in seen:
+                continue
+            seen.add(patient_id)
+            results.append(dict(entry, score=float(live_scores[order])))
+            if len(results) == k:
+                break
+        return results
+
+    @staticmethod
+    def _ranked(scores, candidates):
+        if candidates < len(scores):
+            top = np.argpartition(-scores, candidates)[:candidates]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            yield from top
+            # Only reached when the candidates collapse onto too few patients
+            seen = set(top.tolist())
+            yield from (i for i in np.argsort(-scores, kind="stable") if i not in seen)
+        else:
+            yield from np.argsort(-scores, kind="stable")
+
+
+class _FileLock:
+    """Exclusive advisory lock serializing writers across processes"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.file = open(self.path, "a")
+        if fcntl:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def patient_key(patient_id):
+    return "patient:{}".format(patient_id)
+
+
+def note_key(patient_id, timestamp):
+    return "note:{}:{}".format(patient_id, timestamp)
+
+
+def iter_documents(db):
+    """Yield every patient note and record note of the database as
+    (key, patient_id, text, kind) tuples"""
+    for patient in db["patients"].find({"note": {"$nin": [None, ""]}}, {"note": 1}):
+        yield patient_key(patient["_id"]), patient["_id"], patient["note"], "patient"
+    for patient_id, note in iter_all_notes(db, ["note", "timestamp"]):
+        if note.get("note"):
+            yield note_key(patient_id, note.get("timestamp")), patient_id, note["note"], "note"
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_vector_index():
+    """Return the process-wide vector index stored at VECTOR_INDEX_PATH"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = VectorIndex(
+                    os.getenv("VECTOR_INDEX_PATH", DEFAULT_PATH),
+                    int(os.getenv("VECTOR_INDEX_DIM", "512")),
+                )
+    return _index
+
+
+if __name__ == "__main__":
+    import argparse
+    from db import get_client
+    parser = argparse.ArgumentParser(description="Maintain the patient note vector index")
+    parser.add_argument("command", choices=["rebuild", "compact"])
+    args = parser.parse_args()
+
+    index = get_vector_index()
+    if args.command == "rebuild":
+        db = get_client()["nursecheck"]
+        print("Indexed {} notes".format(index.rebuild(iter_documents(db))))
+    else:
+        print("Kept {} live vectors".format(index.compact()))
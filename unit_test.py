@@ -3,6 +3,14 @@ from system import System
 from objects import Patient, Nurse
 import pytest
 from bson import ObjectId
+from contextlib import contextmanager
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import json
+import os
+import threading
+import time
 
 
 def test_ping_database():
@@ -55,5 +63,1176 @@ def test_create_patient():
     assert isinstance(patient_id, ObjectId)
 
 
+def mongo_client(monkeypatch=None):
+    """An in-memory stand-in for MongoDB. With monkeypatch, the shared client
+    of db.get_client, and so System(), is this one too."""
+    import mongomock
+
+    client = mongomock.MongoClient()
+    if monkeypatch is not None:
+        import db
+
+        monkeypatch.setattr(db, "MongoClient", lambda *args, **kwargs: client)
+        monkeypatch.setattr(db, "_clients", {})
+    return client
+
+
+@contextmanager
+def local_server(handler):
+    """Serve a stand-in for an HTTP API on a free local port
+
+    Yields:
+        str: The base URL of the server"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield "http://127.0.0.1:{}".format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def import_with_dotenv(code, **settings):
+    """Run code in a fresh interpreter where .env holds settings
+
+    Returns:
+        str: What the code printed"""
+    import subprocess
+    import sys
+
+    fake_dotenv = (
+        "import dotenv, os\n"
+        "dotenv.load_dotenv = lambda *args, **kwargs: os.environ.update({!r}) or True\n".format(settings)
+    )
+    return subprocess.run(
+        [sys.executable, "-c", fake_dotenv + code],
+        cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), "Backend"),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.strip()
+
+
+class FakeCollection:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find_one(self, *args, **kwargs):
+        return self.documents[0] if self.documents else None
+
+    def find(self, *args, **kwargs):
+        return FakeCursor(self.documents)
+
+    def aggregate(self, pipeline):
+        return iter(self.documents)
+
+    def insert_one(self, document):
+        self.documents.append(document)
+        return SimpleNamespace(inserted_id=ObjectId())
+
+    def update_one(self, *args, **kwargs):
+        return SimpleNamespace(modified_count=1)
+
+    def find_one_and_update(self, *args, **kwargs):
+        return self.find_one()
+
+    def create_index(self, keys, **kwargs):
+        return kwargs.get("name")
+
+
+class FakeCursor(list):
+    def sort(self, *args, **kwargs):
+        return self
+
+
+class CountingMongoClient:
+    """Stands in for pymongo.MongoClient and counts how many are opened"""
+
+    opened = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingMongoClient.opened += 1
+        patient = {
+            "_id": PATIENT_ID,
+            "first_name": "Alex",
+            "last_name": "Doan",
+            "age": 27,
+            "dob": "01/01/1996",
+            "gender": "female",
+            "weight": 180,
+            "blood_type": "O+",
+            "note": "",
+            "assign_nurse_id": str(ObjectId()),
+        }
+        self.collections = {
+            "patients": FakeCollection([patient]),
+            "records": FakeCollection([]),
+            "record_notes": FakeCollection([]),
+            "documents": FakeCollection([]),
+        }
+
+    def __getitem__(self, name):
+        return self if name == "nursecheck" else self.collections[name]
+
+
+class FakeOpenAI:
+    def __init__(self, *args, **kwargs):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages):
+        prompt = messages[0]["content"]
+        if prompt.startswith("From these emotion"):
+            content = "True"
+        elif prompt.startswith("Process the priority"):
+            content = "4"
+        else:
+            content = "Patient reports mild headache."
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+PATIENT_ID = ObjectId()
+
+
+def use_fake_pipeline(monkeypatch, tmp_path, render_delay=0):
+    """Run the conversation pipeline against fakes
+
+    Returns:
+        tuple: (chat module, render service, alert dispatcher, sent emails)"""
+    import alerts
+    import chat
+    import db
+    from emotions import EmotionMatrix
+    import llm
+    import render_service
+    import vector_index
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "records").mkdir()
+    monkeypatch.setattr(db, "MongoClient", CountingMongoClient)
+    monkeypatch.setattr(db, "_clients", {})
+    monkeypatch.setattr(CountingMongoClient, "opened", 0)
+    monkeypatch.setattr(llm, "_client", FakeOpenAI())
+    monkeypatch.setattr(vector_index, "_index", vector_index.VectorIndex(str(tmp_path / "vectors")))
+    monkeypatch.setattr(llm, "_cache", llm.LLMCache(str(tmp_path / "llm_cache.sqlite3")))
+    # Render on a thread of this process so the renderer sees the fake client
+    renders = render_service.RenderService(workers=0, delay=render_delay)
+    monkeypatch.setattr(render_service, "_service", renders)
+    sent = []
+    # Not started: the pipeline only queues the alert
+    dispatcher = alerts.AlertDispatcher(
+        str(tmp_path / "alerts.sqlite3"), window=60, sender=sent.append,
+        nurse_lookup=lambda nurse_id: {"email": "nurse@example.com", "first_name": "Ann", "last_name": "Lee"},
+    )
+    monkeypatch.setattr(alerts, "_dispatcher", dispatcher)
+    monkeypatch.setattr(chat.Chat, "get_latest_chat_id", lambda self: "chat-1")
+    monkeypatch.setattr(
+        chat.Chat,
+        "list_chat_messages",
+        lambda self, chat_id: {
+            "conversation": [
+                {"role": "ASSISTANT", "message": "How are you feeling?"},
+                {"role": "USER", "message": "I have a mild headache."},
+            ],
+            "emotions": EmotionMatrix.from_events([{"emotion_features": {"Calmness": 0.6, "Pain": 0.3}}]),
+        },
+    )
+    return chat, renders, dispatcher, sent
+
+
+def test_inverted_index_finds_patients_sharing_note_tokens(monkeypatch):
+    import search_index
+
+    patients = mongo_client()["nursecheck"]["patients"]
+    a, b, c, d = patients.insert_many([
+        {"note": "chest pain and fever"},
+        {"note": "fever and chest pain after surgery"},
+        {"note": "mild fever"},
+        {},
+    ]).inserted_ids
+    index = search_index.InvertedIndex()
+    assert index.is_stale(None)
+    index.build(patients)
+    assert len(index) == 4 and a in index and not index.is_stale(300)
+
+    assert index.search(a) == [(str(b), 4), (str(c), 1)]
+    assert index.search(a, k=1) == [(str(b), 4)]
+    assert index.search(a, min_score=2) == [(str(b), 4)]
+    assert index.search(d) == [] and index.search(ObjectId()) == []
+    assert index.search_tokens({"fever"}, exclude=str(c)) == [(str(b), 1), (str(a), 1)]
+
+    # Updates and removals only touch the postings of the changed tokens
+    index.update(c, "chest pain")
+    assert index.search(a) == [(str(b), 4), (str(c), 2)]
+    assert "mild" not in index.postings
+    index.remove(b)
+    assert index.search(a) == [(str(c), 2)] and "surgery" not in index.postings
+
+    # The shared index is built once, and again only when older than max_age
+    shared = search_index.InvertedIndex()
+    monkeypatch.setattr(search_index, "patient_index", shared)
+    assert search_index.get_patient_index(patients, max_age=300) is shared and len(shared) == 4
+    patients.insert_one({"note": "fever"})
+    assert len(search_index.get_patient_index(patients, max_age=300)) == 4
+    shared.built_at -= 301
+    assert len(search_index.get_patient_index(patients, max_age=300)) == 5
+
+
+def test_vector_index_returns_top_k_patients_by_cosine(tmp_path):
+    import numpy as np
+    from vector_index import VectorIndex, note_key, patient_key
+
+    index = VectorIndex(str(tmp_path / "notes"), dim=256)
+    notes = {
+        "p1": "crushing chest pain radiating to the left arm",
+        "p2": "chest pain when breathing deeply",
+        "p3": "sprained ankle after a fall",
+        "p4": "mild headache and nausea",
+    }
+    for patient_id, note in notes.items():
+        index.upsert(patient_key(patient_id), patient_id, note)
+    index.upsert(note_key("p2", 1), "p2", "chest pain again today", kind="note")
+
+    query = "chest pain in the left arm"
+    vector = index.vectorizer.transform(query)
+    expected = sorted(
+        ((float(index.vectorizer.transform(note) @ vector), patient_id) for patient_id, note in notes.items()),
+        reverse=True,
+    )
+    results = index.query(query, k=2)
+    assert [result["patient_id"] for result in results] == [patient_id for _, patient_id in expected[:2]]
+    assert results[0]["score"] == pytest.approx(expected[0][0], abs=1e-5)
+    assert results[0]["score"] >= results[1]["score"]
+    # One result per patient, the excluded one left out, nothing unrelated
+    assert len({result["patient_id"] for result in index.query(query, k=10)}) == len(index.query(query, k=10))
+    assert "p1" not in [result["patient_id"] for result in index.query(query, exclude_patient_id="p1")]
+    assert [result["patient_id"] for result in index.query(query, min_score=0.2)] == ["p1", "p2"]
+
+    # Another process's reader picks up appends, replacements and deletes
+    reader = VectorIndex(str(tmp_path / "notes"), dim=256)
+    assert len(reader) == 5
+    # Upserts alone do not make a built index
+    assert not reader.is_built()
+    index.upsert(patient_key("p3"), "p3", "chest pain radiating to the left arm")
+    index.delete(patient_key("p1"))
+    assert reader.query(query, k=1)[0]["patient_id"] == "p3"
+    assert reader.get(patient_key("p1")) is None
+    assert np.allclose(reader.get(patient_key("p4")), index.vectorizer.transform(notes["p4"]))
+
+    assert index.compact() == 4 and not index.is_built()
+    assert reader.query(query, k=1)[0]["patient_id"] == "p3" and len(reader) == 4
+    assert index.rebuild([(patient_key("p9"), "p9", "chest pain", "patient")]) == 1
+    assert [result["patient_id"] for result in reader.query(query)] == ["p9"]
+    assert reader.is_built() and index.compact() == 1 and reader.is_built()
+    with pytest.raises(ValueError):
+        len(VectorIndex(str(tmp_path / "notes"), dim=128))
+
+
+def test_indexes_bootstrap_once_and_conversations_are_read_server_side():
+    import indexes
+
+    client = mongo_client()
+    db = client["nursecheck"]
+    names = indexes.ensure_indexes(db, force=True)
+    assert set(names) == {options["name"] for specs in indexes.INDEXES.values() for _, options in specs}
+    assert "patient_timestamp" in db["documents"].index_information()
+    # Checked once per process unless forced
+    assert indexes.ensure_indexes(db) == []
+
+    system = System(client=client)
+    patient_id, other_id = ObjectId(), ObjectId()
+    db["documents"].insert_many([
+        {"patient_id": patient_id, "timestamp": 2, "content": "second"},
+        {"patient_id": patient_id, "timestamp": 1, "content": "first"},
+        {"patient_id": patient_id, "timestamp": 3, "content": "third"},
+        {"patient_id": other_id, "timestamp": 9, "content": "other"},
+    ])
+    oldest_first = system.retrieve_conversations(str(patient_id), {"content": 1, "_id": 0})
+    assert oldest_first == [{"content": "first"}, {"content": "second"}, {"content": "third"}]
+    assert system.retrieve_conversations(str(patient_id), {"content": 1, "_id": 0}, limit=1) == [{"content": "first"}]
+    assert system.get_latest_conversation(str(patient_id), {"content": 1, "_id": 0}) == {"content": "third"}
+    assert system.get_latest_conversation(str(ObjectId())) is None
+    assert len(system.get_all_documents({"_id": 1})) == 4
+
+
+def test_pipeline_opens_one_mongo_client(monkeypatch, tmp_path):
+    chat, renders, dispatcher, sent = use_fake_pipeline(monkeypatch, tmp_path)
+
+    chat.Chat(str(PATIENT_ID)).process_conversation()
+    assert renders.wait(PATIENT_ID, timeout=30)
+
+    # Chat, System, Record and PDF all share the process-wide client
+    assert CountingMongoClient.opened == 1
+    assert renders.status(PATIENT_ID)["state"] == "fresh"
+    assert dispatcher.counts() == {"pending": 1}
+    assert sent == []
+
+
+def test_llm_stages_share_a_client_and_cancel_on_timeout(monkeypatch, tmp_path):
+    import asyncio
+    import chat
+    import llm
+
+    monkeypatch.setattr(llm, "_cache", llm.LLMCache(str(tmp_path / "llm_cache.sqlite3")))
+    cancelled = []
+
+    async def slow_stage():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append("slow")
+            raise
+
+    async def timed_out_stage():
+        await asyncio.wait_for(asyncio.sleep(10), timeout=0.01)
+
+    async def run():
+        assert llm.get_async_llm_client() is llm.get_async_llm_client()
+        started = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            await chat.gather_or_cancel([slow_stage(), timed_out_stage()])
+        assert time.monotonic() - started < 5
+        await llm.close_async_llm_client()
+        assert await chat.gather_or_cancel([asyncio.sleep(0, "a"), asyncio.sleep(0, "b")]) == ["a", "b"]
+
+    asyncio.run(run())
+    assert cancelled == ["slow"]
+
+
+def test_llm_cache_serves_repeats_and_evicts(monkeypatch, tmp_path):
+    import llm
+
+    clock = [1000.0]
+    monkeypatch.setattr(llm.time, "time", lambda: clock[0])
+    path = str(tmp_path / "llm_cache.sqlite3")
+    cache = llm.LLMCache(path, ttl=60, max_entries=2, memory_entries=1)
+    monkeypatch.setattr(llm, "_cache", cache)
+    calls = []
+    client = FakeOpenAI()
+    create = client.create
+    client.chat.completions.create = lambda model, messages: calls.append(messages) or create(model, messages)
+
+    assert llm.complete(client, "Summarize:  mild headache", model="m") == "Patient reports mild headache."
+    # Whitespace-only differences share the entry
+    assert llm.complete(client, "Summarize: mild\nheadache", model="m") == "Patient reports mild headache."
+    assert len(calls) == 1 and cache.stats()["memory_hits"] == 1
+    assert cache.get("other-model", "Summarize: mild headache") is None
+
+    # The memory LRU holds one entry; the file answers for the evicted one and other processes
+    cache.set("m", "second", "2")
+    assert list(cache.memory) == [llm.cache_key("m", "second")]
+    assert llm.LLMCache(path, ttl=60).get("m", "second") == "2"
+    clock[0] += 1
+    assert cache.get("m", "Summarize: mild headache") == "Patient reports mild headache."
+    assert cache.stats()["disk_hits"] == 1
+
+    # The file is capped at max_entries, least recently used first, and
+    # entries expire after ttl
+    clock[0] += 1
+    cache.set("m", "third", "3")
+    cache.prune()
+    kept = {row[0] for row in cache.connection.execute("SELECT response FROM completions")}
+    assert kept == {"Patient reports mild headache.", "3"}
+    clock[0] += 60
+    assert cache.get("m", "Summarize: mild headache") is None and cache.get("m", "third") == "3"
+    cache.clear()
+    assert cache.get("m", "third") is None
+
+
+def test_backfill_summarizes_once_and_resumes_from_its_checkpoint(tmp_path):
+    import asyncio
+    from backfill import Backfill
+
+    client = mongo_client()
+    documents = client["nursecheck"]["documents"]
+    ids = documents.insert_many(
+        [{"content": "conversation {}".format(i), "patient_id": ObjectId(), "processed": False} for i in range(6)]
+    ).inserted_ids
+    documents.insert_one({"content": "done", "processed": True, "summary": "kept"})
+    checkpoint = str(tmp_path / "checkpoint.json")
+
+    def run(summarize, **options):
+        backfill = Backfill(client=client, concurrency=3, rate=1000, batch_size=2,
+                            checkpoint_path=checkpoint, report_every=3600, **options)
+        backfill.record.summarize_conversation = summarize
+        return backfill, asyncio.run(backfill.run())
+
+    seen = []
+
+    def summarize(document):
+        seen.append(document["_id"])
+        if document["_id"] == ids[1]:
+            raise RuntimeError("LLM unavailable")
+        return "summary of " + document["content"]
+
+    backfill, result = run(summarize, limit=4)
+    assert result == {"summarized": 3, "failed": 1}
+    assert backfill.checkpoint.last_id == ids[3] and backfill.checkpoint.failed_ids == [str(ids[1])]
+
+    # A second run starts after the checkpoint: nothing is summarized twice
+    seen.clear()
+    _, result = run(summarize)
+    assert sorted(seen) == ids[4:] and result == {"summarized": 2, "failed": 0}
+    assert documents.count_documents({"processed": False}) == 1
+    assert documents.find_one({"_id": ids[5]})["summary"] == "summary of conversation 5"
+    assert documents.find_one({"processed": True, "content": "done"})["summary"] == "kept"
+    with open(checkpoint) as f:
+        assert json.load(f)["summarized"] == 5
+
+
+class FakeHumeHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the Hume /v0/evi/chats API"""
+
+    chats = [{"id": "chat-{}".format(i), "start_timestamp": i} for i in range(5)]
+    events = [
+        {"role": "USER", "message_text": "Message {}".format(i), "emotion_features": json.dumps({"Pain": 0.1})}
+        for i in range(7)
+    ]
+    requests = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        FakeHumeHandler.requests.append(url.path)
+        page_number = int(params["page_number"][0])
+        page_size = int(params["page_size"][0])
+        if url.path == "/v0/evi/chats":
+            items = self.chats if params["ascending_order"][0] == "true" else self.chats[::-1]
+            body = {"chats_page": items[page_number * page_size:(page_number + 1) * page_size]}
+        else:
+            items = self.events
+            body = {
+                "id": url.path.rsplit("/", 1)[-1],
+                "status": "USER_ENDED",
+                "start_timestamp": 1,
+                "end_timestamp": 2,
+                "events_page": items[page_number * page_size:(page_number + 1) * page_size],
+            }
+        body.update(page_number=page_number, page_size=page_size, total_pages=-(-len(items) // page_size))
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_hume_client_pages_and_caches_chats(tmp_path):
+    from chat import HumeChatClient
+
+    with local_server(FakeHumeHandler) as base_url:
+        hume = HumeChatClient(api_key="test", base_url=base_url, page_size=2, cache_dir=str(tmp_path))
+        assert [chat["id"] for chat in hume.iter_chats()] == ["chat-{}".format(i) for i in range(5)]
+        assert hume.latest_chat()["id"] == "chat-4"
+
+        FakeHumeHandler.requests.clear()
+        chat = hume.get_chat("chat-4")
+        assert len(chat["events"]) == 7
+        assert len(FakeHumeHandler.requests) == 4
+
+        # Finished chats are served from the cache, in memory and on disk
+        assert hume.get_chat("chat-4") == chat
+        fresh = HumeChatClient(api_key="test", base_url=base_url, cache_dir=str(tmp_path))
+        assert fresh.get_chat("chat-4") == chat
+        assert len(FakeHumeHandler.requests) == 4
+
+
+def test_emotion_matrix_ranks_only_scored_emotions():
+    import numpy as np
+    from emotions import EMOTIONS, EmotionMatrix, decode_vector, encode_vector, stack_notes, top_emotions_dict, top_k
+
+    emotions = EmotionMatrix.from_events([
+        {"emotion_features": {"Pain": 0.5, "Calmness": 0.1, "Unknown": 9.0}, "timestamp": 10},
+        {"role": "ASSISTANT"},
+        {"emotion_features": json.dumps({"Pain": 0.25, "Fear": 0.25}), "timestamp": 20},
+    ])
+    assert len(emotions) == 2 and list(emotions.timestamps) == [10, 20]
+    assert emotions.top_k(5) == [("Pain", 0.75), ("Fear", 0.25), ("Calmness", pytest.approx(0.1))]
+    assert emotions.top_k(1, reduce="mean") == [("Pain", 0.375)]
+    assert top_emotions_dict(emotions.sums(), 2) == {"Pain": 0.75, "Fear": 0.25}
+    timestamps, pain = emotions.series("Pain")
+    assert list(pain) == [0.5, 0.25]
+
+    # Nothing scored above 0: no emotions, rather than 5 zero ones
+    assert top_k(np.zeros(len(EMOTIONS))) == []
+    assert EmotionMatrix.from_events([]).top_k(5) == []
+    assert top_k(-np.ones(len(EMOTIONS))) == []
+
+    vector = emotions.sums()
+    assert np.array_equal(decode_vector(encode_vector(vector)), vector)
+    assert decode_vector({"Pain": 0.5, "Unknown": 1})[EMOTIONS.index("Pain")] == 0.5
+    stacked = stack_notes([{"emotion_vector": encode_vector(vector)}, {"emotions": {"Fear": 1}}, {}])
+    assert stacked.shape == (3, len(EMOTIONS)) and stacked[1, EMOTIONS.index("Fear")] == 1
+
+
+def test_render_service_coalesces_updates(monkeypatch, tmp_path):
+    import render_service
+
+    monkeypatch.chdir(tmp_path)
+    started = threading.Event()
+    release = threading.Event()
+    rendered = []
+
+    def fake_render(patient_id):
+        rendered.append(patient_id)
+        started.set()
+        release.wait(10)
+
+    monkeypatch.setattr(render_service, "render_patient_pdf", fake_render)
+    renders = render_service.RenderService(workers=0, delay=0)
+
+    assert renders.request("p1") == "scheduled"
+    assert started.wait(10)
+    # Twenty notes arrive while the first render runs
+    for _ in range(20):
+        assert renders.request("p1") == "coalesced"
+    assert renders.status("p1")["state"] == "pending"
+    release.set()
+    assert renders.wait(timeout=10)
+    assert rendered == ["p1", "p1"]
+    renders.shutdown()
+
+
+def test_kiosk_renders_pdf_and_alerts_before_exiting(monkeypatch, tmp_path):
+    from pdf import pdf_path
+
+    # The delay would outlive the kiosk process
+    chat, renders, dispatcher, sent = use_fake_pipeline(monkeypatch, tmp_path, render_delay=3600)
+
+    def stop_recording(self):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(chat.Chat, "record_streaming", stop_recording)
+    chat.Chat(str(PATIENT_ID)).chat()
+
+    assert (tmp_path / pdf_path(PATIENT_ID)).exists()
+    assert renders.status(PATIENT_ID)["state"] == "fresh"
+    # Sent without waiting for the window
+    assert dispatcher.counts() == {"sent": 1}
+    assert len(sent) == 1 and "Alex Doan" in sent[0]["html"]
+
+
+def test_qr_store_serves_from_memory_and_writes_in_background(monkeypatch, tmp_path):
+    import qr_codes
+
+    monkeypatch.chdir(tmp_path)
+    store = qr_codes.QRCodeStore(max_entries=2)
+    first, second, third = "p1", "p2", "p3"
+    assert store.generate(first).result(timeout=30) == qr_codes.qr_path(first)
+    png = store.get(first)
+    assert png.startswith(b"\x89PNG") and store.get(first) is png
+    with open(qr_codes.qr_path(first), "rb") as f:
+        assert f.read() == png
+
+    # A code that was never generated is encoded on read and written later
+    assert store.get(second) == qr_codes.encode_png(second)
+    store.flush()
+    assert os.path.exists(qr_codes.qr_path(second))
+
+    # The LRU keeps max_entries codes; evicted ones are read back from disk
+    store.generate(third).result(timeout=30)
+    assert list(store.memory) == [second, third]
+    assert store.get(first) == png and list(store.memory) == [third, first]
+
+    store.delete(first)
+    assert first not in store.memory and not os.path.exists(qr_codes.qr_path(first))
+
+    patients = mongo_client()["nursecheck"]["patients"]
+    patients.insert_many([{"_id": second}, {"_id": "p4"}, {"_id": "p5"}])
+    assert sorted(qr_codes.missing_patient_ids(patients)) == ["p4", "p5"]
+    assert qr_codes.generate_missing(patients, workers=1) == 2
+    assert qr_codes.missing_patient_ids(patients) == []
+
+
+def test_qr_route_serves_only_existing_patients(monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+    import app
+    import qr_codes
+
+    monkeypatch.chdir(tmp_path)
+    client = mongo_client(monkeypatch)
+    store = qr_codes.QRCodeStore()
+    monkeypatch.setattr(qr_codes, "_store", store)
+    patient_id = str(client["nursecheck"]["patients"].insert_one({"first_name": "Alex"}).inserted_id)
+    api = TestClient(app.app)
+
+    response = api.get("/patients/{}/qr".format(patient_id))
+    assert response.status_code == 200 and response.content == qr_codes.encode_png(patient_id)
+    # Unknown and invalid IDs are neither encoded, cached nor written
+    assert api.get("/patients/{}/qr".format(ObjectId())).status_code == 404
+    assert api.get("/patients/not-an-id/qr").status_code == 404
+    store.flush()
+    assert list(store.memory) == [patient_id]
+    assert os.listdir(qr_codes.QR_DIR) == [os.path.basename(qr_codes.qr_path(patient_id))]
+
+
+def test_note_history_appends_into_buckets_and_reads_newest_first():
+    from note_history import NoteHistory
+
+    db = mongo_client()["nursecheck"]
+    history = NoteHistory(db, bucket_size=2)
+    patient_id = ObjectId()
+    # Notes written before buckets existed live in the record
+    db["records"].insert_one({"patient_id": patient_id, "notes": [
+        {"timestamp": "2024-01-03 09:00:00", "content": "legacy 1", "priority": 1},
+        {"timestamp": "2024-01-04 09:00:00", "content": "legacy 2", "priority": 2},
+    ]})
+    timestamps = ["2024-02-01 09:00:00", "2024-02-02 09:00:00", "2024-02-03 09:00:00", "2024-03-01 09:00:00"]
+    for number, timestamp in enumerate(timestamps, 3):
+        history.append(patient_id, {"timestamp": timestamp, "content": "note {}".format(number), "priority": number})
+    history.append(ObjectId(), {"timestamp": timestamps[0], "content": "other patient"})
+
+    # A full month continues in a new bucket
+    buckets = list(db["record_notes"].find({"patient_id": patient_id}).sort("first_timestamp", 1))
+    assert [(bucket["month"], bucket["count"]) for bucket in buckets] == [("2024-02", 2), ("2024-02", 1), ("2024-03", 1)]
+    assert history.count(patient_id) == 4
+
+    assert [note["content"] for note in history.latest(patient_id, 3)] == ["note 4", "note 5", "note 6"]
+    assert history.latest(patient_id, 2, fields=["priority"]) == [{"priority": 5}, {"priority": 6}]
+    assert history.last(patient_id)["content"] == "note 6"
+    # Legacy notes are older than any bucket
+    assert [note["content"] for note in history.latest(patient_id, 5)] == ["legacy 2", "note 3", "note 4", "note 5", "note 6"]
+    everything = ["legacy 1", "legacy 2", "note 3", "note 4", "note 5", "note 6"]
+    assert [note["content"] for note in history.iter_notes(patient_id)] == everything
+
+    # Migrating seals the legacy notes into buckets; running it again changes nothing
+    assert history.migrate() == 1 and history.migrate() == 0
+    assert "notes" not in db["records"].find_one({"patient_id": patient_id})
+    assert [note["content"] for note in history.iter_notes(patient_id)] == everything
+    assert history.latest(patient_id, 6) == list(history.iter_notes(patient_id))
+    assert history.last(ObjectId()) is None
+
+
+def test_bulk_updates_skip_stale_versions_and_portal_writes_invalidate(monkeypatch):
+    from portal_data import PortalData
+    from response_cache import patient_tag, response_cache
+
+    client = mongo_client()
+    system = System(client=client)
+    patients = client["nursecheck"]["patients"]
+    fresh, moved, plain = patients.insert_many([
+        {"first_name": "A", "assign_nurse_id": "n1", "order": 1, "process": False, "version": 2},
+        {"first_name": "B", "assign_nurse_id": "n1", "order": 2, "process": False, "version": 5},
+        {"first_name": "C", "assign_nurse_id": "n1", "order": 3, "process": False},
+    ]).inserted_ids
+
+    result = system.bulk_update_patients([
+        {"patient_id": fresh, "set": {"order": 7}, "expected_version": 2},
+        {"patient_id": moved, "set": {"order": 7}, "expected_version": 4},
+        {"patient_id": plain, "inc": {"order": 1}},
+    ])
+    assert result == {"matched": 2, "modified": 2, "stale": [moved]}
+    assert patients.find_one({"_id": fresh})["order"] == 7
+    assert patients.find_one({"_id": moved}) == {
+        "_id": moved, "first_name": "B", "assign_nurse_id": "n1", "order": 2, "process": False, "version": 5,
+    }
+    assert patients.find_one({"_id": plain})["order"] == 4
+    assert system.bulk_update_patients([{"patient_id": fresh, "set": {"order": 8}, "expected_version": 3}])["stale"] == []
+
+    # The portal's checkbox goes through System: version bump and cache invalidation
+    response_cache.set("profile:" + str(plain), b"{}", tags=[patient_tag(plain)])
+    PortalData(client["nursecheck"], {}).set_process(str(plain), True)
+    assert response_cache.get("profile:" + str(plain)) is None
+    assert patients.find_one({"_id": plain})["process"] is True
+    assert patients.find_one({"_id": plain})["version"] == 2
+    response_cache.clear()
+
+
+def test_identity_indexes_replace_the_old_ones_only_once_built(monkeypatch):
+    from pymongo.errors import OperationFailure
+    import indexes
+    import system as system_module
+
+    client = mongo_client()
+    db = client["nursecheck"]
+    identity = [("first_name", 1), ("last_name", 1), ("dob", 1), ("email", 1)]
+    db["patients"].create_index(identity, name="patient_identity")
+    twin = {"first_name": "Alex", "last_name": "Doan", "dob": "1990-01-01", "email": "a@example.com"}
+    db["patients"].insert_many([dict(twin), dict(twin)])
+
+    # The duplicates block the unique index, so the old one stays
+    indexes.ensure_indexes(db, force=True)
+    existing = db["patients"].index_information()
+    assert "patient_identity" in existing and "patient_identity_unique" not in existing
+
+    db["patients"].delete_one(twin)
+    indexes.ensure_indexes(db, force=True)
+    existing = db["patients"].index_information()
+    assert "patient_identity" not in existing and existing["patient_identity_unique"]["unique"]
+    assert "nurse_identity_unique" in db["nurses"].index_information()
+
+    # A server that refuses two indexes on the same keys gets them swapped,
+    # and the old one back if the new one cannot be built
+    class SameKeysCollection:
+        def __init__(self, collection, fail):
+            self.collection = collection
+            self.fail = fail
+
+        def create_index(self, keys, **options):
+            if options.get("unique"):
+                if "old" in self.collection.index_information():
+                    raise OperationFailure("Index already exists with a different name", indexes.INDEX_OPTIONS_CONFLICT)
+                if self.fail:
+                    raise OperationFailure("E11000 duplicate key error", 11000)
+            return self.collection.create_index(keys, **options)
+
+        def drop_index(self, name):
+            self.collection.drop_index(name)
+
+    for fail in (False, True):
+        collection = client["swap"]["fail" if fail else "ok"]
+        collection.create_index([("a", 1)], name="old")
+        wrapped = SameKeysCollection(collection, fail)
+        if fail:
+            with pytest.raises(OperationFailure):
+                indexes.create_index(wrapped, [("a", 1)], {"name": "new", "unique": True}, ("old", [("a", 1)]))
+            assert sorted(collection.index_information()) == ["_id_", "old"]
+        else:
+            assert indexes.create_index(wrapped, [("a", 1)], {"name": "new", "unique": True}, ("old", [("a", 1)])) == "new"
+            assert sorted(collection.index_information()) == ["_id_", "new"]
+
+    # With the unique index in place, creating the same patient twice returns the first ID
+    monkeypatch.setattr(system_module, "get_qr_store", lambda: SimpleNamespace(generate=lambda patient_id: None))
+    monkeypatch.setattr(system_module, "patient_index", SimpleNamespace(update=lambda patient_id, note: None))
+    system = System(client=client)
+    patient = Patient("Sam", "Lee", 40, "1985-02-03", "1 Main St", 70, "O+", "555-0100", "s@example.com", "M", "12")
+    first = system.create_patient(patient)
+    assert system.create_patient(patient) == first
+    assert db["patients"].count_documents({"first_name": "Sam"}) == 1
+
+
+def test_portal_data_caches_reads_per_session(monkeypatch):
+    import portal_data
+
+    db = mongo_client()["nursecheck"]
+    ids = db["patients"].insert_many(
+        [{"first_name": "P{}".format(order), "assign_nurse_id": "n1", "order": order, "process": False}
+         for order in (9, 7, 5)]
+    ).inserted_ids
+    state = {}
+    data = portal_data.PortalData(db, state, ttl=30)
+    monkeypatch.setattr(data, "page_size", 2)
+
+    pages = data.nurse_patients("n1")
+    assert [patient["_id"] for patient in pages["patients"]] == ids[:2] and pages["next_cursor"]
+    # A Streamlit rerun builds a new PortalData on the same session state
+    rerun = portal_data.PortalData(db, state, ttl=30)
+    assert rerun.nurse_patients("n1") is pages and rerun.reads == 0
+    rerun.load_more("n1")
+    assert [patient["_id"] for patient in pages["patients"]] == ids and pages["next_cursor"] is None
+    # Listed patients are cached one by one; the others come in one $in query
+    other = db["patients"].insert_one({"first_name": "Q", "assign_nurse_id": "n2", "order": 1}).inserted_id
+    found = rerun.patients([str(ids[0]), str(other)])
+    assert set(found) == {str(ids[0]), str(other)} and rerun.reads == 2
+    assert rerun.patient(str(other))["first_name"] == "Q" and rerun.reads == 2
+
+    # Checking a patient off moves it between the cached lists without a read
+    processed = rerun.nurse_patients("n1", processed=True)
+    reads = rerun.reads
+    rerun.set_process(str(ids[1]), True)
+    assert [patient["_id"] for patient in pages["patients"]] == [ids[0], ids[2]]
+    assert [patient["_id"] for patient in processed["patients"]] == [ids[1]]
+    assert rerun.reads == reads and db["patients"].find_one({"_id": ids[1]})["process"] is True
+
+    calls = []
+    assert rerun.cached(("similarity", "x"), lambda: calls.append(1) or ["y"]) == ["y"]
+    assert rerun.cached(("similarity", "x"), lambda: calls.append(1) or ["z"]) == ["y"] and calls == [1]
+    rerun.patient_created("n1")
+    assert ("similarity", "x") not in state["portal_cache"] and ("list", "n1", False) not in state["portal_cache"]
+
+    # Entries expire after ttl
+    expired = portal_data.PortalData(db, state, ttl=0)
+    expired.nurse_patients("n2")
+    assert expired.reads == 1
+    expired.nurse_patients("n2")
+    assert expired.reads == 2
+
+
+def test_keyset_pages_cover_every_patient_once():
+    from system import decode_cursor, encode_cursor, page_sort_key
+
+    client = mongo_client()
+    system = System(client=client)
+    patients = client["nursecheck"]["patients"]
+    patients.insert_many(
+        [{"assign_nurse_id": "n1", "order": order, "process": False} for order in (5, 5, 5, 3, 8)]
+        + [{"assign_nurse_id": "n1"}, {"assign_nurse_id": "n1", "order": None, "process": False}]
+        + [{"assign_nurse_id": "n1", "order": 9, "process": True}, {"assign_nurse_id": "n2", "order": 9}]
+    )
+    expected = sorted(patients.find({"assign_nurse_id": "n1", "process": {"$ne": True}}), key=page_sort_key)
+
+    for limit in (1, 2, 3, 7, 20):
+        seen, cursor, pages = [], None, 0
+        while True:
+            page = system.get_patients_page("n1", limit=limit, cursor=cursor)
+            seen.extend(page["patients"])
+            pages += 1
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        # Ties on order continue by _id, patients without an order come last,
+        # and an exactly full last page has no next cursor
+        assert seen == expected
+        assert pages == max(1, -(-len(expected) // limit))
+
+    # A cursor keeps its position when patients are added before it
+    first = system.get_patients_page("n1", limit=2)
+    patients.insert_one({"assign_nurse_id": "n1", "order": 10, "process": False})
+    later = patients.insert_one({"assign_nurse_id": "n1", "order": 1, "process": False}).inserted_id
+    rest = system.get_patients_page("n1", limit=20, cursor=first["next_cursor"])["patients"]
+    assert [patient["_id"] for patient in rest] == [patient["_id"] for patient in expected[2:5]] + [later] + [
+        patient["_id"] for patient in expected[5:]
+    ]
+    assert first["next_cursor"] == encode_cursor(expected[1])
+
+    processed = system.get_patients_page("n1", processed=True, projection={"order": 1})
+    assert [patient["order"] for patient in processed["patients"]] == [9] and processed["next_cursor"] is None
+    assert system.get_patients_page("n3") == {"patients": [], "next_cursor": None}
+    with pytest.raises(ValueError):
+        system.get_patients_page("n1", cursor="not-a-cursor")
+
+    # Orders older versions stored as strings sort ahead of every number
+    # until the index bootstrap converts them
+    import indexes
+    legacy = patients.insert_many([
+        {"assign_nurse_id": "n4", "order": "12", "process": False},
+        {"assign_nurse_id": "n4", "order": "3", "process": False},
+        {"assign_nurse_id": "n4", "order": 7, "process": False},
+    ]).inserted_ids
+    first = system.get_patients_page("n4", limit=1)
+    # "3" > "12" as strings; the cursor still decodes
+    assert decode_cursor(first["next_cursor"]) == (3, legacy[1])
+    indexes.ensure_indexes(client["nursecheck"], force=True)
+    assert patients.find_one({"_id": legacy[1]})["order"] == 3
+    first = system.get_patients_page("n4", limit=1)
+    rest = system.get_patients_page("n4", limit=5, cursor=first["next_cursor"])["patients"]
+    assert [patient["_id"] for patient in first["patients"] + rest] == legacy[::2] + [legacy[1]]
+
+
+def test_job_queue_never_runs_a_leased_job_twice(tmp_path):
+    from jobs import JobQueue
+
+    path = str(tmp_path / "jobs.sqlite3")
+    started = threading.Event()
+    release = threading.Event()
+    runs = []
+
+    def handler(payload):
+        runs.append(payload)
+        started.set()
+        release.wait(5)
+        return "done"
+
+    first = JobQueue(path, workers=1, poll_interval=0.01, lease=0.3)
+    second = JobQueue(path, workers=2, poll_interval=0.01, lease=0.3)
+    for queue in (first, second):
+        queue.register("work", handler)
+    job, _ = first.enqueue("work", {"n": 1})
+    first.start()
+    try:
+        assert started.wait(5)
+        # Another worker starting, e.g. in a rolling restart, outlives the
+        # lease while the first still runs the job and renews it
+        second.start()
+        time.sleep(1)
+        assert runs == [{"n": 1}]
+        release.set()
+        assert wait_for(lambda: first.get(job["id"])["state"] == "succeeded")
+        assert first.get(job["id"])["attempts"] == 1
+    finally:
+        release.set()
+        first.stop(timeout=5)
+        second.stop(timeout=5)
+
+
+def test_job_queue_recovers_jobs_of_dead_workers(tmp_path):
+    from jobs import JobQueue
+
+    path = str(tmp_path / "jobs.sqlite3")
+    # A worker that claimed both jobs and died without finishing them
+    crashed = JobQueue(path, workers=0, max_attempts=2, lease=0.05)
+    exhausted, _ = crashed.enqueue("work", {"n": 1})
+    retried, _ = crashed.enqueue("work", {"n": 2})
+    crashed._claim()
+    crashed._claim()
+    time.sleep(0.1)
+    # Its replacement took the oldest job back and died too
+    assert JobQueue(path, workers=0, max_attempts=2, lease=0.05)._claim()["id"] == exhausted["id"]
+    time.sleep(0.1)
+
+    restarted = JobQueue(path, workers=1, max_attempts=2, poll_interval=0.01, lease=60)
+    restarted.register("work", lambda payload: payload["n"])
+    restarted.start()
+    try:
+        assert wait_for(lambda: restarted.get(retried["id"])["state"] == "succeeded")
+        assert restarted.get(retried["id"])["attempts"] == 2
+        assert restarted.get(retried["id"])["result"] == 2
+        assert restarted.get(exhausted["id"])["state"] == "failed"
+    finally:
+        restarted.stop(timeout=5)
+
+
+def test_read_api_etags_and_invalid_input(monkeypatch):
+    from fastapi.testclient import TestClient
+    import app
+    from response_cache import response_cache
+
+    mongo_client(monkeypatch)
+    response_cache.clear()
+    system = System()
+    patient_id = str(system.client["nursecheck"]["patients"].insert_one(
+        {"first_name": "Alex", "last_name": "Doan", "assign_nurse_id": "n1", "order": 3, "note": "", "version": 0}
+    ).inserted_id)
+    client = TestClient(app.app)
+
+    first = client.get("/patients/{}/profile".format(patient_id))
+    assert first.status_code == 200 and first.json()["first_name"] == "Alex"
+    etag = first.headers["ETag"]
+    assert client.get("/patients/{}/profile".format(patient_id), headers={"If-None-Match": etag}).status_code == 304
+    # A write through System drops the cached response, so the ETag changes
+    system.set_patient_fields(patient_id, {"note": "Headache"})
+    changed = client.get("/patients/{}/profile".format(patient_id), headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    assert changed.json()["note"] == "Headache"
+
+    page = client.get("/nurses/n1/patients", params={"limit": 1})
+    assert [patient["_id"] for patient in page.json()["patients"]] == [patient_id]
+
+    assert client.get("/patients/not-an-id/profile").status_code == 404
+    assert client.get("/patients/not-an-id/record").status_code == 404
+    assert client.get("/patients/{}/profile".format(ObjectId())).status_code == 404
+    assert client.get("/nurses/n1/patients", params={"cursor": "garbage"}).status_code == 400
+    assert client.get("/nurses/n1/patients", params={"limit": 0}).status_code == 422
+    assert client.get("/nurses/n1/patients", params={"limit": 101}).status_code == 422
+    response_cache.clear()
+
+
+def test_metrics_spans_and_exposition():
+    import metrics
+
+    registry = metrics.Registry()
+    seconds = registry.histogram("test_seconds", "Test spans", ("span",), buckets=(0.1, 1.0))
+    seconds.observe(0.05, "a")
+    seconds.observe(0.5, "a")
+    seconds.observe(5, "a")
+    text = registry.render()
+    assert 'test_seconds_bucket{span="a",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{span="a",le="1"} 2' in text
+    assert 'test_seconds_bucket{span="a",le="+Inf"} 3' in text
+    assert 'test_seconds_count{span="a"} 3' in text
+
+    count, _ = metrics.SPAN_SECONDS.snapshot("test.failing")
+    with pytest.raises(ValueError):
+        with metrics.span("test.failing"):
+            raise ValueError()
+    assert metrics.SPAN_SECONDS.snapshot("test.failing")[0] == count + 1
+    assert metrics.SPAN_IN_FLIGHT.values[("test.failing",)] == 0
+    assert metrics.SPAN_ERRORS.values[("test.failing",)] >= 1
+
+    listener = metrics.MongoCommandMetrics()
+    count, _ = metrics.MONGO_SECONDS.snapshot("find")
+    listener.started(SimpleNamespace(command_name="find"))
+    listener.succeeded(SimpleNamespace(command_name="find", duration_micros=1500))
+    assert metrics.MONGO_SECONDS.snapshot("find")[0] == count + 1
+    assert 'nursecheck_mongo_command_seconds_count{command="find"}' in metrics.registry.render()
+
+
+def test_settings_in_dotenv_apply_to_import_time_settings():
+    # db imports metrics before it loads .env itself
+    assert import_with_dotenv("import db, metrics; print(metrics.ENABLED)", METRICS_ENABLED="0") == "False"
+    # system imports response_cache before it loads .env itself
+    assert import_with_dotenv(
+        "import system, response_cache as r; print(r.response_cache.ttl, r.response_cache.max_entries)",
+        RESPONSE_CACHE_TTL="5", RESPONSE_CACHE_ENTRIES="7",
+    ) == "5.0 7"
+    assert import_with_dotenv(
+        "import system, triage_queue; print(triage_queue.get_triage_queue().max_age)", TRIAGE_QUEUE_MAX_AGE="5"
+    ) == "5.0"
+
+
+class FakeResendHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the Resend /emails API. Fails the first `failures` requests."""
+
+    failures = 0
+    emails = []
+
+    def do_POST(self):
+        message = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if FakeResendHandler.failures:
+            FakeResendHandler.failures -= 1
+            status, body = 500, {"statusCode": 500, "name": "application_error", "message": "Try again"}
+        else:
+            FakeResendHandler.emails.append(message)
+            status, body = 200, {"id": "email-{}".format(len(FakeResendHandler.emails))}
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_alert_dispatcher_coalesces_and_retries(monkeypatch, tmp_path):
+    import alerts
+    import resend
+
+    monkeypatch.setattr(FakeResendHandler, "failures", 1)
+    monkeypatch.setattr(FakeResendHandler, "emails", [])
+    nurses = {
+        "n1": {"email": "n1@example.com", "first_name": "Ann", "last_name": "Lee"},
+        "n2": {"email": "n2@example.com", "first_name": "Bo", "last_name": "Kim"},
+    }
+    with local_server(FakeResendHandler) as base_url:
+        monkeypatch.setattr(resend, "api_url", base_url)
+        dispatcher = alerts.AlertDispatcher(
+            str(tmp_path / "alerts.sqlite3"), window=60, retry_delay=0, nurse_lookup=nurses.get
+        )
+        dispatcher.alert("n1", "p1", "Alex Doan")
+        dispatcher.alert("n1", "p1", "Alex Doan")
+        dispatcher.alert("n1", "p2", "Sam Tran")
+        dispatcher.alert("n2", "p3", "Kai Ng")
+        # Duplicates for the same patient are merged
+        assert dispatcher.counts() == {"pending": 3}
+        # Nothing is sent before the window closes
+        assert dispatcher.flush() == 0
+
+        later = time.time() + 61
+        # One digest fails once and is retried
+        assert dispatcher.flush(later) == 1
+        assert dispatcher.flush(later) == 1
+    assert dispatcher.counts() == {"sent": 3}
+    digests = {email["to"]: email for email in FakeResendHandler.emails}
+    assert len(FakeResendHandler.emails) == 2
+    assert "Alex Doan" in digests["n1@example.com"]["html"]
+    assert "Sam Tran" in digests["n1@example.com"]["html"]
+    assert "2 conversations" in digests["n1@example.com"]["html"]
+    assert "Kai Ng" in digests["n2@example.com"]["html"]
+
+
+def test_alert_dispatcher_urgent_and_claimed_once(tmp_path):
+    import alerts
+
+    path = str(tmp_path / "alerts.sqlite3")
+    nurse = {"email": "n1@example.com", "first_name": "Ann", "last_name": "Lee"}
+    sent = []
+    # Two workers sharing the outbox
+    first = alerts.AlertDispatcher(path, window=60, sender=sent.append, nurse_lookup=lambda nurse_id: nurse)
+    second = alerts.AlertDispatcher(path, window=60, sender=sent.append, nurse_lookup=lambda nurse_id: nurse)
+
+    first.alert("n1", "p1", "Alex Doan", urgent=True)
+    # Urgent alerts do not wait for the window
+    assert second.due() == ["n1"]
+    # A sender that died holding the rows: its claim expires
+    crashed = alerts.AlertDispatcher(path, sender=sent.append, nurse_lookup=lambda nurse_id: nurse, claim_timeout=-1)
+    assert len(crashed.claim("n1")) == 1
+    assert second.flush() == 1 and len(sent) == 1
+
+    first.alert("n1", "p2", "Sam Tran", urgent=True)
+    assert len(first.claim("n1")) == 1
+    # Claimed by the first worker: the second sends nothing
+    assert second.flush() == 0 and second.flush(force=True) == 0
+    assert len(sent) == 1
+
+    second.alert("n2", "p3", "Kai Ng")
+    assert "n2" not in second.due()
+    # Before exiting, pending digests go out regardless of the window
+    assert second.drain() == 1 and len(sent) == 2
+
+
+def test_entry_modules_import_without_sdks_or_clients():
+    heavy = ("openai", "hume", "fpdf", "qrcode", "resend", "google.generativeai", "uvicorn", "PIL", "streamlit_pdf_viewer")
+    loaded = import_with_dotenv(
+        "import sys, app, chat, db, llm, render_service, alerts, jobs\n"
+        "print(sorted(name for name in {!r} if name in sys.modules))\n"
+        "print(llm._client, llm._cache, db._clients, render_service._service, alerts._dispatcher, jobs._queue)\n".format(heavy)
+    )
+    assert loaded.splitlines() == ["[]", "None None {} None None None"]
+
+
+def test_models_decode_and_validate_many():
+    from objects import decode, validate_many
+
+    client = mongo_client()
+    system = System(client=client)
+    patient = Patient("Alex", "Doan", 27, "01/01/1996", "123 Main St", 180, "O+", "123-456-7890",
+                      "alex@example.com", "female", "123", None, 3, "Headache")
+    assert patient.to_dict()["order"] == 3 and "id" not in patient.to_dict()
+    assert Patient(**patient.to_dict()) == patient
+    assert Nurse("Jane", "Doe", 40, "9am-5pm", "555-0100", email="j@example.com").email == "j@example.com"
+    with pytest.raises(TypeError):
+        Nurse("Jane", "Doe", 40, "9am-5pm", "555-0100", "j@example.com", "extra")
+    patient_id = client["nursecheck"]["patients"].insert_one(dict(patient.to_dict(), version=0)).inserted_id
+
+    found = system.find_patients(fields=["first_name", "order"])
+    assert [(p.id, p.first_name, p.order) for p in found] == [(str(patient_id), "Alex", 3)]
+    assert not hasattr(found[0], "last_name")
+    assert decode(Patient, client["nursecheck"]["patients"].find())[0] == patient.model_copy(update={"id": str(patient_id)})
+
+    rows = [patient.to_dict(), dict(patient.to_dict(), age="old"), {"first_name": "Sam"}]
+    patients, errors = validate_many(Patient, rows)
+    assert [index for index, _ in patients] == [0]
+    assert errors[1].startswith("age:") and "room_number: Field required" in errors[2]
+
+
+def test_local_triage_scores_and_evaluates(monkeypatch):
+    import triage
+    from emotions import EmotionMatrix, encode_vector
+
+    scorer = triage.TriageScorer()
+    calm = EmotionMatrix.from_events([{"emotion_features": {"Calmness": 0.6, "Contentment": 0.4}}] * 4)
+    urgent = scorer.score_chat("Nurse: How are you?\nPatient: I have chest pain.\n", calm)
+    assert urgent.priority >= 9 and urgent.confidence >= 0.9 and urgent.version == "rules-1"
+    fine = scorer.score_chat("Nurse: How are you?\nPatient: Better today, no pain.\n", calm)
+    assert fine.priority <= 3 and "moderate" not in fine.features["rules"]
+    for sentence in ("No, I have chest pain.", "Not really, I can't breathe."):
+        negated = scorer.score_chat("Nurse: Are you OK?\nPatient: {}\n".format(sentence), calm)
+        assert negated.priority >= 9 and "critical" in negated.features["rules"]
+    # A negated critical term keeps the priority but leaves it to the LLM
+    for sentence in ("I have no chest pain.", "Denies suicidal thoughts."):
+        negated = scorer.score_chat("Nurse: Anything else?\nPatient: {}\n".format(sentence), calm)
+        assert negated.priority >= 9 and negated.features["negated_critical"]
+        assert negated.confidence < triage.min_confidence()
+    clause = scorer.score_chat("Nurse: Any pain?\nPatient: Not since yesterday, but my headache is back.\n", calm)
+    assert "moderate" in clause.features["rules"]
+
+    assert triage.parse_priority("Priority: 7/10") == 7
+    assert triage.parse_priority("On a scale of 1-10 the priority is 7") == 7
+    assert triage.parse_priority("Priority (1 to 10): 3") == 3
+    assert triage.parse_priority("Level 2 concern, I would rate it 6 out of 10.") == 6
+    assert triage.parse_priority("Between 1 and 10, I'd say 9") == 9
+    assert triage.parse_priority("8") == 8
+    with pytest.raises(ValueError):
+        triage.parse_priority("Unknown")
+    monkeypatch.setenv("TRIAGE_MIN_CONFIDENCE", "0.75")
+    monkeypatch.setenv("TRIAGE_MODE", "hybrid")
+    assert not triage.needs_llm(urgent)
+    assert triage.resolve_priority(None, urgent) == (urgent.priority, "local:rules-1")
+    assert triage.resolve_priority("I would say 8.", urgent) == (8, "llm")
+    assert triage.resolve_priority("Unknown", fine) == (fine.priority, "local:rules-1")
+
+    notes = [
+        {"content": "Patient: I have chest pain.\n", "priority": 9, "emotion_vector": encode_vector(calm.sums()), "emotion_events": 4},
+        {"content": "Patient: Better today.\n", "priority": 5, "emotion_vector": encode_vector(calm.sums()), "emotion_events": 4},
+        {"content": "Patient: Fine.\n", "priority": 2, "priority_source": "local:rules-1"},
+    ]
+    report = triage.evaluate(notes, scorer, threshold=0.75)
+    assert report["notes"] == 2 and report["confident"]["notes"] >= 1
+    assert report["all"]["mae"] > 0 and report["confident"]["exact"] is not None
+
+
 if __name__ == "__main__":
     pytest.main(["-s", "unit_test.py"])